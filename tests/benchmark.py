@@ -0,0 +1,158 @@
+"""End-to-end throughput benchmark of wowchars against the local mock
+Blizzard server (see lib/MockBlizzardServer.py): a synthetic guild of each
+requested size is fetched with CharactersExtractor.run() (or its asyncio
+counterpart), and the wall time, throughput and request counts are reported.
+
+The results are appended to a JSON Lines file, and compared with the last
+result of the same configuration to catch regressions. Ex:
+    python tests/benchmark.py --sizes 10,100,1000 --workers 8 --latency 0.01
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "lib")))
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import platform
+import subprocess
+import time
+
+import wowchars
+from MockBlizzardServer import MockBlizzardServer
+
+DEFAULT_SIZES = "10,100,1000,5000"
+DEFAULT_RESULTS = os.path.join(os.path.dirname(__file__), "benchmark_results.jsonl")
+CONFIG_KEYS = ("engine", "workers", "latency", "error_rate", "throttle_rate",
+               "check_gear", "single_request", "raid", "size")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark wowchars against a local mock of Blizzard's API")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Sizes of the synthetic guilds (default: %s)" % DEFAULT_SIZES)
+    parser.add_argument("--engine", choices=["sync", "asyncio"], default="sync", help="Extractor to benchmark (default: sync)")
+    parser.add_argument("-w", "--workers", type=int, default=8, help="Workers of the sync engine (default: 8)")
+    parser.add_argument("--latency", type=float, default=0.005, help="Latency of the mock server, in seconds (default: 0.005)")
+    parser.add_argument("--error-rate", type=float, default=0, help="Ratio of the API calls failing with a 503")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="Ratio of the API calls throttled with a 429")
+    parser.add_argument("--check-gear", action="store_true", help="check the gear of the characters")
+    parser.add_argument("--single-request", action="store_true", help="fetch each character with a single API call")
+    parser.add_argument("-r", "--raid", action="store_true", help="only fetch the info usefull for raids")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="JSON Lines file tracking the results (default: %s)" % DEFAULT_RESULTS)
+    parser.add_argument("--no-save", action="store_true", help="do not save the results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown reported as a regression (default: 0.2 = 20%%)")
+    args = parser.parse_args()
+    wowchars.logger.setLevel(logging.ERROR)
+
+    server = MockBlizzardServer(args.latency, args.error_rate, args.throttle_rate, retry_after=0)
+    api_host = server.start_server()
+    previous = load_results(args.results)
+    regressions = 0
+
+    print("%6s %10s %10s %10s %10s  %s" % ("size", "wall (s)", "chars/s", "requests", "req/s", "vs previous"))
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            server.reset_counters()
+            result = run_once(args, api_host, size)
+            result["requests"] = server.get_request_counts()
+            result["total_requests"] = server.get_request_count()
+            result["requests_per_s"] = result["total_requests"] / result["wall"]
+
+            prev = find_previous(previous, result)
+            comparison = ""
+            if prev:
+                ratio = result["wall"] / prev["wall"]
+                comparison = "%+.1f%% (%s)" % ((ratio - 1) * 100, prev["commit"])
+                if ratio > 1 + args.threshold:
+                    comparison += " REGRESSION"
+                    regressions += 1
+            print("%6d %10.3f %10.1f %10d %10.1f  %s" % (size, result["wall"], result["chars_per_s"],
+                                                       result["total_requests"], result["requests_per_s"],
+                                                       comparison))
+            if not args.no_save:
+                with open(args.results, "a") as f:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+    finally:
+        server.stop_server()
+    return 1 if regressions else 0
+
+
+def run_once(args, api_host, size):
+    """Fetch a synthetic guild and measure the run
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+        api_host (str): base URL of the mock server
+        size (int): number of members of the guild
+
+    Returns:
+        (dict) the result
+    """
+    guild = "mock:bench-%d" % size
+    # no quota and no persistent cache: only the extractor is measured
+    options = dict(single_request=args.single_request,
+                   token_store=wowchars.TokenStore(),
+                   rate_limiter=wowchars.RateLimiter(()),
+                   api_host=api_host)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if args.engine == "asyncio":
+            ce = asyncio.run(run_async(guild, args, options))
+        else:
+            ce = wowchars.CharactersExtractor("mock-id", "mock-secret", "eu",
+                                              pool_size=max(wowchars.DEFAULT_POOL_SIZE, args.workers),
+                                              **options)
+            ce.run(guild, [], args.raid, None, False, args.check_gear, None, False, None, args.workers)
+            ce.close()
+    wall = time.perf_counter() - start
+
+    result = {key: getattr(args, key) for key in CONFIG_KEYS if key != "size"}
+    result.update({"size": size,
+                   "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "commit": get_commit(),
+                   "python": platform.python_version(),
+                   "wall": wall,
+                   "chars": len(ce.characters),
+                   "failed": len(ce.failed),
+                   "chars_per_s": len(ce.characters) / wall})
+    return result
+
+
+async def run_async(guild, args, options):
+    async with wowchars.AsyncCharactersExtractor("mock-id", "mock-secret", "eu", **options) as ace:
+        await ace.run(guild, [], args.raid, None, False, args.check_gear, None, False, None)
+    return ace
+
+
+def get_commit():
+    """Get the current commit of the repository, if any"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_results(path):
+    """Load the tracked results"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_previous(results, result, keys=CONFIG_KEYS):
+    """Find the last result with the same configuration (same values of 'keys')"""
+    for r in reversed(results):
+        if all([r.get(k) == result[k] for k in keys]):
+            return r
+    return None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Startup benchmark of wowchars: the import of the module and a minimal
+run of the command line (--version) are timed in fresh interpreters, and
+the modules loaded by the import are checked: Google's API client must only
+be imported when connecting to Google Sheets, asyncio and aiohttp only by the
+asyncio engine.
+
+The results are appended to a JSON Lines file, and compared with the last
+result of the same Python version to catch regressions. The run fails if
+the median import time exceeds the budget. Ex:
+    python tests/import_benchmark.py --runs 20 --budget 0.2 --details 15
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+from benchmark import get_commit, load_results, find_previous
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+DEFAULT_RESULTS = os.path.join(os.path.dirname(__file__), "import_benchmark_results.jsonl")
+DEFAULT_BUDGET = 0.25  # seconds
+CONFIG_KEYS = ("python",)
+LAZY_MODULES = ("googleapiclient", "apiclient", "oauth2client", "httplib2", "aiohttp", "asyncio")
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import wowchars
+elapsed = time.perf_counter() - start
+print(json.dumps({"import": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of wowchars")
+    parser.add_argument("-n", "--runs", type=int, default=10, help="Number of interpreters started per measure (default: 10)")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="Maximum median import time, in seconds (default: %.2f)" % DEFAULT_BUDGET)
+    parser.add_argument("--details", type=int, default=0, help="Display the N slowest imported modules (python -X importtime)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="JSON Lines file tracking the results (default: %s)" % DEFAULT_RESULTS)
+    parser.add_argument("--no-save", action="store_true", help="do not save the results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown reported as a regression (default: 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    imports, starts, clis = [], [], []
+    modules = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        out = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT)
+        starts.append(time.perf_counter() - start)
+        measure = json.loads(out.decode().splitlines()[-1])
+        imports.append(measure["import"])
+        modules = measure["modules"]
+
+        start = time.perf_counter()
+        subprocess.check_output([sys.executable, os.path.join(ROOT, "wowchars.py"), "--version"], cwd=ROOT)
+        clis.append(time.perf_counter() - start)
+
+    result = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "commit": get_commit(),
+              "python": platform.python_version(),
+              "runs": args.runs,
+              "import": statistics.median(imports),
+              "interpreter_with_import": statistics.median(starts),
+              "cli_version": statistics.median(clis),
+              "modules": len(modules)}
+    eager = sorted({m.split(".")[0] for m in modules if m.split(".")[0] in LAZY_MODULES})
+
+    prev = find_previous(load_results(args.results), result, CONFIG_KEYS)
+    failed = False
+    print("%-28s %10s  %s" % ("", "median (s)", "vs previous"))
+    for key, label in (("import", "import wowchars"),
+                       ("interpreter_with_import", "interpreter + import"),
+                       ("cli_version", "wowchars.py --version")):
+        comparison = ""
+        if prev:
+            ratio = result[key] / prev[key]
+            comparison = "%+.1f%% (%s)" % ((ratio - 1) * 100, prev["commit"])
+            if ratio > 1 + args.threshold:
+                comparison += " REGRESSION"
+                failed = True
+        print("%-28s %10.3f  %s" % (label, result[key], comparison))
+    print("%d modules loaded by the import" % result["modules"])
+
+    if result["import"] > args.budget:
+        print("Import time over the budget: %.3fs > %.3fs" % (result["import"], args.budget))
+        failed = True
+    if eager:
+        print("Modules that should be imported lazily: %s" % ", ".join(eager))
+        failed = True
+
+    if args.details:
+        display_import_details(args.details)
+
+    if not args.no_save:
+        with open(args.results, "a") as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+    return 1 if failed else 0
+
+
+def display_import_details(count):
+    """Display the slowest modules imported by wowchars, including their
+    own imports, from python -X importtime
+
+    Args:
+        count (int): number of modules to display
+    """
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", "import wowchars"], cwd=ROOT,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE).stderr.decode()
+    modules = []
+    for line in err.splitlines():
+        fields = line.split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        modules.append((int(fields[1]), int(fields[0].split(":")[1]), fields[2].rstrip()))
+    print("%12s %12s  %s" % ("total (ms)", "self (ms)", "module"))
+    for cumulative, own, name in sorted(modules, reverse=True)[:count]:
+        print("%12.1f %12.1f  %s" % (cumulative / 1000, own / 1000, name))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,90 @@
 import sys, os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
 import wowchars
 
+# shared by all the extractors, so the access token is only fetched once
+TOKEN_STORE = wowchars.TokenStore(os.path.join(wowchars.DEFAULT_CACHE_DIR, "tokens.json"))
+
 class BlizzardTestHelper(object):
     def __init__(self):
         self.extractor = None
+        self.char_states = None
+        self.archive = None
+        self.item_cache = None
+        self.elapsed = None
+        self.scheduler = None
+        self.guild_chars = set()
+        self.explicit_chars = set()
 
-    def init_test(self, api_key):
+    def init_test(self, client_id, client_secret, zone="eu", api_host=None,
+                  state_dir=None, archive_dir=None, replay=False, item_cache_dir=None,
+                  static_cache_dir=None, static_ttl=wowchars.STATIC_CACHE_TTL * 3600,
+                  refresh_static=False):
         if self.extractor:
             print("*WARN* Already initialized")
             return
-        self.extractor = wowchars.CharactersExtractor(api_key)
+        # the tokens of a mock server are not saved
+        token_store = TOKEN_STORE if api_host is None else wowchars.TokenStore()
+        if state_dir:
+            self.char_states = wowchars.CharacterStateStore(os.path.join(state_dir, "characters.sqlite"))
+        if archive_dir:
+            self.archive = wowchars.ApiArchive(archive_dir, replay)
+        if item_cache_dir:
+            self.open_item_cache(item_cache_dir)
+        static_cache = None
+        if static_cache_dir:
+            static_cache = wowchars.StaticDataCache(os.path.join(static_cache_dir, "static-%s.json" % zone),
+                                                    float(static_ttl), refresh_static)
+        self.extractor = wowchars.CharactersExtractor(client_id, client_secret, zone,
+                                                      token_store=token_store,
+                                                      char_states=self.char_states,
+                                                      api_host=api_host,
+                                                      archive=self.archive,
+                                                      item_cache=self.item_cache,
+                                                      static_cache=static_cache)
         self.extractor.fetch_classes()
 
+    def close_test(self):
+        self.scheduler = None
+        self.guild_chars = set()
+        self.explicit_chars = set()
+        if self.extractor:
+            self.extractor.close()
+            self.extractor = None
+        if self.char_states:
+            self.char_states.close()
+            self.char_states = None
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+        self.close_item_cache()
+
+    def open_item_cache(self, directory, max_age=None, max_entries=None):
+        """Open the item cache of a directory, max_age in seconds"""
+        self.item_cache = wowchars.ItemCache(os.path.join(directory, "items.sqlite"),
+                                             float(max_age) if max_age else wowchars.ITEM_CACHE_MAX_AGE * 24 * 3600,
+                                             int(max_entries) if max_entries else wowchars.ITEM_CACHE_MAX_ENTRIES)
+
+    def close_item_cache(self):
+        if self.item_cache:
+            self.item_cache.close()
+            self.item_cache = None
+
+    def cache_item(self, item_id):
+        self.item_cache.put((int(item_id), "", ""), {"id": int(item_id)})
+
+    def read_cached_item(self, item_id):
+        return self.item_cache.get((int(item_id), "", ""))
+
+    def get_cached_item_ids(self):
+        """Get the ids of the items kept in the cache, without using them"""
+        with self.item_cache.lock:
+            return [r[0] for r in self.item_cache.db.execute("SELECT item_id FROM items ORDER BY item_id")]
+
     def get_level(self, server, name):
         char = wowchars.CharInfo(server, name)
         self.extractor.fetch_char_base(char, False)
@@ -29,8 +100,79 @@ class BlizzardTestHelper(object):
         self.extractor.fetch_char_base(char, False)
         return char[wowchars.H_LEG_ITEMS]
 
+    def get_gear_to_fix(self, server, name):
+        char = wowchars.CharInfo(server, name)
+        self.extractor.fetch_char_base(char, True)
+        return char.to_fix
+
+    def build_char(self, server, name):
+        start = time.perf_counter()
+        char = self.extractor.build_char(server, name)
+        self.elapsed = time.perf_counter() - start
+        if char is None:
+            raise AssertionError("cannot fetch %s/%s" % (server, name))
+        return dict(char)
+
+    def build_char_concurrently(self, server, name, count):
+        with ThreadPoolExecutor(max_workers=int(count)) as executor:
+            futures = [executor.submit(self.extractor.build_char, server, name) for _ in range(int(count))]
+            return [dict(f.result()) for f in futures]
+
+    def last_build_should_have_taken_at_least(self, seconds):
+        if self.elapsed < float(seconds):
+            raise AssertionError("%.3fs < %ss" % (self.elapsed, seconds))
+
     def load_achievements(self):
         self.extractor.fetch_achievements_details()
 
     def should_know_achievement(self, achievement_id):
-        self.extractor.get_achievement_title(achievement_id)
\ No newline at end of file
+        self.extractor.get_achievement_title(achievement_id)
+
+    def create_scheduler(self):
+        self.scheduler = wowchars.RefreshScheduler()
+
+    def schedule_refresh(self, server, name, due):
+        self.scheduler.schedule(server, name, float(due))
+
+    def schedule_explicit_character(self, server, name):
+        """Schedule a character as given with -c in daemon mode"""
+        self.scheduler.schedule(server, name, 0)
+        self.explicit_chars.add(wowchars.char_key(server, name))
+
+    def pop_due_refreshes(self, now, max_count=1000):
+        return ["%s:%s" % c for c in self.scheduler.pop_due(float(now), int(max_count))]
+
+    def get_scheduled_count(self):
+        return len(self.scheduler)
+
+    def get_refresh_interval(self, level=120, modified_ago=None):
+        """Get the refresh interval of a character of the given level,
+        modified 'modified_ago' seconds ago (unknown if None)"""
+        char = wowchars.CharInfo("voljin", "oxyde")
+        char[wowchars.H_LVL] = str(level)
+        if modified_ago is not None:
+            char.last_modified = int((time.time() - float(modified_ago)) * 1000)
+        return self.scheduler.get_interval(char)
+
+    def refresh_roster(self, guild):
+        """Fetch the guild roster as done periodically in daemon mode"""
+        self.guild_chars = self.extractor.refresh_guild_roster(guild, None, self.scheduler,
+                                                               self.guild_chars, self.explicit_chars)
+
+    def refresh_due_characters(self):
+        """Fetch and register the characters to refresh now, as done in
+        daemon mode
+
+        Returns:
+            (int) the number of refreshed characters
+        """
+        due = self.scheduler.pop_due(time.time(), len(self.scheduler))
+        for server, name in due:
+            char = self.extractor.build_char(server, name)
+            if char:
+                self.extractor.register_char(char, replace=True)
+            self.scheduler.schedule(server, name, time.time() + self.scheduler.get_interval(char))
+        return len(due)
+
+    def get_registered_count(self):
+        return len(self.extractor.characters)
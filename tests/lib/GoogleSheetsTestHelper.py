@@ -3,17 +3,43 @@ import string, random
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
 
+import wowchars
 from wowchars import SheetConnector, RGBColor
+from MockSheetsService import MockSheetsService
 
 class GoogleSheetsTestHelper(object):
     def __init__(self):
         self.connector = None
+        self.spreadsheet_id = None
+        self.service = None
 
-    def connect(self, spreadsheet_id, dry_run=False):
+    def connect(self, spreadsheet_id, dry_run=False, mock=False):
         if self.connector:
             print("*WARN* Already connected")
             return
-        self.connector = SheetConnector(spreadsheet_id, dry_run)
+        self.spreadsheet_id = spreadsheet_id
+        self.service = MockSheetsService() if mock else None
+        self.connector = SheetConnector(spreadsheet_id, dry_run, self.service)
+
+    def export_roster(self, size, ilvl=340, dry_run=False):
+        """Export the results of a synthetic roster of 'size' characters
+        (Char0, Char1...) with CharactersExtractor.export_results()"""
+        ce = wowchars.CharactersExtractor("mock-id", "mock-secret", "eu")
+        ce.sheets_service = self.service
+        for i in range(int(size)):
+            char = wowchars.CharInfo("voljin", "Char%d" % i)
+            char[wowchars.H_CLASS] = "Mage"
+            char[wowchars.H_LVL] = 120
+            char[wowchars.H_ILVL] = int(ilvl) + i
+            ce.register_char(char)
+        ce.export_results(False, None, False, False, self.spreadsheet_id, dry_run)
+        ce.close()
+
+    def get_sheet_values(self, sheet_name):
+        return self.service.get_sheet_values(sheet_name)
+
+    def get_call_count(self, call=None):
+        return self.service.get_call_count(call)
 
     def sheet_exists(self, sheet_name):
         return self.connector.sheet_exists(sheet_name)
@@ -0,0 +1,315 @@
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CLASSES = ["Warrior", "Paladin", "Hunter", "Rogue", "Priest", "Death Knight",
+           "Shaman", "Mage", "Warlock", "Monk", "Druid", "Demon Hunter"]
+SLOTS = ["head", "neck", "shoulder", "back", "chest", "wrist", "hands", "waist",
+         "legs", "feet", "finger1", "finger2", "trinket1", "trinket2", "mainHand", "offHand"]
+DEFAULT_GUILD_SIZE = 10
+
+
+def crc(*values):
+    """Deterministic hash of the given values"""
+    return zlib.crc32(":".join([str(v) for v in values]).lower().encode())
+
+
+class MockBlizzardServer(object):
+    """Local stand-in for Blizzard's API and OAuth servers, serving synthetic
+    (or recorded) responses for all the URLs used by wowchars, with
+    configurable latency, errors and throttling. Usable as a Robot Framework
+    library or from Python:
+
+        server = MockBlizzardServer(latency=0.005)
+        api_host = server.start_server()
+        ce = wowchars.CharactersExtractor(client_id, client_secret, "eu", api_host=api_host)
+
+    The synthetic guilds have DEFAULT_GUILD_SIZE members, or N members when
+    their name ends with "-N" (ex: "voljin:bench-500").
+
+    The access tokens are numbered, the revoked ones (see revoke_tokens())
+    are answered with a 401. Deterministic failures can be requested with
+    fail_next_requests().
+    """
+
+    ROBOT_LIBRARY_SCOPE = "GLOBAL"
+
+    def __init__(self, latency=0, error_rate=0, throttle_rate=0, retry_after=1, seed=0):
+        """Constructor
+
+        Args:
+            latency (float): seconds before answering each request
+            error_rate (float): ratio of the API calls answered with a 503
+            throttle_rate (float): ratio of the API calls answered with a 429
+            retry_after (float): Retry-After header of the 429 responses
+            seed (int): seed of the random errors
+        """
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.throttle_rate = float(throttle_rate)
+        self.retry_after = retry_after
+        self.random = random.Random(int(seed))
+        self.lock = threading.Lock()
+        self.counts = Counter()  # {kind of request or response: count}
+        self.responses = {}      # recorded responses: {path: (status, body)}
+        self.guild_sizes = {}    # {(server, guild): number of members}
+        self.failures = []       # statuses of the next API calls
+        self.tokens = 0          # number of issued tokens
+        self.first_valid_token = 0
+        self.server = None
+
+    def start_server(self, port=0):
+        """Start the server in a background thread
+
+        Args:
+            port (int): port of the server, any free port if 0
+
+        Returns:
+            (str) the base URL of the server, to use as 'api_host'
+        """
+        handler = type("MockHandler", (MockHandler,), {"mock": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", int(port)), handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def stop_server(self):
+        """Stop the server"""
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def reset_counters(self):
+        """Reset the request counters"""
+        with self.lock:
+            self.counts.clear()
+
+    def get_request_count(self, kind=None):
+        """Get the number of received requests
+
+        Args:
+            kind (str): kind of request (token, guild, character, item,
+                        achievement, classes) or of response (errors,
+                        throttled, unauthorized, not_modified), all the
+                        requests if None
+
+        Returns:
+            (int) the number of requests
+        """
+        with self.lock:
+            if kind is None:
+                return sum([v for k, v in self.counts.items()
+                            if k not in ("errors", "throttled", "unauthorized", "not_modified")])
+            return self.counts[kind]
+
+    def get_request_counts(self):
+        """Get the number of received requests per kind
+
+        Returns:
+            (dict) {kind: count}
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def set_latency(self, latency):
+        """Set the seconds before answering each request"""
+        self.latency = float(latency)
+
+    def fail_next_requests(self, count, status=429, retry_after=None):
+        """Answer the next API calls (not the token requests) with an error
+
+        Args:
+            count (int): number of failed calls
+            status (int): HTTP status of the failures, ex: 429 or 503
+            retry_after (float): Retry-After header of the 429 responses,
+                                 unchanged if None
+        """
+        with self.lock:
+            self.failures.extend([int(status)] * int(count))
+            if retry_after is not None:
+                self.retry_after = retry_after
+
+    def revoke_tokens(self):
+        """Reject the tokens issued so far with a 401"""
+        with self.lock:
+            self.first_valid_token = self.tokens
+
+    def set_guild_size(self, server, guild, size):
+        """Set the number of members of a synthetic guild"""
+        self.guild_sizes[(server.lower(), guild.lower())] = int(size)
+
+    def set_response(self, path, body, status=200):
+        """Serve a recorded response instead of a synthetic one
+
+        Args:
+            path (str): path of the URL, without the query, ex: "/wow/character/voljin/oxyde"
+            body (dict): the JSON body
+            status (int): the HTTP status
+        """
+        self.responses[path] = (int(status), body)
+
+    def load_responses(self, json_path):
+        """Serve the recorded responses of a JSON file: {path: body}"""
+        with open(json_path) as f:
+            for path, body in json.load(f).items():
+                self.set_response(path, body)
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def draw_fault(self):
+        """Draw a random error or throttling, unless a failure is requested
+
+        Returns:
+            (int) the status of the fault, None if no fault
+        """
+        with self.lock:
+            if self.failures:
+                return self.failures.pop(0)
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def respond(self, method, url):
+        """Build the response of a request
+
+        Returns:
+            (int, dict) the HTTP status and the JSON body
+        """
+        u = urlparse(url)
+        path = u.path
+        query = parse_qs(u.query)
+        if path.endswith("/oauth/token"):
+            self.count("token")
+            with self.lock:
+                self.tokens += 1
+                token = "mock-token-%d" % self.tokens
+            return 200, {"access_token": token, "token_type": "bearer", "expires_in": 86400}
+        if self.is_revoked(query.get("access_token", [""])[0]):
+            self.count("unauthorized")
+            return 401, {"code": 401, "type": "mock", "detail": "Invalid access token"}
+
+        m = re.match(r"^/wow/(character|guild|item|achievement|data)/", path)
+        kind = m.group(1) if m else "unknown"
+        self.count("classes" if kind == "data" else kind)
+        fault = self.draw_fault()
+        if fault:
+            self.count("throttled" if fault == 429 else "errors")
+            return fault, {"code": fault, "type": "mock", "detail": "Simulated failure"}
+        if path in self.responses:
+            return self.responses[path]
+
+        parts = path.split("/")
+        if kind == "character":
+            return self.character(parts[3], parts[4], query.get("fields", [""])[0].split(","))
+        if kind == "guild":
+            return self.guild(parts[3], parts[4])
+        if kind == "item":
+            return self.item(int(parts[3]))
+        if kind == "achievement":
+            return self.achievement(int(parts[3]))
+        if path == "/wow/data/character/classes":
+            return 200, {"classes": [{"id": i + 1, "name": c} for i, c in enumerate(CLASSES)]}
+        return 404, {"code": 404, "type": "mock", "detail": "Not Found"}
+
+    def is_revoked(self, token):
+        m = re.match(r"^mock-token-(\d+)$", token)
+        return bool(m) and int(m.group(1)) <= self.first_valid_token
+
+    def guild(self, server, name):
+        m = re.search(r"-(\d+)$", name)
+        size = self.guild_sizes.get((server.lower(), name.lower()),
+                                    int(m.group(1)) if m else DEFAULT_GUILD_SIZE)
+        members = [{"character": {"name": "%s%d" % (name.split("-")[0].capitalize(), i),
+                                  "realm": server,
+                                  "level": self.char_level(server, i),
+                                  "lastModified": 1500000000000 + crc(server, name, i) % 10 ** 9}}
+                   for i in range(size)]
+        return 200, {"name": name, "realm": server, "members": members}
+
+    def char_level(self, server, index):
+        # one member out of ten is a low level alt
+        return 120 if index % 10 else 100
+
+    def character(self, server, name, fields):
+        h = crc(server, name)
+        char = {"name": name, "realm": server, "class": h % len(CLASSES) + 1,
+                "level": 120, "lastModified": 1500000000000 + h % 10 ** 9}
+        if "items" in fields:
+            items = {"averageItemLevelEquipped": 340 + h % 50}
+            for i, slot in enumerate(SLOTS):
+                item_h = crc(server, name, slot)
+                items[slot] = {"id": 160000 + item_h % 200, "context": "raid-normal",
+                               "bonusLists": [4800 + item_h % 3],
+                               "tooltipParams": {"gem0": 1} if item_h % 4 else {}}
+                if slot.startswith("finger") and item_h % 3:
+                    items[slot]["tooltipParams"]["enchant"] = 5942
+            items["neck"]["azeriteItem"] = {"azeriteLevel": 10 + h % 40}
+            char["items"] = items
+        if "achievements" in fields:
+            char["achievements"] = {"achievementsCompleted": [11609] if h % 2 else [],
+                                    "criteria": [1, 2] if h % 2 else [],
+                                    "criteriaQuantity": [1, 1] if h % 2 else []}
+        if "professions" in fields:
+            char["professions"] = {"primary": [{"name": "Kul Tiran Alchemy", "rank": h % 176},
+                                               {"name": "Kul Tiran Herbalism", "rank": 175}]}
+        return 200, char
+
+    def item(self, item_id):
+        return 200, {"id": item_id, "name": "Item %d" % item_id,
+                     "socketInfo": {"sockets": [{"type": "PRISMATIC"}]} if item_id % 5 == 0 else {}}
+
+    def achievement(self, ach_id):
+        return 200, {"id": ach_id, "title": "Achievement %d" % ach_id,
+                     "criteria": [{"id": 1, "description": "Step 1", "max": 1},
+                                  {"id": 2, "description": "Step 2", "max": 1}]}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """HTTP handler of MockBlizzardServer, keeping the connections alive"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = -1  # headers and body sent at once, flushed after each request
+    mock = None
+
+    def do_GET(self):
+        self.answer("GET")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.answer("POST")
+
+    def answer(self, method):
+        if self.mock.latency:
+            time.sleep(self.mock.latency)
+        status, body = self.mock.respond(method, self.path)
+        data = json.dumps(body).encode()
+        etag = '"%08x"' % zlib.crc32(data)
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.mock.count("not_modified")
+            status, data = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json;charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        if status in (200, 304) and "/wow/character/" in self.path:
+            self.send_header("ETag", etag)
+        if status == 429:
+            self.send_header("Retry-After", str(self.mock.retry_after))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
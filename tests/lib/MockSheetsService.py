@@ -0,0 +1,303 @@
+import json
+import re
+import sys, os
+from collections import Counter
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+from wowchars import column_index
+
+DEFAULT_ROWS = 1000     # size of the sheets added by Google Sheets
+DEFAULT_COLUMNS = 26
+
+
+class MockSheetsError(Exception):
+    """Error returned by the fake API, like the HTTP 400 errors of Google's"""
+    pass
+
+
+class MockSheetsService(object):
+    """In-process stand-in for the Google Sheets v4 service used by
+    SheetConnector: spreadsheets().get(), spreadsheets().batchUpdate()
+    (addSheet, deleteSheet, appendDimension, repeatCell) and
+    spreadsheets().values().get()/batchGet()/batchUpdate(). The cells are
+    kept in memory, as formatted strings, and the API calls, the cells read
+    and written and the bytes sent are counted. Ex:
+
+        service = MockSheetsService()
+        sc = wowchars.SheetConnector("mock-id", False, service)
+
+    Like Google's, the sheets have a grid size: reading or writing outside
+    of it fails, the sheets must be extended with appendDimension first.
+    """
+
+    def __init__(self):
+        self.sheets = {}   # {title: MockSheet}, in the order of the document
+        self.next_id = 0
+        self.counts = Counter()  # {API call or counter: count}
+
+    def spreadsheets(self):
+        return MockSpreadsheets(self)
+
+    def add_sheet(self, title, values=None, rows=DEFAULT_ROWS, columns=DEFAULT_COLUMNS):
+        """Add a sheet to the document, without counting an API call
+
+        Args:
+            title (str): name of the sheet
+            values (array): initial values of the sheet, from A1
+            rows (int): number of rows of the grid, extended to the values
+            columns (int): number of columns of the grid, extended to the values
+
+        Returns:
+            (int) the ID of the sheet
+        """
+        if title in self.sheets:
+            raise MockSheetsError("A sheet with the name \"%s\" already exists" % title)
+        values = values or []
+        sheet = MockSheet(self.next_id, title, max(rows, len(values)),
+                          max([columns] + [len(row) for row in values]))
+        self.next_id += 1
+        self.sheets[title] = sheet
+        sheet.write(0, 0, values)
+        return sheet.sheet_id
+
+    def get_sheet_values(self, title):
+        """Get all the values of a sheet, without counting an API call"""
+        sheet = self.sheets[title]
+        return sheet.read(0, 0, sheet.rows - 1, sheet.columns - 1)
+
+    def get_call_count(self, call=None):
+        """Get the number of API calls
+
+        Args:
+            call (str): API call, ex: "values.batchUpdate", all if None
+
+        Returns:
+            (int) the number of calls
+        """
+        if call is None:
+            return sum([v for k, v in self.counts.items() if k in CALLS])
+        return self.counts[call]
+
+    def get_counts(self):
+        """Get the counters: API calls, "cells_read", "cells_written",
+        "requests" (in the batchUpdate calls) and "bytes_sent"
+
+        Returns:
+            (dict) {counter: count}
+        """
+        return dict(self.counts)
+
+    def reset_counters(self):
+        """Reset the counters"""
+        self.counts.clear()
+
+    def call(self, name, body=None):
+        """Count an API call"""
+        self.counts[name] += 1
+        if body is not None:
+            self.counts["bytes_sent"] += len(json.dumps(body))
+
+    def sheet_by_id(self, sheet_id):
+        for sheet in self.sheets.values():
+            if sheet.sheet_id == sheet_id:
+                return sheet
+        raise MockSheetsError("No grid with id: %s" % sheet_id)
+
+    def parse_range(self, range_name):
+        """Parse a A1 range, ex: "sheet!A2:B3", "sheet!1:1", "sheet!C:C", "sheet"
+
+        Returns:
+            (MockSheet, int, int, int, int) the sheet, the first row and column
+            and the last row and column (from 0), clipped to the grid
+        """
+        title, _, cells = range_name.partition("!")
+        title = title.strip("'")
+        if title not in self.sheets:
+            raise MockSheetsError("Unable to parse range: %s" % range_name)
+        sheet = self.sheets[title]
+        if not cells:
+            return sheet, 0, 0, sheet.rows - 1, sheet.columns - 1
+        bounds = []
+        for i, cell in enumerate(cells.upper().split(":")):
+            m = re.match(r"^([A-Z]*)(\d*)$", cell)
+            if not m or not cell:
+                raise MockSheetsError("Unable to parse range: %s" % range_name)
+            col = column_index(m.group(1)) if m.group(1) else (0 if i == 0 else sheet.columns - 1)
+            row = int(m.group(2)) - 1 if m.group(2) else (0 if i == 0 else sheet.rows - 1)
+            bounds.append((row, col))
+        if len(bounds) == 1:
+            bounds.append(bounds[0])
+        (r1, c1), (r2, c2) = bounds
+        if max(r1, r2) >= sheet.rows or max(c1, c2) >= sheet.columns:
+            raise MockSheetsError("Range (%s) exceeds grid limits. Max rows: %d, max columns: %d"
+                                  % (range_name, sheet.rows, sheet.columns))
+        return sheet, r1, c1, r2, c2
+
+    def read_range(self, range_name):
+        sheet, r1, c1, r2, c2 = self.parse_range(range_name)
+        values = sheet.read(r1, c1, r2, c2)
+        self.counts["cells_read"] += sum([len(row) for row in values])
+        return values
+
+    def write_range(self, range_name, values):
+        sheet, r1, c1, r2, c2 = self.parse_range(range_name)
+        if len(values) > r2 - r1 + 1 or max([len(row) for row in values] + [0]) > c2 - c1 + 1:
+            raise MockSheetsError("Requested writing within range [%s], but tried writing more data"
+                                  % range_name)
+        self.counts["cells_written"] += sum([len([v for v in row if v is not None]) for row in values])
+        sheet.write(r1, c1, values)
+
+
+CALLS = ("get", "batchUpdate", "values.get", "values.batchGet", "values.batchUpdate")
+
+
+class MockSheet(object):
+    """Sheet of MockSheetsService: rows of formatted values"""
+
+    def __init__(self, sheet_id, title, rows, columns):
+        self.sheet_id = sheet_id
+        self.title = title
+        self.rows = rows
+        self.columns = columns
+        self.values = []   # rows of values, without the trailing empty cells
+        self.colors = {}   # {(row, column): backgroundColor}
+
+    def properties(self):
+        return {"sheetId": self.sheet_id, "title": self.title,
+                "gridProperties": {"rowCount": self.rows, "columnCount": self.columns}}
+
+    def read(self, r1, c1, r2, c2):
+        """Read a range like Google's: trailing empty cells and rows are removed"""
+        values = []
+        for row in self.values[r1:r2 + 1]:
+            cells = row[c1:c2 + 1]
+            while cells and cells[-1] == "":
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def write(self, r1, c1, values):
+        """Write values, skipping the None ones like Google's"""
+        for i, row in enumerate(values):
+            while len(self.values) <= r1 + i:
+                self.values.append([])
+            cells = self.values[r1 + i]
+            for j, v in enumerate(row):
+                if v is None:
+                    continue
+                if len(cells) <= c1 + j:
+                    cells.extend([""] * (c1 + j + 1 - len(cells)))
+                cells[c1 + j] = format_value(v)
+
+
+def format_value(value):
+    """Format a value entered by the user, as read back with the default
+    FORMATTED_VALUE rendering"""
+    if value is True or value is False:
+        return str(value).upper()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class MockRequest(object):
+    """Request returned by the fake API, executed by execute()"""
+
+    def __init__(self, function):
+        self.function = function
+
+    def execute(self):
+        return self.function()
+
+
+class MockSpreadsheets(object):
+    def __init__(self, service):
+        self.service = service
+
+    def values(self):
+        return MockValues(self.service)
+
+    def get(self, spreadsheetId, ranges=None, includeGridData=False, fields=None):
+        svc = self.service
+        svc.call("get")
+
+        def execute():
+            if not ranges:
+                return {"sheets": [{"properties": s.properties()} for s in svc.sheets.values()]}
+            # only the background colors of the cells are returned
+            result = []
+            for range_name in ([ranges] if isinstance(ranges, str) else ranges):
+                sheet, r1, c1, r2, c2 = svc.parse_range(range_name)
+                rows = [{"values": [{"effectiveFormat": {"backgroundColor": sheet.colors.get((r, c), {})}}
+                                    for c in range(c1, c2 + 1)]}
+                        for r in range(r1, r2 + 1)]
+                result.append({"properties": sheet.properties(),
+                               "data": [{"startRow": r1, "startColumn": c1, "rowData": rows}]})
+            return {"sheets": result}
+        return MockRequest(execute)
+
+    def batchUpdate(self, spreadsheetId, body):
+        svc = self.service
+        svc.call("batchUpdate", body)
+        svc.counts["requests"] += len(body["requests"])
+
+        def execute():
+            replies = []
+            for request in body["requests"]:
+                (kind, params), = request.items()
+                if kind == "addSheet":
+                    properties = params.get("properties", {})
+                    grid = properties.get("gridProperties", {})
+                    sheet_id = svc.add_sheet(properties["title"], rows=grid.get("rowCount", DEFAULT_ROWS),
+                                             columns=grid.get("columnCount", DEFAULT_COLUMNS))
+                    replies.append({"addSheet": {"properties": svc.sheet_by_id(sheet_id).properties()}})
+                    continue
+                if kind == "deleteSheet":
+                    del svc.sheets[svc.sheet_by_id(params["sheetId"]).title]
+                elif kind == "appendDimension":
+                    sheet = svc.sheet_by_id(params["sheetId"])
+                    if params["dimension"] == "ROWS":
+                        sheet.rows += params["length"]
+                    else:
+                        sheet.columns += params["length"]
+                elif kind == "repeatCell":
+                    r = params["range"]
+                    sheet = svc.sheet_by_id(r["sheetId"])
+                    color = params["cell"]["userEnteredFormat"]["backgroundColor"]
+                    for row in range(r["startRowIndex"], r["endRowIndex"]):
+                        for col in range(r["startColumnIndex"], r["endColumnIndex"]):
+                            sheet.colors[(row, col)] = color
+                else:
+                    raise MockSheetsError("Unsupported request: %s" % kind)
+                replies.append({})
+            return {"spreadsheetId": spreadsheetId, "replies": replies}
+        return MockRequest(execute)
+
+
+class MockValues(object):
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId, range):
+        self.service.call("values.get")
+        return MockRequest(lambda: {"range": range, "majorDimension": "ROWS",
+                                    "values": self.service.read_range(range)})
+
+    def batchGet(self, spreadsheetId, ranges):
+        self.service.call("values.batchGet")
+        return MockRequest(lambda: {"spreadsheetId": spreadsheetId,
+                                    "valueRanges": [{"range": r, "majorDimension": "ROWS",
+                                                     "values": self.service.read_range(r)}
+                                                    for r in ranges]})
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.service.call("values.batchUpdate", body)
+
+        def execute():
+            for d in body["data"]:
+                self.service.write_range(d["range"], d["values"])
+            return {"spreadsheetId": spreadsheetId, "totalUpdatedRanges": len(body["data"])}
+        return MockRequest(execute)
@@ -0,0 +1,69 @@
+import sys, os
+import csv
+import json
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../")))
+
+import wowchars
+
+class OutputsTestHelper(object):
+    def __init__(self):
+        self.registry = None
+
+    def stream_characters(self, chars, csv_path=None, jsonl_path=None):
+        """Register the characters (dictionaries with at least 'server' and
+        'name') in an extractor feeding the requested sinks, as done while
+        fetching them"""
+        extractor = wowchars.CharactersExtractor("mock-id", "mock-secret", "eu")
+        if csv_path:
+            extractor.add_sink(wowchars.CsvSink(csv_path))
+        if jsonl_path:
+            extractor.add_sink(wowchars.JsonLinesSink(jsonl_path))
+        try:
+            for fields in chars:
+                char = wowchars.CharInfo(fields[wowchars.H_SERVER], fields[wowchars.H_NAME])
+                char.update(fields)
+                extractor.register_char(char)
+        finally:
+            extractor.close_sinks()
+            extractor.close()
+
+    def register_characters(self, chars):
+        """Register the characters (dictionaries with at least 'server' and
+        'name') in a new CharacterRegistry"""
+        self.registry = wowchars.CharacterRegistry()
+        for fields in chars:
+            char = wowchars.CharInfo(fields[wowchars.H_SERVER], fields[wowchars.H_NAME])
+            char.update(fields)
+            self.registry.add(char)
+
+    def get_registered_characters(self):
+        return [dict(row) for row in self.registry]
+
+    def get_column_values(self, field):
+        return list(self.registry.table.column_values(field))
+
+    def get_sorted_names(self, field, reverse=False):
+        return [row.name() for row in self.registry.sorted_by(field, reverse)]
+
+    def record_snapshot(self, cache_dir, server, name, ilvl, days_ago, level=120):
+        """Record a snapshot of a character in the history, as done with
+        --history N days ago"""
+        store = wowchars.HistoryStore(os.path.join(cache_dir, "history.sqlite"), "eu",
+                                      time.time() - float(days_ago) * 24 * 3600)
+        char = wowchars.CharInfo(server, name)
+        char.update({wowchars.H_LVL: str(level), wowchars.H_ILVL: str(ilvl)})
+        store.write(char)
+        store.close()
+
+    def read_csv(self, path):
+        with open(path) as csvfile:
+            return list(csv.reader(csvfile, delimiter=';'))
+
+    def read_json_lines(self, path):
+        with open(path) as f:
+            return self.parse_json_lines(f.read())
+
+    def parse_json_lines(self, text):
+        return [json.loads(line) for line in text.splitlines()]
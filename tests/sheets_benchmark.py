@@ -0,0 +1,159 @@
+"""Benchmark of the Google Sheets synchronization of wowchars against the
+local fake of the Sheets API (see lib/MockSheetsService.py): the results of
+a synthetic roster of each requested size are exported with
+CharactersExtractor.export_results(), and the API calls, the cells read and
+written and the wall time are reported.
+
+Two documents are synchronized for each size:
+- "first": an empty document
+- "update": a document already containing the roster in the summary sheet
+  and 'days' lines of history (one column per character) in the level and
+  ilvl sheets, a ratio of the characters having a new ilvl
+
+The results are appended to a JSON Lines file, and compared with the last
+result of the same configuration to catch regressions. Ex:
+    python tests/sheets_benchmark.py --sizes 100,500 --days 2000
+"""
+
+import sys, os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../")))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "lib")))
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import platform
+import time
+
+import wowchars
+from benchmark import get_commit, load_results, find_previous
+from MockSheetsService import MockSheetsService
+from MockBlizzardServer import CLASSES
+
+DEFAULT_SIZES = "10,100,500"
+DEFAULT_RESULTS = os.path.join(os.path.dirname(__file__), "sheets_benchmark_results.jsonl")
+CONFIG_KEYS = ("scenario", "size", "days", "changed")
+SCENARIOS = ("first", "update")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Google Sheets synchronization against a local fake of the API")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Sizes of the synthetic rosters (default: %s)" % DEFAULT_SIZES)
+    parser.add_argument("--days", type=int, default=1000, help="Lines of history in the level and ilvl sheets (default: 1000)")
+    parser.add_argument("--changed", type=float, default=0.1, help="Ratio of the characters with a new ilvl (default: 0.1)")
+    parser.add_argument("--results", default=DEFAULT_RESULTS, help="JSON Lines file tracking the results (default: %s)" % DEFAULT_RESULTS)
+    parser.add_argument("--no-save", action="store_true", help="do not save the results")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown reported as a regression (default: 0.2 = 20%%)")
+    args = parser.parse_args()
+    wowchars.logger.setLevel(logging.ERROR)
+
+    previous = load_results(args.results)
+    regressions = 0
+
+    print("%-7s %6s %10s %6s %8s %12s %12s %12s  %s" % ("", "size", "wall (s)", "calls", "requests",
+                                                        "cells read", "cells wrote", "bytes sent", "vs previous"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        for scenario in SCENARIOS:
+            result = run_once(args, scenario, size)
+            prev = find_previous(previous, result, CONFIG_KEYS)
+            comparison = ""
+            if prev:
+                ratio = result["wall"] / prev["wall"]
+                comparison = "%+.1f%% (%s)" % ((ratio - 1) * 100, prev["commit"])
+                if ratio > 1 + args.threshold:
+                    comparison += " REGRESSION"
+                    regressions += 1
+            counts = result["counts"]
+            print("%-7s %6d %10.3f %6d %8d %12d %12d %12d  %s" % (scenario, size, result["wall"], result["calls"],
+                                                               counts.get("requests", 0), counts.get("cells_read", 0),
+                                                               counts.get("cells_written", 0), counts.get("bytes_sent", 0),
+                                                               comparison))
+            if not args.no_save:
+                with open(args.results, "a") as f:
+                    f.write(json.dumps(result, sort_keys=True) + "\n")
+    return 1 if regressions else 0
+
+
+def run_once(args, scenario, size):
+    """Synchronize the results of a synthetic roster and measure it
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+        scenario (str): "first" or "update", see SCENARIOS
+        size (int): number of characters of the roster
+
+    Returns:
+        (dict) the result
+    """
+    ce = wowchars.CharactersExtractor("mock-id", "mock-secret", "eu")
+    ce.sheets_service = service = MockSheetsService()
+    for i in range(size):
+        ce.register_char(synthetic_char(i))
+    if scenario == "update":
+        fill_document(service, ce, args.days, args.changed)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        ce.export_results(False, None, False, False, "mock-id", False)
+    wall = time.perf_counter() - start
+    ce.close()
+
+    return {"scenario": scenario,
+            "size": size,
+            "days": args.days,
+            "changed": args.changed,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "wall": wall,
+            "calls": service.get_call_count(),
+            "counts": service.get_counts()}
+
+
+def synthetic_char(index):
+    """Build the index-th character of the synthetic roster"""
+    char = wowchars.CharInfo("mock", "Char%d" % index)
+    char[wowchars.H_CLASS] = CLASSES[index % len(CLASSES)]
+    char[wowchars.H_LVL] = 120 if index % 10 else 110
+    char[wowchars.H_ILVL] = 340 + index % 50
+    char[wowchars.H_AZERITE_LVL] = 10 + index % 40
+    char["BfA profession 1"] = "BfA Alchemy: %d" % (index % 176)
+    char["BfA profession 2"] = "BfA Herbalism: 175"
+    return char
+
+
+def fill_document(service, ce, days, changed):
+    """Fill the document with the previous results of the roster: the
+    summary, and 'days' lines of history in the level and ilvl sheets. A
+    ratio 'changed' of the characters have a lower ilvl than now.
+    """
+    chars = list(ce.characters)
+    changed_names = {c[wowchars.H_NAME] for c in chars[:int(len(chars) * changed)]}
+
+    def previous(char, field):
+        if field == wowchars.H_ILVL and char[wowchars.H_NAME] in changed_names:
+            return char[field] - 5
+        return char[field]
+
+    fieldnames = ce.get_ordered_fieldnames()
+    summary = [fieldnames] + [[previous(c, f) for f in fieldnames]
+                              for c in ce.characters.sorted_by(wowchars.H_ILVL, reverse=True)]
+    service.add_sheet(wowchars.SUMMARY_SHEET, summary)
+
+    names = [c[wowchars.H_NAME] for c in ce.characters.sorted_by(wowchars.H_NAME)]
+    first_day = datetime.date.today() - datetime.timedelta(days=days)
+    for s in (wowchars.H_LVL, wowchars.H_ILVL):
+        last = [previous(c, s) for c in ce.characters.sorted_by(wowchars.H_NAME)]
+        history = [[wowchars.H_DATE] + names]
+        for day in range(days):
+            date = (first_day + datetime.timedelta(days=day)).strftime("%Y-%m-%d")
+            history.append([date] + [v - (days - day) // 100 for v in last])
+        service.add_sheet(s, history)
+    service.reset_counters()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
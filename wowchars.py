@@ -19,31 +19,54 @@ import csv
 import argparse
 import re
 import logging
-import httplib2
 import os
+import sys
 import string
-from time import strftime
-
-import googleapiclient
-from apiclient import discovery
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+import unicodedata
+import json
+import sqlite3
+import gzip
+import tempfile
+import threading
+import time
+import random
+import functools
+import heapq
+import itertools
+import contextlib
+import cProfile
+import pstats
+import tracemalloc
+from array import array
+from collections.abc import Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import strftime, localtime
+from email.utils import parsedate_to_datetime
+
+# Google's API client (googleapiclient, oauth2client, httplib2) is only
+# imported when connecting to Google Sheets, see SheetConnector
 
 logger = logging.getLogger('wowchars')
 
 ####################
 # URLs
-TOKEN_URL       = "https://{zone}.battle.net/oauth/token"
-BASE_CHAR_URL   = "https://{zone}.api.blizzard.com/wow/character/{server}/{name}?fields={fields}&access_token={access_token}"
-BASE_ACHIEV_URL = "https://{zone}.api.blizzard.com/wow/achievement/{id}?access_token={access_token}"
-BASE_ITEM_URL   = "https://{zone}.api.blizzard.com/wow/item/{id}{slash_context}?bl={bonus_list}&access_token={access_token}"
-CLASSES_URL     = "https://{zone}.api.blizzard.com/wow/data/character/classes?locale=en_GB&access_token={access_token}"
-GUILD_URL       = "https://{zone}.api.blizzard.com/wow/guild/{server}/{name}?fields={fields}&access_token={access_token}"
+API_HOST        = "https://{zone}.api.blizzard.com"
+OAUTH_HOST      = "https://{zone}.battle.net"
+TOKEN_URL       = "{oauth_host}/oauth/token"
+BASE_CHAR_URL   = "{api_host}/wow/character/{server}/{name}?fields={fields}&access_token={access_token}"
+BASE_ACHIEV_URL = "{api_host}/wow/achievement/{id}?access_token={access_token}"
+BASE_ITEM_URL   = "{api_host}/wow/item/{id}{slash_context}?bl={bonus_list}&access_token={access_token}"
+CLASSES_URL     = "{api_host}/wow/data/character/classes?locale=en_GB&access_token={access_token}"
+GUILD_URL       = "{api_host}/wow/guild/{server}/{name}?fields={fields}&access_token={access_token}"
+ENDPOINTS       = {TOKEN_URL: "token", BASE_CHAR_URL: "character", BASE_ACHIEV_URL: "achievement",
+                   BASE_ITEM_URL: "item", CLASSES_URL: "classes", GUILD_URL: "guild"}  # names in the metrics
+
+ZONES = ["eu", "us", "kr", "tw"]
 
 ####################
 # Headers
 H_DATE        = "date"
+H_ZONE        = "zone"
 H_SERVER      = "server"
 H_NAME        = "name"
 H_CLASS       = "class"
@@ -51,6 +74,44 @@ H_LVL         = "level"
 H_ILVL        = "ilvl"
 H_AZERITE_LVL = "Azerite lvl"
 
+####################
+# Google Sheets
+SUMMARY_SHEET = "summary"
+
+####################
+# HTTP
+DEFAULT_POOL_SIZE = 10       # kept-alive connections to the API
+DEFAULT_TIMEOUT   = (5, 30)  # (connect, read) timeouts in seconds
+API_RATE_LIMITS   = ((100, 1), (36000, 3600))  # Blizzard's quotas: (requests, per seconds)
+MAX_RETRIES       = 4
+RETRY_BACKOFF     = 0.5      # seconds, doubled at each retry
+RETRY_MAX_DELAY   = 60       # seconds
+RETRY_STATUSES    = (429, 500, 502, 503, 504)
+
+####################
+# Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # upper bounds in seconds
+
+####################
+# Cache
+DEFAULT_CACHE_DIR      = os.path.join(os.path.expanduser("~"), ".cache", "wowchars")
+ITEM_CACHE_MAX_AGE     = 30  # days
+ITEM_CACHE_MAX_ENTRIES = 100000
+STATIC_CACHE_TTL       = 24  # hours
+TOKEN_REFRESH_MARGIN   = 300  # seconds before expiry when a token is renewed
+DEFAULT_TOKEN_LIFETIME = 3600  # seconds, when the OAuth API does not give the expiry
+ARCHIVE_FILE           = "archive.jsonl.gz"  # file of the recorded responses, see ApiArchive
+
+####################
+# Daemon
+DAEMON_FLUSH_INTERVAL  = 300   # seconds between two exports of the results
+DAEMON_ROSTER_INTERVAL = 3600  # seconds between two fetches of the guild roster
+DAEMON_REFRESH_INTERVALS = ((24 * 3600, 900),         # (modified within, refreshed every) in seconds
+                            (7 * 24 * 3600, 2 * 3600))
+DAEMON_IDLE_INTERVAL   = 12 * 3600  # seconds, idle characters and alts
+DAEMON_RETRY_INTERVAL  = 3600       # seconds, characters that cannot be fetched
+DAEMON_ALT_LEVEL       = 120        # characters below this level are refreshed as idle
+
 ####################
 # Achievements: {ID: stepped}
 ACHIEVEMENTS = { 
@@ -59,10 +120,17 @@ ACHIEVEMENTS = {
 
 
 def main():
-    parser = argparse.ArgumentParser(parents=[tools.argparser])
+    if sys.argv[1:2] == ["history"]:
+        return history_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(parents=[get_oauth_argparser()],
+                                     epilog="Use '%(prog)s history -h' to query the recorded history")
     parser.add_argument("--blizzard-client-id", help="Client ID of Blizzard's Battle.net API", required=True)
     parser.add_argument("--blizzard-client-secret", help="Token to Blizzard's Battle.net API", required=True)
     parser.add_argument("-o", "--output", help="Output CSV file", required=False)
+    parser.add_argument("--jsonl", help="Output JSON Lines file, '-' for the standard output", required=False)
+    parser.add_argument("--stream", action="store_true", help="print each character as soon as it is fetched")
+    parser.add_argument("--history", action="store_true", help="record the fetched characters in the local history (CACHE_DIR/history.sqlite)")
     parser.add_argument("-c", "--char", help="Check character (server:charname)", action="append", default=[], required=False)
     parser.add_argument("--guild", help="Check characters from given GUILD with minimum level of 111")
     parser.add_argument("-r", "--raid", action="store_true", help="Only keeps info that are usefull for raids (class, lvl, ilvl)")
@@ -72,24 +140,358 @@ def main():
     parser.add_argument("-d", "--dry-run", action="store_true", help="does not update target output")
     parser.add_argument("--check-gear", action="store_true", help="inspect gear for legendaries or any missing gem/enchantment")
     parser.add_argument("--default-server", help="Default server when not given with the '-c' option", default=None)
-    parser.add_argument("--zone", choices=["eu", "us", "kr", "tw"], help="Select server's zone.", default="eu")
+    parser.add_argument("--zone", choices=ZONES, help="Select server's zone.", default="eu")
+    parser.add_argument("--config", help="JSON file listing the guilds and characters to process per zone, the zones being processed concurrently (see run_batch())")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of characters fetched in parallel (default: 1)")
+    parser.add_argument("--pool-size", type=int, default=None, help="Maximum number of kept-alive connections to the API (default: max(%d, WORKERS))" % DEFAULT_POOL_SIZE)
+    parser.add_argument("--timeout", type=float, default=None, help="Timeout of the API calls, in seconds (default: %d to connect, %d to read)" % DEFAULT_TIMEOUT)
+    parser.add_argument("--single-request", action="store_true", help="fetch all the info of a character with a single API call")
+    parser.add_argument("--cache-dir", help="Directory of the persistent caches (default: %s)" % DEFAULT_CACHE_DIR, default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--no-item-cache", action="store_true", help="do not use the persistent cache of the item descriptions")
+    parser.add_argument("--item-cache-max-age", type=float, default=ITEM_CACHE_MAX_AGE, help="Days before a cached item description is fetched again (default: %d)" % ITEM_CACHE_MAX_AGE)
+    parser.add_argument("--item-cache-size", type=int, default=ITEM_CACHE_MAX_ENTRIES, help="Maximum number of cached item descriptions (default: %d)" % ITEM_CACHE_MAX_ENTRIES)
+    parser.add_argument("--static-ttl", type=float, default=STATIC_CACHE_TTL, help="Hours before the cached classes and achievements are fetched again (default: %d)" % STATIC_CACHE_TTL)
+    parser.add_argument("--refresh-static", action="store_true", help="fetch the classes and achievements even if they are cached")
+    parser.add_argument("--incremental", action="store_true", help="only fetch again the characters modified since the previous incremental run")
+    parser.add_argument("--rate-limit", type=float, default=API_RATE_LIMITS[0][0], help="Maximum number of API calls per second (default: %d)" % API_RATE_LIMITS[0][0])
+    parser.add_argument("--hourly-limit", type=float, default=API_RATE_LIMITS[1][0], help="Maximum number of API calls per hour (default: %d)" % API_RATE_LIMITS[1][0])
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="Retries of the API calls failing with a transient error (default: %d)" % MAX_RETRIES)
+    parser.add_argument("--asyncio", action="store_true", help="fetch all characters at once on an asyncio event loop (requires aiohttp)")
+    parser.add_argument("--api-host", help="Base URL of the API and OAuth servers, ex: a local mock server (default: Blizzard's servers of the zone)")
+    parser.add_argument("--daemon", action="store_true", help="keep running and refresh each character according to its activity, until interrupted")
+    parser.add_argument("--flush-interval", type=float, default=DAEMON_FLUSH_INTERVAL, help="Seconds between two exports of the results in daemon mode (default: %d)" % DAEMON_FLUSH_INTERVAL)
+    parser.add_argument("--roster-interval", type=float, default=DAEMON_ROSTER_INTERVAL, help="Seconds between two fetches of the guild roster in daemon mode (default: %d)" % DAEMON_ROSTER_INTERVAL)
+    parser.add_argument("--stats", action="store_true", help="display the metrics of the API calls and of the caches at the end of the run")
+    parser.add_argument("--metrics-json", help="Save the metrics of the API calls and of the caches in this JSON file")
+    parser.add_argument("--metrics-prom", help="Save the metrics of the API calls and of the caches in this file, in Prometheus' text format")
+    parser.add_argument("--profile", action="store_true", help="display the wall time, CPU time and peak memory of each phase of the run (slows the run down)")
+    parser.add_argument("--profile-dir", help="Save a cProfile dump of each phase of the run in this directory (implies --profile)")
+    parser.add_argument("--record", metavar="DIR", help="Save the responses of the API calls in an archive in this directory, for --replay")
+    parser.add_argument("--replay", metavar="DIR", help="Run again from the archive of --record in this directory, without any API call (implies --dry-run)")
     parser.add_argument('--version', action='version', version=__version__)
     args = parser.parse_args()
+    if args.daemon and args.asyncio:
+        parser.error("--daemon cannot be used with --asyncio")
+    if args.config and (args.daemon or args.asyncio):
+        parser.error("--config cannot be used with --daemon or --asyncio")
+    if args.record and args.replay:
+        parser.error("--record cannot be used with --replay")
+    if (args.record or args.replay) and (args.asyncio or args.incremental):
+        parser.error("--record and --replay cannot be used with --asyncio or --incremental")
+    if args.replay and args.daemon:
+        parser.error("--replay cannot be used with --daemon")
+
+    if args.jsonl == "-":
+        # the standard output only gets the JSON lines, so they can be piped:
+        # the progress and the other outputs are printed on the standard error
+        args.jsonl = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            run_main(args)
+    else:
+        run_main(args)
+
+
+def run_main(args):
+    """Run wowchars with the parsed command line arguments
 
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+    """
     set_logger(args.verbosity)
+    if args.profile or args.profile_dir:
+        profiler.enable(args.profile_dir)
+
+    # the persistent caches are bypassed so that all the responses are recorded
+    archive = None
+    if args.record:
+        archive = ApiArchive(args.record)
+    elif args.replay:
+        archive = ApiArchive(args.replay, replay=True)
+        args.dry_run = True
+
+    item_cache = None
+    if args.check_gear and not args.no_item_cache and not archive:
+        item_cache = ItemCache(os.path.join(args.cache_dir, "items.sqlite"),
+                               args.item_cache_max_age * 24 * 3600,
+                               args.item_cache_size)
+
+    static_cache = None
+    if not archive:
+        static_cache = StaticDataCache(os.path.join(args.cache_dir, "static-%s.json" % args.zone),
+                                       args.static_ttl * 3600, args.refresh_static)
+
+    if args.replay:
+        token_store = TokenStore()
+        rate_limiter = RateLimiter(())
+    else:
+        token_store = TokenStore(os.path.join(args.cache_dir, "tokens.json"))
+        rate_limiter = RateLimiter(((args.rate_limit, 1), (args.hourly_limit, 3600)))
+    char_states = None
+    if args.incremental:
+        char_states = CharacterStateStore(os.path.join(args.cache_dir, "characters.sqlite"))
+
+    if args.config:
+        run_batch(args, item_cache, token_store, char_states, rate_limiter, archive)
+    elif args.asyncio:
+        import asyncio
+        asyncio.run(run_async(args, item_cache, static_cache, token_store, char_states,
+                              rate_limiter))
+    else:
+        ce = CharactersExtractor(args.blizzard_client_id,
+                                 args.blizzard_client_secret,
+                                 args.zone,
+                                 args.pool_size or max(DEFAULT_POOL_SIZE, args.workers),
+                                 args.timeout or DEFAULT_TIMEOUT,
+                                 args.single_request,
+                                 item_cache,
+                                 static_cache,
+                                 token_store,
+                                 char_states,
+                                 rate_limiter,
+                                 args.max_retries,
+                                 args.api_host,
+                                 archive)
+        for sink in create_sinks(args):
+            ce.add_sink(sink)
+        if args.daemon:
+            ce.run_daemon(args.guild,
+                          args.char,
+                          args.raid,
+                          args.output,
+                          args.summary,
+                          args.check_gear,
+                          args.google_sheet,
+                          args.dry_run,
+                          args.default_server,
+                          args.workers,
+                          args.flush_interval,
+                          args.roster_interval)
+        else:
+            ce.run(args.guild,
+                   args.char,
+                   args.raid,
+                   args.output,
+                   args.summary,
+                   args.check_gear,
+                   args.google_sheet,
+                   args.dry_run,
+                   args.default_server,
+                   args.workers)
+        ce.close()
+
+    if item_cache:
+        if not args.stats:  # already in the metrics
+            print("Item cache: %d hit(s), %d miss(es)" % (item_cache.hits, item_cache.misses))
+        item_cache.close()
+    if char_states:
+        char_states.close()
+    if archive:
+        archive.close()
+
+    if args.stats:
+        metrics.display()
+    if args.metrics_json:
+        with open(args.metrics_json, "w") as f:
+            json.dump(metrics.to_dict(), f, indent=2)
+    if args.metrics_prom:
+        with open(args.metrics_prom, "w") as f:
+            f.write(metrics.to_prometheus())
+    if profiler.enabled:
+        profiler.display()
+        for path in profiler.dump_stats():
+            print("Profile saved in %s" % path)
+
+
+def get_oauth_argparser():
+    """Build the parser of the flags of Google's OAuth flow, the same as
+    oauth2client.tools.argparser, without importing oauth2client
+
+    Returns:
+        an argparse.ArgumentParser, to use as a parent parser
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--auth_host_name", default="localhost", help="Hostname when running a local web server.")
+    parser.add_argument("--noauth_local_webserver", action="store_true", default=False, help="Do not run a local web server.")
+    parser.add_argument("--auth_host_port", default=[8080, 8090], type=int, nargs="*", help="Port web server should listen on.")
+    parser.add_argument("--logging_level", default="ERROR", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], help="Set the logging level of detail.")
+    return parser
+
+
+def run_batch(args, item_cache=None, token_store=None, char_states=None,
+              rate_limiter=None, archive=None):
+    """main function of the batch mode: process the guilds and characters of
+    several zones, listed in the JSON file given with --config. Ex:
+        {
+          "eu": {"guilds": ["voljin:Guild"], "chars": ["hyjal:Char"], "default_server": "voljin"},
+          "us": {"guilds": ["area-52:Guild"]}
+        }
+    The zones are processed concurrently, each one with its own extractor
+    (token, static data and connection pool). The characters are exported
+    together, with a 'zone' column.
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+        item_cache (ItemCache): persistent cache of the item descriptions
+        token_store (TokenStore): store of the access tokens
+        char_states (CharacterStateStore): characters of the previous runs
+        rate_limiter (RateLimiter): limiter of the API calls, shared by the zones
+        archive (ApiArchive): archive of the API responses, shared by the zones
+    """
+    with open(args.config) as f:
+        config = json.load(f)
+    unknown = [zone for zone in config if zone not in ZONES]
+    if unknown:
+        raise ValueError("unknown zone(s) in %s: %s" % (args.config, ", ".join(unknown)))
+
+    # extractor gathering the results of all the zones
+    combined = CharactersExtractor(args.blizzard_client_id, args.blizzard_client_secret, None,
+                                   pool_size=1, token_store=token_store, rate_limiter=rate_limiter,
+                                   archive=archive)
+    combined.characters = CharacterRegistry(FieldSchema((H_ZONE, H_SERVER, H_NAME, H_CLASS, H_ILVL, H_LVL)))
+    combined.schema = combined.characters.schema
+    for sink in create_sinks(args):
+        combined.add_sink(sink)
+    if args.output:
+        combined.add_sink(CsvSink(args.output))
+
+    extractors = {}
+    for zone in config:
+        static_cache = None
+        if not archive:
+            static_cache = StaticDataCache(os.path.join(args.cache_dir, "static-%s.json" % zone),
+                                           args.static_ttl * 3600, args.refresh_static)
+        extractors[zone] = CharactersExtractor(args.blizzard_client_id,
+                                               args.blizzard_client_secret,
+                                               zone,
+                                               args.pool_size or max(DEFAULT_POOL_SIZE, args.workers),
+                                               args.timeout or DEFAULT_TIMEOUT,
+                                               args.single_request,
+                                               item_cache,
+                                               static_cache,
+                                               token_store,
+                                               char_states,
+                                               rate_limiter,
+                                               args.max_retries,
+                                               args.api_host,
+                                               archive)
+        extractors[zone].share_results(combined)
+
+    try:
+        with profiler.phase("zones"), ThreadPoolExecutor(max_workers=len(extractors) or 1) as executor:
+            futures = [executor.submit(profiler.call, extractors[zone].collect,
+                                       config[zone].get("guilds", []),
+                                       config[zone].get("chars", []),
+                                       args.raid,
+                                       args.check_gear,
+                                       config[zone].get("default_server", args.default_server),
+                                       args.workers)
+                       for zone in extractors]
+            for f in futures:
+                f.result()
+    finally:
+        with profiler.phase("outputs"):
+            combined.close_sinks()
+        for ze in extractors.values():
+            ze.close()
+
+    # the CSV file is already written by its sink
+    combined.export_results(args.raid, None, args.summary, args.check_gear,
+                            args.google_sheet, args.dry_run)
+    combined.close()
+
+
+async def run_async(args, item_cache=None, static_cache=None, token_store=None,
+                    char_states=None, rate_limiter=None):
+    """main function of the asyncio engine
+
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+        item_cache (ItemCache): persistent cache of the item descriptions
+        static_cache (StaticDataCache): cache of the classes and achievements
+        token_store (TokenStore): store of the access tokens
+        char_states (CharacterStateStore): characters of the previous runs
+        rate_limiter (RateLimiter): limiter of the API calls
+    """
+    async with AsyncCharactersExtractor(args.blizzard_client_id,
+                                        args.blizzard_client_secret,
+                                        args.zone,
+                                        timeout=args.timeout or DEFAULT_TIMEOUT,
+                                        single_request=args.single_request,
+                                        item_cache=item_cache,
+                                        static_cache=static_cache,
+                                        token_store=token_store,
+                                        char_states=char_states,
+                                        rate_limiter=rate_limiter,
+                                        max_retries=args.max_retries,
+                                        api_host=args.api_host) as ace:
+        for sink in create_sinks(args):
+            ace.add_sink(sink)
+        await ace.run(args.guild,
+                      args.char,
+                      args.raid,
+                      args.output,
+                      args.summary,
+                      args.check_gear,
+                      args.google_sheet,
+                      args.dry_run,
+                      args.default_server)
+
+
+def history_main(argv):
+    """main function of the 'history' command: query the characters recorded
+    with the --history option
+
+    Args:
+        argv (str array): the command line arguments after 'history'
+    """
+    parser = argparse.ArgumentParser(prog="wowchars.py history",
+                                     description="Query the local history of the characters")
+    parser.add_argument("--cache-dir", help="Directory of the persistent caches (default: %s)" % DEFAULT_CACHE_DIR, default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--zone", choices=ZONES, help="Select server's zone.", default="eu")
+    parser.add_argument("--field", choices=sorted(HistoryStore.FIELDS), default=H_ILVL, help="Tracked value (default: %s)" % H_ILVL)
+    parser.add_argument("--days", type=float, default=7, help="Period of the query, in days (default: 7)")
+    subparsers = parser.add_subparsers(dest="query", metavar="QUERY")
+    subparsers.required = True
+    trend = subparsers.add_parser("trend", help="values of a character over the period")
+    trend.add_argument("char", help="the character (server:charname)")
+    subparsers.add_parser("delta", help="progression of all the characters over the period")
+    gained = subparsers.add_parser("gained", help="characters that gained at least N over the period")
+    gained.add_argument("n", type=float, help="minimum progression")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(os.path.join(args.cache_dir, "history.sqlite"), args.zone)
+    since = time.time() - args.days * 24 * 3600
+    if args.query == "trend":
+        server, name = split_server_and_name(args.char)
+        for fetched, level, ilvl in store.trend(server, name, since):
+            print("%s, %s, %s" % (strftime("%Y-%m-%d %H:%M", localtime(fetched)), level, ilvl))
+    else:
+        deltas = store.deltas(args.field, since)
+        if args.query == "gained":
+            deltas = [d for d in deltas if d[4] >= args.n]
+        for server, name, old_v, new_v, delta in deltas:
+            print("%s:%s, %s -> %s, %+d" % (server, name, old_v, new_v, delta))
+    store.close()
+
+
+def create_sinks(args):
+    """Create the streaming outputs requested on the command line, the CSV
+    output being handled by CharactersExtractor.run()
 
-    ce = CharactersExtractor(args.blizzard_client_id,
-                             args.blizzard_client_secret,
-                             args.zone)
-    ce.run(args.guild,
-           args.char,
-           args.raid,
-           args.output,
-           args.summary,
-           args.check_gear,
-           args.google_sheet,
-           args.dry_run,
-           args.default_server)
+    Args:
+        args (argparse.Namespace): the parsed command line arguments
+
+    Returns:
+        the sinks
+    """
+    sinks = []
+    if args.history:
+        sinks.append(HistoryStore(os.path.join(args.cache_dir, "history.sqlite"), args.zone))
+    if args.jsonl:
+        sinks.append(JsonLinesSink(args.jsonl))
+    if args.stream:
+        sinks.append(StdoutSink())
+    return sinks
 
 
 class CharInfo(dict):
@@ -107,6 +509,10 @@ class CharInfo(dict):
         super().__init__()
         self[H_SERVER] = server
         self[H_NAME] = name
+        self.to_fix = []  # gear to fix, registered with the character
+        self.last_modified = None     # 'lastModified' of the profile
+        self.validators = None        # (ETag, Last-Modified) HTTP headers
+        self.previous = None          # CharInfo of the previous incremental run
 
     def server(self):
         """Get character's server
@@ -187,33 +593,200 @@ class CharactersExtractor:
     - extract and process data from Blizzard API
     - save in CSV and/or export to a Google Sheets document"""
 
-    def __init__(self, client_id, client_secret, zone):
+    def __init__(self, client_id, client_secret, zone,
+                 pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 single_request=False, item_cache=None, static_cache=None,
+                 token_store=None, char_states=None, rate_limiter=None,
+                 max_retries=MAX_RETRIES, api_host=None, archive=None):
         """Contructor
 
         Args:
             client_id (str): Blizzard client ID
             client_secret (str): Blizzard client secret
             zone (str): Zone of the target guild and/or characters
+            pool_size (int): maximum number of kept-alive connections to the API
+            timeout (float or tuple): default timeout of the API calls, in
+                                      seconds, see requests' documentation
+            single_request (bool): fetch all the info of a character with a
+                                   single API call
+            item_cache (ItemCache): persistent cache of the item descriptions
+            static_cache (StaticDataCache): cache of the classes and achievements
+            token_store (TokenStore): store of the access tokens, the tokens
+                                      are only kept in memory if not given
+            char_states (CharacterStateStore): characters of the previous
+                                               runs, enables the incremental
+                                               mode
+            rate_limiter (RateLimiter): limiter of the API calls, may be
+                                        shared by several extractors. Limited
+                                        to Blizzard's quotas if not given
+            max_retries (int): retries of the API calls failing with a
+                               transient error (429, 5xx, network errors)
+            api_host (str): base URL of the API and OAuth servers, ex:
+                            "http://localhost:8080". Blizzard's servers of
+                            the zone if None
+            archive (ApiArchive): archive recording the responses of the
+                                  API, or replaying them instead of
+                                  calling the API
         """
-
-        # getting auth token
-        url = TOKEN_URL.format(zone=zone)
-        logger.debug(url)
-        r = requests.post(url, data={"grant_type": "client_credentials"},
-                          auth=(client_id, client_secret))
-        r.raise_for_status()
-
-        self.access_token = r.json()["access_token"]
-        logger.debug("Got access token: %s", self.access_token)
         self.zone = zone
+        self.api_host = api_host if api_host else API_HOST.format(zone=zone)
+        self.oauth_host = api_host if api_host else OAUTH_HOST.format(zone=zone)
+        self.timeout = timeout
+        self.single_request = single_request
+        self.item_cache = item_cache
+        self.static_cache = static_cache
+        self.char_states = char_states
+        self.roster_last_modified = {}  # {(server, name): 'lastModified' in the guild roster}
+        self.rate_limiter = rate_limiter if rate_limiter else RateLimiter()
+        self.max_retries = max_retries
+        self.failed = []        # characters that cannot be fetched
+        self.session = self.create_session(pool_size)
+        self.archive = archive
+        if archive:
+            archive.attach(self.session)
         self.achievements = []  # achievement details
-        self.characters = []    # fetched characters
+        self.achievements_by_id = {}  # {id: achievement details}
+        self.characters = CharacterRegistry()  # fetched characters
+        self.schema = self.characters.schema  # fieldnames of the fetched characters
+        self.sinks = []         # outputs fed with each registered character
+        self.register_lock = threading.Lock()
+        self.tag_zone = False   # add the zone to the characters, see share_results()
+        self.item_requests = self.create_single_flight("item (run)", memoize=True)
+        self.char_requests = self.create_single_flight("character (in flight)")
+        self.sheets_service = None  # Sheets API used instead of Google's, see SheetConnector
         self.to_fix = {}        # {char, [to fix]}
         self.classnames = {}    # {id, classname}
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_store = token_store if token_store else TokenStore()
+        self.token_lock = threading.Lock()
+
+    def create_session(self, pool_size):
+        """Create the HTTP session shared by all the API calls, so the
+        connections to the API are kept alive and reused
+
+        Args:
+            pool_size (int): maximum number of kept-alive connections
+
+        Returns:
+            a requests.Session object
+        """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def create_single_flight(self, name, memoize=False):
+        """Create a coalescing of the identical API calls, see SingleFlight
+
+        Returns:
+            a SingleFlight object
+        """
+        return SingleFlight(name, memoize)
+
+    def close(self):
+        """Close the connections to the API"""
+        self.session.close()
+
+    def get_json(self, url_template, **params):
+        """Send a GET request to the API
+
+        Args:
+            url_template (str): template of the requested URL (ex: BASE_CHAR_URL)
+            params: parameters of the URL, except the zone and the access token
+
+        Returns:
+            (dict) the decoded JSON response
+        """
+        return self.api_get(url_template, **params).json()
+
+    def api_get(self, url_template, headers=None, **params):
+        """Send a GET request to the API, within the rate limits. If the
+        access token is rejected, a new one is fetched and the request is sent
+        again. The transient errors (429, 5xx, network errors) are retried
+        with a jittered exponential backoff, respecting any Retry-After.
+
+        Args:
+            url_template (str): template of the requested URL (ex: BASE_CHAR_URL)
+            headers (dict): extra HTTP headers
+            params: parameters of the URL, except the zone and the access token
+
+        Returns:
+            the requests.Response object, an HTTPError is raised for the
+            error statuses
+        """
+        endpoint = ENDPOINTS.get(url_template, "other")
+        token_renewed = False
+        attempt = 0
+        while True:
+            time.sleep(self.rate_limiter.reserve())
+            access_token = self.get_access_token()
+            url = url_template.format(api_host=self.api_host, access_token=access_token, **params)
+            logger.debug(url)
+            start = time.perf_counter()
+            try:
+                r = self.session.get(url, headers=headers, timeout=self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.observe_request("blizzard", endpoint, None, time.perf_counter() - start)
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_delay(attempt)
+                logger.warning("%s, retrying in %.1fs", e, delay)
+            else:
+                metrics.observe_request("blizzard", endpoint, r.status_code, time.perf_counter() - start,
+                                        len(r.content))
+                if r.status_code == 401 and not token_renewed:
+                    logger.info("access token rejected, getting a new one")
+                    self.token_store.discard(self.zone, self.client_id, access_token)
+                    token_renewed = True
+                    continue
+                if (r.status_code not in RETRY_STATUSES) or (attempt >= self.max_retries):
+                    break
+                delay = retry_delay(attempt, r.headers.get("Retry-After"))
+                if r.status_code == 429:
+                    self.rate_limiter.pause(delay)
+                logger.warning("HTTP %d, retrying in %.1fs", r.status_code, delay)
+            attempt += 1
+            time.sleep(delay)
+        r.raise_for_status()
+        return r
+
+    def get_access_token(self):
+        """Get a valid access token, from the token store if possible
+
+        Returns:
+            (str) the access token
+        """
+        with self.token_lock:
+            access_token = self.token_store.get(self.zone, self.client_id)
+            metrics.observe_cache("token", access_token is not None)
+            if access_token is None:
+                access_token, expires_in = self.fetch_access_token()
+                self.token_store.put(self.zone, self.client_id, access_token, expires_in)
+        return access_token
+
+    def fetch_access_token(self):
+        """Get a new auth token from Blizzard's OAuth API
+
+        Returns:
+            (str, int) the access token and its lifetime in seconds
+        """
+        url = TOKEN_URL.format(oauth_host=self.oauth_host)
+        logger.debug(url)
+        start = time.perf_counter()
+        r = self.session.post(url, data={"grant_type": "client_credentials"},
+                              auth=(self.client_id, self.client_secret), timeout=self.timeout)
+        metrics.observe_request("blizzard", "token", r.status_code, time.perf_counter() - start, len(r.content))
+        r.raise_for_status()
+        token_json = r.json()
+        logger.debug("Got access token: %s", token_json["access_token"])
+        return token_json["access_token"], token_json.get("expires_in", DEFAULT_TOKEN_LIFETIME)
 
     def run(self, guild, chars, raid, csv_output, summary,
             check_gear, google_sheet_id, dry_run,
-            default_server):
+            default_server, workers=1):
         """main function
 
         Args:
@@ -226,28 +799,230 @@ class CharactersExtractor:
             google_sheet_id (str): if not None, save results in Google Sheets
             dry_run (boolean): does not modify the Google Sheets document
             default_server (string): default server if not given in 'chars'
+            workers (int): number of characters fetched in parallel
+        """
+        if csv_output:
+            self.add_sink(CsvSink(csv_output))
+        try:
+            self.collect([guild] if guild else [], chars, raid, check_gear,
+                         default_server, workers)
+        finally:
+            with profiler.phase("outputs"):
+                self.close_sinks()
+
+        # the CSV file is already written by its sink
+        self.export_results(raid, None, summary, check_gear,
+                            google_sheet_id, dry_run)
+
+    def collect(self, guilds, chars, raid, check_gear, default_server, workers=1):
+        """Fetch and register the characters, without exporting them
+
+        Args:
+            guilds (str array): guilds to process
+            chars (str array): list of characters to process
+            raid (bool): only keeps info usefull for raids
+            check_gear (bool): check gear for any missing gem or enchantment
+            default_server (string): default server if not given in 'chars'
+            workers (int): number of characters fetched in parallel
+        """
+        with profiler.phase("static data"):
+            self.fetch_achievements_details()
+            self.fetch_classes()
+
+        guild_chars = []
+        with profiler.phase("guild roster"):
+            for guild in guilds:
+                guild_chars += self.find_guild_characters(guild, default_server)
+
+        with profiler.phase("character fetch"):
+            if workers > 1:
+                self.fetch_chars(guild_chars + chars, default_server, raid, check_gear, workers)
+            else:
+                for c in guild_chars + chars:
+                    self.fetch_char(c, default_server, raid, check_gear)
+
+    def share_results(self, other):
+        """Register the characters in the results of another extractor,
+        tagged with their zone, to combine the results of several zones
+        fetched concurrently
+
+        Args:
+            other (CharactersExtractor): the extractor gathering the results
+        """
+        self.characters = other.characters
+        self.schema = other.schema
+        self.to_fix = other.to_fix
+        self.failed = other.failed
+        self.sinks = other.sinks
+        self.register_lock = other.register_lock
+        self.tag_zone = True
+
+    def run_daemon(self, guild, chars, raid, csv_output, summary,
+                   check_gear, google_sheet_id, dry_run,
+                   default_server, workers=1,
+                   flush_interval=DAEMON_FLUSH_INTERVAL,
+                   roster_interval=DAEMON_ROSTER_INTERVAL):
+        """main function of the daemon mode: keep refreshing the characters,
+        the most active ones more often (see RefreshScheduler), and export
+        the results periodically, until interrupted (Ctrl-C)
+
+        Args:
+            guild (str or None): guild to process, its roster is refreshed
+                                 every 'roster_interval'
+            chars (str array): list of characters to process
+            raid (bool): only keeps info usefull for raids
+            csv_output (str): if not None, save results in the CSV file
+            summary (bool): print a results' sumamry
+            check_gear (bool): check gear for any missing gem or enchantment
+            google_sheet_id (str): if not None, save results in Google Sheets
+            dry_run (boolean): does not modify the Google Sheets document
+            default_server (string): default server if not given in 'chars'
+            workers (int): number of characters fetched in parallel
+            flush_interval (float): seconds between two exports of the results
+            roster_interval (float): seconds between two fetches of the roster
+        """
+        with profiler.phase("static data"):
+            self.fetch_achievements_details()
+            self.fetch_classes()
+
+        scheduler = RefreshScheduler()
+        explicit_chars = set()
+        for server, name in self.get_chars_to_fetch(chars, default_server):
+            scheduler.schedule(server, name, 0)
+            explicit_chars.add(char_key(server, name))
+        guild_chars = set()
+        next_roster = 0
+        next_flush = time.time() + flush_interval
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while True:
+                now = time.time()
+                if guild and (now >= next_roster):
+                    with profiler.phase("guild roster"):
+                        guild_chars = self.refresh_guild_roster(guild, default_server, scheduler, guild_chars,
+                                                                explicit_chars)
+                    next_roster = now + roster_interval
+
+                due = scheduler.pop_due(now, workers)
+                with profiler.phase("character fetch"):
+                    futures = [executor.submit(profiler.call, self.build_char, server, name, raid, check_gear)
+                               for server, name in due]
+                    for (server, name), f in zip(due, futures):
+                        char = f.result()
+                        if char:
+                            self.register_char(char, replace=True)
+                        scheduler.schedule(server, name, time.time() + scheduler.get_interval(char))
+
+                now = time.time()
+                if now >= next_flush:
+                    self.flush_results(raid, csv_output, summary, check_gear, google_sheet_id, dry_run)
+                    next_flush = now + flush_interval
+                elif not due:
+                    wake_up = min(next_flush, scheduler.next_due(), next_roster if guild else next_flush)
+                    time.sleep(max(0, wake_up - now))
+        except KeyboardInterrupt:
+            print("Stopping...")
+        finally:
+            executor.shutdown()
+            self.flush_results(raid, csv_output, summary, check_gear, google_sheet_id, dry_run)
+            self.close_sinks()
+
+    def refresh_guild_roster(self, guild, default_server, scheduler, guild_chars,
+                             explicit_chars=()):
+        """Fetch the guild roster in daemon mode: the new members are fetched
+        right away, the departed ones are no longer refreshed nor exported,
+        unless they are also given explicitly
+
+        Args:
+            guild (str): the guild
+            default_server (string): default server if not given in 'guild'
+            scheduler (RefreshScheduler): characters to refresh
+            guild_chars (set): current members, (server, name)
+            explicit_chars (set): characters given explicitly, see char_key()
+
+        Returns:
+            (set) the members, (server, name)
+        """
+        try:
+            members = set([split_server_and_name(c) for c in self.find_guild_characters(guild, default_server)])
+        except (ValueError, KeyError, requests.exceptions.RequestException):
+            logger.error("cannot fetch the roster of %s", guild)
+            return guild_chars
+        for server, name in members - guild_chars:
+            if not scheduler.is_scheduled(server, name):
+                scheduler.schedule(server, name, 0)
+        for server, name in guild_chars - members:
+            if char_key(server, name) in explicit_chars:
+                continue
+            scheduler.unschedule(server, name)
+            self.unregister_char(server, name)
+        return members
+
+    def flush_results(self, raid, csv_output, summary, check_gear,
+                      google_sheet_id, dry_run):
+        """Export the results in daemon mode, see export_results(). The item
+        descriptions memoized since the previous export are forgotten, so
+        the memory of the daemon stays bounded."""
+        self.item_requests.clear()
+        if not len(self.characters):
+            return
+        self.export_results(raid, csv_output, summary, check_gear,
+                            google_sheet_id, dry_run)
+        self.failed = []
+
+    def add_sink(self, sink):
+        """Add an output fed with each character as soon as it is registered
+
+        Args:
+            sink (CsvSink, JsonLinesSink or StdoutSink): the output
         """
-        self.fetch_achievements_details()
-        self.fetch_classes()
+        self.sinks.append(sink)
+
+    def close_sinks(self):
+        """Close the outputs fed with the registered characters"""
+        for sink in self.sinks:
+            sink.close(self.schema)
+        self.sinks = []
 
-        guild_chars = self.find_guild_characters(guild, default_server) if guild else []
+    def export_results(self, raid, csv_output, summary, check_gear,
+                       google_sheet_id, dry_run):
+        """Save and display the results of the fetched characters
 
-        for c in guild_chars + chars:
-            self.fetch_char(c, default_server, raid, check_gear)
+        Args:
+            raid (bool): only keeps info usefull for raids
+            csv_output (str): if not None, save results in the CSV file
+            summary (bool): print a results' sumamry
+            check_gear (bool): display the gear to fix
+            google_sheet_id (str): if not None, save results in Google Sheets
+            dry_run (boolean): does not modify the Google Sheets document
+        """
+        if self.failed:
+            print("======================================================")
+            print("/!\\ %d character(s) cannot be fetched: %s" % (len(self.failed), ", ".join(self.failed)))
 
         if csv_output:
-            self.save_csv(csv_output)
+            with profiler.phase("CSV"):
+                self.save_csv(csv_output)
 
         if summary:
-            self.display_summary()
+            with profiler.phase("summary"):
+                self.display_summary()
 
         if google_sheet_id:
-            self.save_summary_in_google_sheets(google_sheet_id, dry_run)
+            with profiler.phase("Sheets summary"):
+                sc = SheetConnector(google_sheet_id, dry_run, self.sheets_service, self.archive)
+                # reading all the target ranges at once
+                sc.check_or_create_sheet(SUMMARY_SHEET)
+                sc.get_multiple_values([sc.get_range(SUMMARY_SHEET)] +
+                                       ([] if raid else self.get_extra_sheets_ranges(sc)))
+                self.save_summary_in_google_sheets(google_sheet_id, dry_run, sc)
             if not raid:
-                self.save_extra_google_sheets(google_sheet_id, dry_run)
+                with profiler.phase("Sheets history"):
+                    self.save_extra_google_sheets(google_sheet_id, dry_run, sc)
 
         if check_gear:
-            self.display_gear_to_fix()
+            with profiler.phase("gear report"):
+                self.display_gear_to_fix()
 
     def get_known_char(self, server, name):
         """Search an already known/processed character
@@ -259,10 +1034,7 @@ class CharactersExtractor:
         Returns
             a CharInfo object or None if not found
         """
-        for r in self.characters:
-            if (r.server() == server) and (r.name() == name):
-                return r
-        return None
+        return self.characters.get(server, name, self.zone if self.tag_zone else None)
 
     def find_guild_characters(self, serv_and_guildname, default_server=None):
         """Find characters from given list
@@ -275,30 +1047,27 @@ class CharactersExtractor:
         """
         print("======================================================")
         print("Processing guild: '%s'" % serv_and_guildname)
-        server = None
-        name = None
-        try:
-            server, name = serv_and_guildname.split(":")
-        except ValueError:
-            if default_server:
-                logger.info("no server name, using default server '%s'", default_server)
-                server = default_server
-            else:
-                logger.warn("no server name, using default server 'voljin'")
-                server = "voljin"
-            name = serv_and_guildname
+        server, name = split_server_and_name(serv_and_guildname, default_server)
 
-        url = GUILD_URL.format(zone=self.zone, access_token=self.access_token, server=server, name=name, fields="members")
-        logger.debug(url)
-        r = requests.get(url)
-        r.raise_for_status()
-        members = r.json()["members"]
+        return self.process_guild_members(self.get_json(GUILD_URL, server=server, name=name, fields="members"))
+
+    def process_guild_members(self, guild_json):
+        """Select the guild members to process
+
+        Args:
+            guild_json (dict): guild description received from the API
+
+        Returns:
+            (str array) the characters to process ("server:name")
+        """
+        members = guild_json["members"]
         guild_chars = []
         for m in members:
             charname = m["character"]["name"]
             level = m["character"]["level"]
             realm = m["character"]["realm"]
             logger.debug("%3d %s" % (level, charname))
+            self.roster_last_modified[(realm, charname)] = m["character"].get("lastModified")
             if level >= 111:
                 logger.info("Found valid character: %3d %s" % (level, charname))
                 guild_chars.append("%s:%s" % (realm, charname))
@@ -316,223 +1085,577 @@ class CharactersExtractor:
             raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
             check_gear (bool): check gear for any missing gem or enchantment
         """
-        print("======================================================")
-        print("Processing: %s" % (serv_and_name))
-        server = None
-        name = None
-        try:
-            server, name = serv_and_name.split(":")
-        except ValueError:
-            if default_server:
-                logger.info("no server name, using default server '%s'", default_server)
-                server = default_server
-            else:
-                logger.warn("no server name, using default server 'voljin'")
-                server = "voljin"
-            name = serv_and_name
+        server, name = split_server_and_name(serv_and_name, default_server)
 
         if self.get_known_char(server, name):
             logger.warn("character '%s' already processed" % (serv_and_name))
             return
 
-        char = CharInfo(server, name)
-        try:
-            self.fetch_char_base(char, check_gear)
-            if not raid:
-                self.fetch_char_achievements(char)
-                self.fetch_char_professions(char)
-        except (ValueError, KeyError, requests.exceptions.HTTPError):
-            logger.error("cannot fetch %s/%s", server, name)
-            return
-        self.characters.append(char)
+        char = self.build_char(server, name, raid, check_gear)
+        if char:
+            self.register_char(char)
 
-    def fetch_char_base(self, char, check_gear):
-        """Fetch and fill info for the given character: level + items related info
+    def fetch_chars(self, servs_and_names, default_server=None, raid=False,
+                    check_gear=False, workers=1):
+        """Fetch and register several characters using a pool of threads.
+        The characters are registered in the given order, whatever the order
+        in which their fetching completes.
 
         Args:
-            char (CharInfo): the character to fetch
+            servs_and_names (str array): characters to fetch ("server:name")
+            default_server (string): default server if not given in 'servs_and_names'
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
             check_gear (bool): check gear for any missing gem or enchantment
+            workers (int): maximum number of characters fetched in parallel
         """
-        url = BASE_CHAR_URL.format(zone=self.zone, access_token=self.access_token, server=char.server(), name=char.name(), fields="items")
-        logger.debug(url)
-        r = requests.get(url)
-        r.raise_for_status()
-        char_json = r.json()
-        char.set_data(H_CLASS, self.classnames[char_json[H_CLASS]])
-        char.set_data(H_LVL, str(char_json[H_LVL]))
-        items = char_json["items"]
-        char.set_data(H_ILVL, str(items["averageItemLevelEquipped"]))
-        try:
-            char.set_data(H_AZERITE_LVL, str(items["neck"]["azeriteItem"]["azeriteLevel"]))
-        except (ValueError, KeyError):
-            logger.warn("Cannot find azerite level.")
-            char.set_data(H_AZERITE_LVL, "0")
-
-        # Checking gear
-        if check_gear:
-            total_empty_sockets = 0
-            missing_enchants = []
-            for slot in sorted(items):
-                item = items[slot]
-                nb_empty_sockets, missing_enchant = self.check_item_enchants_and_gems(slot, item)
-                total_empty_sockets += nb_empty_sockets
-                if missing_enchant:
-                    missing_enchants.append(slot)
-
-            # specific to my characters
-            STAT_ENCHANTS = {
-                # "oxyde"   : ("versatility", "agi", "heavy hide"),
-                # "ayonis"  : ("haste",       "int", "satyr"),
-                # "oxyr"    : ("haste",       "agi", "satyr"),
-                # "agoniss" : ("haste",       "int", "satyr"),
-                # "palaniss": ("haste",       "str", "satyr"),
-                # "odyxe"   : ("mastery",     "agi", "satyr"),
-                # "kodyx"   : ("mastery",     "str", "satyr"),
-                # "oxymus"  : ("haste",       "int", "satyr"),
-                # "monxy"   : ("mastery",     "agi", "satyr"),
-                # "oxgrom"  : ("haste",       "str", "satyr"),
-                # "oxydhe"  : ("crit",        "agi", "satyr"),
-                # "voxy"    : ("mastery",     "agi", "satyr"),
-            }
+        to_fetch = self.get_chars_to_fetch(servs_and_names, default_server)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(profiler.call, self.build_char, server, name, raid, check_gear)
+                       for server, name in to_fetch]
+            for f in futures:
+                char = f.result()
+                if char:
+                    self.register_char(char)
+
+    def get_chars_to_fetch(self, servs_and_names, default_server=None):
+        """Resolve the characters to fetch, skipping the duplicated ones
 
-            to_fix = []
-            if total_empty_sockets:
-                if char.name() in STAT_ENCHANTS:
-                    to_fix.extend(["gem " + STAT_ENCHANTS[char.name()][0] for i in range(total_empty_sockets)])
-                else:
-                    to_fix.append("%d gem(s)"%total_empty_sockets)
-            for m in missing_enchants:
-                if char.name() in STAT_ENCHANTS:
-                    if "finger" in m:
-                        to_fix.append("enchant ring " + STAT_ENCHANTS[char.name()][0])
-                    elif m == "back":
-                        to_fix.append("enchant back " + STAT_ENCHANTS[char.name()][1])
-                    elif m == "neck" and STAT_ENCHANTS[char.name()][2]:
-                        to_fix.append("enchant neck " + STAT_ENCHANTS[char.name()][2])
-                    else:
-                        to_fix.append("enchant " + m)
-                else:
-                    to_fix.append("enchant " + m)
+        Args:
+            servs_and_names (str array): characters to fetch ("server:name")
+            default_server (string): default server if not given in 'servs_and_names'
 
-            if to_fix:
-                self.to_fix["%s-%s"%(char.name(), char.server())] = to_fix
+        Returns:
+            ((str, str) array) servers and names of the characters to fetch
+        """
+        to_fetch = []
+        queued = set()
+        for serv_and_name in servs_and_names:
+            server, name = split_server_and_name(serv_and_name, default_server)
+            if self.get_known_char(server, name) or char_key(server, name) in queued:
+                logger.warn("character '%s' already processed" % (serv_and_name))
+                continue
+            queued.add(char_key(server, name))
+            to_fetch.append((server, name))
+        return to_fetch
 
-    def check_item_enchants_and_gems(self, slot, item_dict):
-        """Check any missing enchant or gem in the given item
+    def build_char(self, server, name, raid=False, check_gear=False):
+        """Fetch a character from Blizzard's API without registering it.
+        Can be called from several threads at once.
 
         Args:
-            slot (str): slot of the item (ex: head, back, shoulders, neck...)
-            item_dict (dict): incomplete description of the item received from
-                              the API
+            server (str): server of the character
+            name (str): name of the character
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+            check_gear (bool): check gear for any missing gem or enchantment
 
         Returns:
-            (int, boolean): (number of empty gem slot, true is not enchanted)
-
+            a CharInfo object or None if the character cannot be fetched
         """
-        if not isinstance(item_dict, dict) or "id" not in item_dict:
-            return 0, False
-        logger.debug("Checking enchants and gems of slot: %s", slot)
-        item_id = item_dict["id"]
-        context = item_dict["context"]
-        # Some contexts seem to be invalid in the API, so we do not use them
-        if context in ["vendor", "scenario-normal", "quest-reward"]:
-            context = ""
-        elif context:
-            context = "/" + context
-        bonus_list = ",".join([str(b) for b in item_dict["bonusLists"]])
-        nb_empty_sockets = 0
-        missing_enchant = False
-        # getting full item description
+        print("======================================================")
+        print("Processing: %s:%s" % (server, name))
+        char = CharInfo(server, name)
+        if self.load_previous_char(char, raid, check_gear):
+            return char.previous
         try:
-            # logger.debug(item_dict)
-            url = BASE_ITEM_URL.format(zone=self.zone, access_token=self.access_token, id=item_id,
-                                       slash_context=context,
-                                       bonus_list=bonus_list)
-            logger.debug(url)
-            r = requests.get(url)
-            r.raise_for_status()
-            item = r.json()
-
-            # checking gem slots & checking with current item state
-            nb_sockets = len(item["socketInfo"]) if "socketInfo" in item else 0
-            for i in range(nb_sockets):
-                if ("gem%d"%i) not in item_dict["tooltipParams"]:
-                   nb_empty_sockets += 1
-            if nb_empty_sockets:
-                logger.debug("Found %d empty socket(s)", nb_empty_sockets)
-
-            # checking enchants
-            if slot in ["finger1", "finger2", "mainHand"]:
-                if ("enchant") not in item_dict["tooltipParams"]:
-                    logger.debug("Detected missing enchantment for this slot !")
-                    missing_enchant = True
-        except ValueError:
-            logger.error("cannot get full item description for %s", item_id)
-
-        return nb_empty_sockets, missing_enchant
+            if self.single_request:
+                self.fetch_char_profile(char, raid, check_gear)
+            else:
+                self.fetch_char_base(char, check_gear)
+                if not raid:
+                    self.fetch_char_achievements(char)
+                    self.fetch_char_professions(char)
+        except NotModified:
+            logger.info("%s/%s not modified since last run", server, name)
+            return char.previous
+        except (ValueError, KeyError, requests.exceptions.RequestException):
+            logger.error("cannot fetch %s/%s", server, name)
+            self.failed.append("%s:%s" % (server, name))
+            return None
+        if self.char_states:
+            self.char_states.put(self.zone, char, self.get_fetch_signature(raid, check_gear))
+        return char
 
-    def fetch_char_achievements(self, char):
-        """Fetch and fill achievements
+    def load_previous_char(self, char, raid, check_gear):
+        """In incremental mode, load the character fetched by a previous run
+        (with the same options) in char.previous
 
         Args:
             char (CharInfo): the character to fetch
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+            check_gear (bool): check gear for any missing gem or enchantment
+
+        Returns:
+            (bool) True if the guild roster shows that the character is not
+            modified, so it does not need to be fetched
         """
-        try:
-            url = BASE_CHAR_URL.format(zone=self.zone, access_token=self.access_token, server=char.server(), name=char.name(), fields="achievements,quests")
-            logger.debug(url)
-            r = requests.get(url)
-            r.raise_for_status()
-            obj = r.json()
-            achievements = obj["achievements"]
-        except ValueError:
-            logger.warn("cannot retrieve achievements for %s/%s", char.server(), char.name())
+        if not self.char_states:
+            return False
+        char.previous = self.char_states.get(self.zone, char.server(), char.name(),
+                                             self.get_fetch_signature(raid, check_gear))
+        if not char.previous:
+            return False
+        last_modified = self.roster_last_modified.get((char.server(), char.name()))
+        if last_modified and (last_modified == char.previous.last_modified):
+            logger.info("%s/%s not modified according to the guild roster", char.server(), char.name())
+            metrics.observe_cache("character", True)
+            return True
+        return False
+
+    def get_fetch_signature(self, raid, check_gear):
+        """Get a description of the info fetched for the characters: a
+        character fetched by a previous run can only be reused if fetched
+        with the same signature
 
-        for ach_desc in self.achievements:
-            ach_id = ach_desc["id"]
-            title = ach_desc["title"]
-            if ACHIEVEMENTS[ach_id]:
-                char.set_data(title, self.check_stepped_achievement(ach_desc, ach_id, achievements))
-            else:
-                char.set_data(title, self.check_achievement(ach_desc, ach_id, achievements))
+        Args:
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+            check_gear (bool): check gear for any missing gem or enchantment
 
-    def check_achievement(self, ach_desc, ach_id, char_achievements):
-        """Check if achievement is completed (ie. one of its criterias is met)
+        Returns:
+            (str) the signature
+        """
+        return "fields=%s;gear=%s;achievements=%s" % (",".join(sorted(self.get_char_fields(raid))),
+                                                      check_gear,
+                                                      ",".join([str(a) for a in sorted(ACHIEVEMENTS)]))
+
+    def get_char_json(self, char, fields):
+        """Fetch the profile of a character. The request is conditional when
+        the character was fetched by a previous incremental run. The
+        concurrent requests of the same profile share a single call (see
+        SingleFlight).
 
         Args:
-            ach_desc (dict): description of the tested achievement
-            ach_id (int): id of the tested achievement
-            char_achievements (dict): achivements info of the character
+            char (CharInfo): the character to fetch
+            fields (str): fields of the profile to fetch
 
         Returns:
-            "Ok" if the achievement is validated. Else: ""
+            (dict) the decoded JSON profile
+
+        Raises:
+            NotModified: the profile is not modified since the previous run
         """
-        ach_ok = False
-        if ach_id in char_achievements["achievementsCompleted"]:
-            logger.debug("char has ach: %s", ach_desc)
-            for criteria in ach_desc["criteria"]:
-                crit_ok = False
-                try:
-                    crit_index = char_achievements["criteria"].index(criteria["id"])
-                    if char_achievements["criteriaQuantity"][crit_index] >= criteria["max"]:
-                        ach_ok = True
-                        crit_ok = True
-                except ValueError:
-                    pass
-                logger.debug("Criteria %s ==> %s", criteria, crit_ok)
-        return "OK" if ach_ok else ""
+        data, char.validators = self.char_requests.do(self.get_char_request_key(char, fields, True),
+                                                      self.request_char_json, char, fields)
+        return data
 
-    def check_stepped_achievement(self, ach_desc, ach_id, char_achievements):
-        """Check if achievement is completed (all its criterias are met)
+    def get_char_fields_json(self, char, fields):
+        """Fetch fields of the profile of a character, without conditional
+        request. The concurrent requests of the same fields share a single
+        call (see SingleFlight).
 
         Args:
-            ach_desc (dict): description of the tested achievement
-            ach_id (int): id of the tested achievement
-            char_achievements (dict): achivements info of the character
+            char (CharInfo): the character to fetch
+            fields (str): fields of the profile to fetch
 
         Returns:
-            "X/X" if the achievement is validated. Else: "Y/X: {next incomplete step}"
+            (dict) the decoded JSON profile
         """
-        count = 0
+        return self.char_requests.do(self.get_char_request_key(char, fields, False),
+                                     self.get_json, BASE_CHAR_URL, server=char.server(),
+                                     name=char.name(), fields=fields)
+
+    def get_char_request_key(self, char, fields, conditional):
+        """Get the key identifying a request of a character profile in
+        'char_requests'
+
+        Args:
+            char (CharInfo): the character to fetch
+            fields (str): fields of the profile to fetch
+            conditional (bool): conditional request, see get_char_json()
+
+        Returns:
+            (tuple) the key
+        """
+        validators = char.previous.validators if (conditional and char.previous) else None
+        return (char_key(char.server(), char.name()), fields, conditional, validators)
+
+    def request_char_json(self, char, fields):
+        """Send the request of get_char_json()
+
+        Returns:
+            (dict, tuple) the decoded JSON profile and its validators
+            (ETag, Last-Modified)
+        """
+        headers = {}
+        if char.previous and char.previous.validators:
+            etag, last_modified = char.previous.validators
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        r = self.api_get(BASE_CHAR_URL, headers=headers, server=char.server(), name=char.name(), fields=fields)
+        if headers:
+            metrics.observe_cache("character", r.status_code == 304)
+        if r.status_code == 304:
+            raise NotModified()
+        return r.json(), (r.headers.get("ETag"), r.headers.get("Last-Modified"))
+
+    def register_char(self, char, replace=False):
+        """Register a fetched character and its gear to fix
+
+        Args:
+            char (CharInfo): the fetched character
+            replace (bool): replace the character if already registered
+        """
+        if self.tag_zone:
+            char[H_ZONE] = self.zone
+        with self.register_lock:
+            self.characters.add(char, replace)
+            if char.to_fix:
+                self.to_fix[char_label(char)] = char.to_fix
+            elif replace:
+                self.to_fix.pop(char_label(char), None)
+            for sink in self.sinks:
+                sink.write(char, self.schema)
+
+    def unregister_char(self, server, name):
+        """Forget a registered character and its gear to fix, ex: when it
+        leaves the guild in daemon mode
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+        """
+        zone = self.zone if self.tag_zone else None
+        with self.register_lock:
+            char = self.characters.get(server, name, zone)
+            if char is None:
+                return
+            self.to_fix.pop(char_label(char), None)
+            self.characters.remove(server, name, zone)
+
+    def fetch_char_base(self, char, check_gear):
+        """Fetch and fill info for the given character: level + items related info
+
+        Args:
+            char (CharInfo): the character to fetch
+            check_gear (bool): check gear for any missing gem or enchantment
+        """
+        char_json = self.get_char_json(char, "items")
+        items = self.process_char_base(char, char_json)
+        if check_gear:
+            with profiler.phase("gear check"):
+                self.check_char_gear(char, items)
+
+    def fetch_char_profile(self, char, raid, check_gear):
+        """Fetch and fill all the info of the character with a single request
+        containing only the fields used by the enabled features
+
+        Args:
+            char (CharInfo): the character to fetch
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+            check_gear (bool): check gear for any missing gem or enchantment
+        """
+        char_json = self.get_char_json(char, ",".join(self.get_char_fields(raid)))
+        items = self.process_char_profile(char, char_json, raid)
+        if check_gear:
+            with profiler.phase("gear check"):
+                self.check_char_gear(char, items)
+
+    def get_char_fields(self, raid):
+        """Get the fields of the character profile used by the enabled features
+
+        Args:
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+
+        Returns:
+            (str array) the fields to request
+        """
+        fields = ["items"]
+        if not raid:
+            if self.achievements:
+                fields.append("achievements")
+            fields.append("professions")
+        return fields
+
+    def process_char_profile(self, char, char_json, raid):
+        """Fill all the info from a character description containing the
+        fields returned by get_char_fields()
+
+        Args:
+            char (CharInfo): the character to fill
+            char_json (dict): character description received from the API
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+
+        Returns:
+            (dict) the equipped items
+        """
+        items = self.process_char_base(char, char_json)
+        if not raid:
+            if self.achievements:
+                self.process_char_achievements(char, char_json)
+            self.process_char_professions(char, char_json)
+        return items
+
+    def check_char_gear(self, char, items):
+        """Check the equipped items of the character and set its gear to fix
+
+        Args:
+            char (CharInfo): the checked character
+            items (dict): the equipped items received from the API
+        """
+        gear_checks = []
+        for slot in sorted(items):
+            nb_empty_sockets, missing_enchant = self.check_item_enchants_and_gems(slot, items[slot])
+            gear_checks.append((slot, nb_empty_sockets, missing_enchant))
+        self.set_gear_to_fix(char, gear_checks)
+
+    def process_char_base(self, char, char_json):
+        """Fill level and items related info from the character description
+
+        Args:
+            char (CharInfo): the character to fill
+            char_json (dict): character description received from the API
+
+        Returns:
+            (dict) the equipped items
+        """
+        char.last_modified = char_json.get("lastModified")
+        char.set_data(H_CLASS, self.classnames[char_json[H_CLASS]])
+        char.set_data(H_LVL, str(char_json[H_LVL]))
+        items = char_json["items"]
+        char.set_data(H_ILVL, str(items["averageItemLevelEquipped"]))
+        try:
+            char.set_data(H_AZERITE_LVL, str(items["neck"]["azeriteItem"]["azeriteLevel"]))
+        except (ValueError, KeyError):
+            logger.warn("Cannot find azerite level.")
+            char.set_data(H_AZERITE_LVL, "0")
+        return items
+
+    def set_gear_to_fix(self, char, gear_checks):
+        """Compute the gear to fix from the checks of the equipped items
+
+        Args:
+            char (CharInfo): the checked character
+            gear_checks ((str, int, bool) array): slot, number of empty gem
+                                                  slots and missing enchant
+                                                  of each item
+        """
+        total_empty_sockets = sum([c[1] for c in gear_checks])
+        missing_enchants = [c[0] for c in gear_checks if c[2]]
+        # specific to my characters
+        STAT_ENCHANTS = {
+            # "oxyde"   : ("versatility", "agi", "heavy hide"),
+            # "ayonis"  : ("haste",       "int", "satyr"),
+            # "oxyr"    : ("haste",       "agi", "satyr"),
+            # "agoniss" : ("haste",       "int", "satyr"),
+            # "palaniss": ("haste",       "str", "satyr"),
+            # "odyxe"   : ("mastery",     "agi", "satyr"),
+            # "kodyx"   : ("mastery",     "str", "satyr"),
+            # "oxymus"  : ("haste",       "int", "satyr"),
+            # "monxy"   : ("mastery",     "agi", "satyr"),
+            # "oxgrom"  : ("haste",       "str", "satyr"),
+            # "oxydhe"  : ("crit",        "agi", "satyr"),
+            # "voxy"    : ("mastery",     "agi", "satyr"),
+        }
+
+        to_fix = []
+        if total_empty_sockets:
+            if char.name() in STAT_ENCHANTS:
+                to_fix.extend(["gem " + STAT_ENCHANTS[char.name()][0] for i in range(total_empty_sockets)])
+            else:
+                to_fix.append("%d gem(s)"%total_empty_sockets)
+        for m in missing_enchants:
+            if char.name() in STAT_ENCHANTS:
+                if "finger" in m:
+                    to_fix.append("enchant ring " + STAT_ENCHANTS[char.name()][0])
+                elif m == "back":
+                    to_fix.append("enchant back " + STAT_ENCHANTS[char.name()][1])
+                elif m == "neck" and STAT_ENCHANTS[char.name()][2]:
+                    to_fix.append("enchant neck " + STAT_ENCHANTS[char.name()][2])
+                else:
+                    to_fix.append("enchant " + m)
+            else:
+                to_fix.append("enchant " + m)
+
+        char.to_fix = to_fix
+
+    def check_item_enchants_and_gems(self, slot, item_dict):
+        """Check any missing enchant or gem in the given item
+
+        Args:
+            slot (str): slot of the item (ex: head, back, shoulders, neck...)
+            item_dict (dict): incomplete description of the item received from
+                              the API
+
+        Returns:
+            (int, boolean): (number of empty gem slot, true is not enchanted)
+
+        """
+        item_key = self.get_item_key(slot, item_dict)
+        if item_key is None:
+            return 0, False
+        # getting full item description
+        try:
+            return self.check_item(slot, item_dict, self.get_item(item_key))
+        except ValueError:
+            logger.error("cannot get full item description for %s", item_dict["id"])
+        return 0, False
+
+    def get_item(self, item_key):
+        """Get the full description of an item. The description is fetched
+        once per run: the concurrent and later lookups of the same item
+        share it (see SingleFlight).
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item, see get_item_key()
+
+        Returns:
+            (dict) the full description of the item, not to be modified
+        """
+        return self.item_requests.do(item_key, self.load_item, item_key)
+
+    def load_item(self, item_key):
+        """Get the full description of an item, from the item cache if possible
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item, see get_item_key()
+
+        Returns:
+            (dict) the full description of the item
+        """
+        item = self.item_cache.get(item_key) if self.item_cache else None
+        if self.item_cache:
+            metrics.observe_cache("item", item is not None)
+        if item is None:
+            item = self.get_json(BASE_ITEM_URL, **self.get_item_params(item_key))
+            if self.item_cache:
+                self.item_cache.put(item_key, item)
+        return item
+
+    def get_item_key(self, slot, item_dict):
+        """Get the parameters identifying the full description of an equipped item
+
+        Args:
+            slot (str): slot of the item (ex: head, back, shoulders, neck...)
+            item_dict (dict): incomplete description of the item received from
+                              the API
+
+        Returns:
+            (int, str, str) the id, context and bonus list of the item, or
+            None if the slot does not contain an item
+        """
+        if not isinstance(item_dict, dict) or "id" not in item_dict:
+            return None
+        logger.debug("Checking enchants and gems of slot: %s", slot)
+        context = item_dict["context"]
+        # Some contexts seem to be invalid in the API, so we do not use them
+        if context in ["vendor", "scenario-normal", "quest-reward"]:
+            context = ""
+        bonus_list = ",".join([str(b) for b in item_dict["bonusLists"]])
+        return item_dict["id"], context, bonus_list
+
+    def get_item_params(self, item_key):
+        """Get the parameters of the URL of the full description of an item
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item, see get_item_key()
+
+        Returns:
+            (dict) the parameters of BASE_ITEM_URL
+        """
+        item_id, context, bonus_list = item_key
+        return {"id": item_id,
+                "slash_context": ("/" + context) if context else "",
+                "bonus_list": bonus_list}
+
+    def check_item(self, slot, item_dict, item):
+        """Compare the full description of an item with its current state
+
+        Args:
+            slot (str): slot of the item (ex: head, back, shoulders, neck...)
+            item_dict (dict): incomplete description of the item received from
+                              the API
+            item (dict): full description of the item received from the API
+
+        Returns:
+            (int, boolean): (number of empty gem slot, true is not enchanted)
+        """
+        nb_empty_sockets = 0
+        missing_enchant = False
+
+        # checking gem slots & checking with current item state
+        nb_sockets = len(item["socketInfo"]) if "socketInfo" in item else 0
+        for i in range(nb_sockets):
+            if ("gem%d"%i) not in item_dict["tooltipParams"]:
+               nb_empty_sockets += 1
+        if nb_empty_sockets:
+            logger.debug("Found %d empty socket(s)", nb_empty_sockets)
+
+        # checking enchants
+        if slot in ["finger1", "finger2", "mainHand"]:
+            if ("enchant") not in item_dict["tooltipParams"]:
+                logger.debug("Detected missing enchantment for this slot !")
+                missing_enchant = True
+
+        return nb_empty_sockets, missing_enchant
+
+    def fetch_char_achievements(self, char):
+        """Fetch and fill achievements
+
+        Args:
+            char (CharInfo): the character to fetch
+        """
+        try:
+            obj = self.get_char_fields_json(char, "achievements")
+        except ValueError:
+            logger.warn("cannot retrieve achievements for %s/%s", char.server(), char.name())
+            return
+        self.process_char_achievements(char, obj)
+
+    def process_char_achievements(self, char, char_json):
+        """Fill achievements from the character description
+
+        Args:
+            char (CharInfo): the character to fill
+            char_json (dict): character description received from the API
+        """
+        achievements = char_json["achievements"]
+        for ach_desc in self.achievements:
+            ach_id = ach_desc["id"]
+            title = ach_desc["title"]
+            if ACHIEVEMENTS[ach_id]:
+                char.set_data(title, self.check_stepped_achievement(ach_desc, ach_id, achievements))
+            else:
+                char.set_data(title, self.check_achievement(ach_desc, ach_id, achievements))
+
+    def check_achievement(self, ach_desc, ach_id, char_achievements):
+        """Check if achievement is completed (ie. one of its criterias is met)
+
+        Args:
+            ach_desc (dict): description of the tested achievement
+            ach_id (int): id of the tested achievement
+            char_achievements (dict): achivements info of the character
+
+        Returns:
+            "Ok" if the achievement is validated. Else: ""
+        """
+        ach_ok = False
+        if ach_id in char_achievements["achievementsCompleted"]:
+            logger.debug("char has ach: %s", ach_desc)
+            for criteria in ach_desc["criteria"]:
+                crit_ok = False
+                try:
+                    crit_index = char_achievements["criteria"].index(criteria["id"])
+                    if char_achievements["criteriaQuantity"][crit_index] >= criteria["max"]:
+                        ach_ok = True
+                        crit_ok = True
+                except ValueError:
+                    pass
+                logger.debug("Criteria %s ==> %s", criteria, crit_ok)
+        return "OK" if ach_ok else ""
+
+    def check_stepped_achievement(self, ach_desc, ach_id, char_achievements):
+        """Check if achievement is completed (all its criterias are met)
+
+        Args:
+            ach_desc (dict): description of the tested achievement
+            ach_id (int): id of the tested achievement
+            char_achievements (dict): achivements info of the character
+
+        Returns:
+            "X/X" if the achievement is validated. Else: "Y/X: {next incomplete step}"
+        """
+        count = 0
         next_step = ""
         if ach_id in char_achievements["achievementsCompleted"]:
             logger.debug("char has ach: %s", ach_desc)
@@ -552,19 +1675,24 @@ class CharactersExtractor:
             char (CharInfo): the character to fetch
         """
         try:
-            url = BASE_CHAR_URL.format(zone=self.zone, access_token=self.access_token, server=char.server(), name=char.name(), fields="professions")
-            logger.debug(url)
-            r = requests.get(url)
-            r.raise_for_status()
-            obj = r.json()
-            professions = obj["professions"]["primary"]
+            obj = self.get_char_fields_json(char, "professions")
         except ValueError:
             logger.warn("cannot retrieve professions for %s/%s", char.server(), char.name())
+            return
+        self.process_char_professions(char, obj)
 
+    def process_char_professions(self, char, char_json):
+        """Fill BfA professions from the character description
+
+        Args:
+            char (CharInfo): the character to fill
+            char_json (dict): character description received from the API
+        """
+        professions = char_json["professions"]["primary"]
         count = 0
         for profession in professions:
             if profession["name"].startswith("Kul Tiran"):
-            count += 1
+                count += 1
                 char.set_data("BfA profession %d" % count, "%s: %d" % (profession["name"].replace("Kul Tiran", "BfA"), profession["rank"]))
 
     def fetch_achievements_details(self):
@@ -572,23 +1700,52 @@ class CharactersExtractor:
         print("======================================================")
         print("Fetching achievements details")
         for a_id in ACHIEVEMENTS:
-            url = BASE_ACHIEV_URL.format(zone=self.zone, access_token=self.access_token, id=a_id)
-            logger.debug(url)
-            r = requests.get(url)
-            r.raise_for_status()
-            ach = r.json()
-            logger.info("%6d: %s", ach["id"], ach["title"])
-            self.achievements.append(ach)
+            self.process_achievement_details(self.get_static_json("achievement/%d" % a_id, BASE_ACHIEV_URL, id=a_id))
+
+    def process_achievement_details(self, ach):
+        """Register the details of an achievement to check
+
+        Args:
+            ach (dict): achievement description received from the API
+        """
+        logger.info("%6d: %s", ach["id"], ach["title"])
+        self.achievements.append(ach)
+        self.achievements_by_id[ach["id"]] = ach
 
     def fetch_classes(self):
         """Fetch the 'class id' to 'name' mapping"""
         print("======================================================")
         print("Fetching classes")
-        url = CLASSES_URL.format(zone=self.zone, access_token=self.access_token)
-        logger.debug(url)
-        r = requests.get(url)
-        r.raise_for_status()
-        classes = r.json()["classes"]
+        self.process_classes(self.get_static_json("classes", CLASSES_URL))
+
+    def get_static_json(self, key, url_template, **params):
+        """Get reference data (classes, achievements...), from the static
+        data cache if possible
+
+        Args:
+            key (str): key of the data in the cache
+            url_template (str): template of the URL of the data (ex: CLASSES_URL)
+            params: parameters of the URL, except the zone and the access token
+
+        Returns:
+            (dict) the decoded JSON data
+        """
+        data = self.static_cache.get(key) if self.static_cache else None
+        if self.static_cache:
+            metrics.observe_cache("static", data is not None)
+        if data is None:
+            data = self.get_json(url_template, **params)
+            if self.static_cache:
+                self.static_cache.put(key, data)
+        return data
+
+    def process_classes(self, classes_json):
+        """Register the 'class id' to 'name' mapping
+
+        Args:
+            classes_json (dict): classes description received from the API
+        """
+        classes = classes_json["classes"]
         for c in classes:
             cid = int(c["id"])
             name = c["name"]
@@ -604,208 +1761,2373 @@ class CharactersExtractor:
         Returns:
             The title of the achievement
         """
-        for a in self.achievements:
-            if ach_id == a["id"]:
-                return a["title"]
-        raise ValueError("Cannot retrieve achievement %d"%ach_id)
+        if ach_id in self.achievements_by_id:
+            return self.achievements_by_id[ach_id]["title"]
+        raise ValueError("Cannot retrieve achievement %d"%ach_id)
+
+    def save_csv(self, output_file):
+        """Save the results in a CSV file
+
+        Args:
+            output_file (str): path to the CSV file
+        """
+        with open(output_file, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=self.get_ordered_fieldnames(), delimiter=';')
+            writer.writeheader()
+            for r in self.characters:
+                writer.writerow(r)
+
+    def get_ordered_fieldnames(self):
+        """Sort the fieldnames (headers) in a specific order
+
+        Returns;
+            (str array) the ordered headers
+        """
+        return list(self.schema)
+
+    def display_summary(self):
+        """Print a summary of the results"""
+        print("======================================================")
+        print("Fetched %d character(s)" % len(self.characters))
+        fieldnames = self.get_ordered_fieldnames()
+        # computing width of each column
+        widths = {f:len(f) for f in fieldnames}
+        for f in fieldnames:
+            for v in self.characters.table.column_values(f):
+                widths[f] = max(widths[f], len(str(v)))
+
+        # printing fieldnames
+        line = []
+        for f in fieldnames:
+            v = "%-" + str(widths[f]) + "s"
+            line.append(v % f)
+        print((", ").join(line))
+
+        # printing rows
+        for char in self.characters.sorted_by(H_ILVL, reverse=True):
+            line = []
+            for f in fieldnames:
+                v = "%-" + str(widths[f]) + "s"
+                line.append(v % (char[f] if (f in char) else ""))
+            print((", ").join(line))
+
+    def display_gear_to_fix(self):
+        """Display gear to fix: missing gems or enchantments"""
+        print("======================================================")
+        print("/!\\ %d character(s) to fix!" % len(self.to_fix))
+        for c in self.to_fix:
+            print("%s: %s" % (c, ", ".join(self.to_fix[c])))
+        print("---------------------------")
+        to_create = {}
+        for c in self.to_fix:
+            for tc in self.to_fix[c]:
+                if tc not in to_create:
+                    to_create[tc] = [1, set()]
+                else:
+                    to_create[tc][0] += 1
+                to_create[tc][1].add(c)
+
+        for tc in sorted(to_create):
+            print("%s: %s %s" % (tc, to_create[tc][0], to_create[tc][1]))
+
+    def save_summary_in_google_sheets(self, google_sheet_id, dry_run, sheet_connector=None):
+        """Save summary in Google Sheets
+
+        Args:
+            google_sheet_id (str): the ID of the document
+            dry_run (bool): if True, do not modify the document
+            sheet_connector (SheetConnector): connector to reuse, a new one
+                                              is created if None
+        """
+        print("======================================================")
+        print("Synching summary in Google Sheets")
+
+        SUMMARY = SUMMARY_SHEET
+
+        sc = sheet_connector or SheetConnector(google_sheet_id, dry_run, self.sheets_service, self.archive)
+        fieldnames = self.get_ordered_fieldnames()
+        sc.check_or_create_sheet(SUMMARY)
+        sheet_values = sc.get_values(sc.get_range(SUMMARY))
+        headers = sc.ensure_headers(SUMMARY, fieldnames, sheet_values[0] if sheet_values else [])
+        h_indexes = {h: i for i, h in enumerate(headers)}
+        values = sheet_values[1:]
+
+        update_data = []  # cell values to update
+        to_colorize = []  # cells to colorize (when adding new character(s))
+
+        # indexing the known characters, and their zone when the fetched ones are tagged with it
+        g_indexes = {}
+        zone_index = h_indexes[H_ZONE] if H_ZONE in fieldnames else None
+        for i, g_line in enumerate(values):
+            zone = g_line[zone_index] if (zone_index is not None) and (zone_index < len(g_line)) else ""
+            g_indexes.setdefault(char_key(g_line[h_indexes[H_SERVER]], g_line[h_indexes[H_NAME]]) + (zone,), i)
+
+        # updating / adding characters info
+        for r in self.characters.sorted_by(H_ILVL, reverse=True):
+            # checking if character is already known
+            char_index = g_indexes.get(char_key(r[H_SERVER], r[H_NAME]) + (r.get(H_ZONE, ""),))
+
+            if char_index is not None:
+                g_row = values[char_index]
+                for i, h in enumerate(headers):
+                    if (h in fieldnames) and (h in r) and r[h] and ((i >= len(g_row)) or (r[h] != g_row[i])):
+                        cell_id = "%s%d" % (column_letter(i), char_index+2)
+                        update_data.append({
+                            "values": [[r[h]]],
+                            "range": SUMMARY+"!%s:%s"%(cell_id, cell_id),
+                        })
+            else:
+                line = [(r[h] if h in r else None) for h in headers]
+                values.append(line)
+                row_index = len(values)+1
+                update_data.append({
+                    "values": [line],
+                    "range": sc.get_range(SUMMARY, 0, len(line)-1, row_index, row_index),
+                })
+                to_colorize.append((h_indexes[H_NAME], row_index, r.get_hex_color()))
+
+        if update_data:
+            sc.ensure_grid(SUMMARY, len(values)+1, len(headers))
+            sc.update_values(update_data)
+            for tc in to_colorize:
+                color = RGBColor.from_hex(tc[2])
+                sc.queue_background_color(SUMMARY, tc[0], tc[1], color)
+            sc.flush_formatting()
+        else:
+            print("Nothing to update")
+
+    def save_extra_google_sheets(self, google_sheet_id, dry_run, sheet_connector=None):
+        """Save level and ilvl in Google Sheets in separated Sheets. These
+        sheets have one column per character and one line per day: only the
+        headers, the dates and the columns of the fetched characters in the
+        last line are read and written.
+
+        Args:
+            google_sheet_id (str): the ID of the document
+            dry_run (bool): if True, do not modify the document
+            sheet_connector (SheetConnector): connector to reuse, a new one
+                                              is created if None
+        """
+        print("======================================================")
+        print("Synching ilvl/level in Google Sheets")
+
+        sc = sheet_connector or SheetConnector(google_sheet_id, dry_run, self.sheets_service, self.archive)
+        names = [char_column(r) for r in self.characters.sorted_by(H_NAME)]
+        sheets = [H_LVL, H_ILVL]
+        if not names:
+            print("Nothing to update")
+            return
+
+        update_data = []
+        today = strftime("%Y-%m-%d")
+
+        # reading the headers and the dates of all the sheets at once
+        index_ranges = self.get_extra_sheets_ranges(sc)
+        sc.get_multiple_values(index_ranges)
+        indexes = {}
+        for s, headers_range, dates_range in zip(sheets, index_ranges[::2], index_ranges[1::2]):
+            head_values = sc.get_values(headers_range)
+            dates = [d[0] if d else "" for d in sc.get_values(dates_range)]
+            headers = sc.ensure_headers(s, [H_DATE]+names, head_values[0] if head_values else [])
+            h_indexes = {h:i for i, h in enumerate(headers)}
+            if h_indexes[H_DATE] != 0:
+                dates = [(d[h_indexes[H_DATE]] if len(d) > h_indexes[H_DATE] else "")
+                         for d in sc.get_values(sc.get_range(s))]
+            dates = dates or [H_DATE]  # the headers were just added
+            indexes[s] = (h_indexes, dates)
+
+        # reading only the cells of the characters in the last lines, the
+        # columns not in the grid yet being empty (not added in dry-run mode)
+        windows = {}
+        for s in sheets:
+            h_indexes, dates = indexes[s]
+            if len(dates) <= 1:
+                continue
+            grid_columns = sc.get_grid_size(s)[1]
+            columns = [h_indexes[name] for name in names if h_indexes[name] < grid_columns]
+            if columns:
+                windows[s] = (min(columns), sc.get_range(s, min(columns), max(columns), len(dates), len(dates)))
+        last_lines = dict(zip(windows, sc.get_multiple_values([w[1] for w in windows.values()])))
+
+        for s in sheets:
+            v_dict = {char_column(r):r[s] for r in self.characters.sorted_by(H_NAME)}
+            h_indexes, dates = indexes[s]
+            update_needed = False
+            if (len(dates) <= 1) or (s not in windows):
+                update_needed = True
+            else:
+                first_col = windows[s][0]
+                last_line = last_lines[s][0] if last_lines[s] else []
+                for name in sorted(v_dict):
+                    h_i = h_indexes[name] - first_col
+                    if len(last_line) <= h_i:
+                        update_needed = True
+                        break
+                    new_v = int(v_dict[name])
+                    cur_v = last_line[h_i]
+                    if (not cur_v) or (int(cur_v) < new_v):
+                        update_needed = True
+                        break
+
+            if not update_needed:
+                continue
+
+            cells = {h_indexes[name]: v_dict[name] for name in v_dict}
+            cells[h_indexes[H_DATE]] = today
+
+            # Adding a new line if last date is not today, else updating the last one
+            line_nb = len(dates)
+            if (len(dates) <= 1) or (dates[-1] < today):
+                line_nb += 1
+            sc.ensure_grid(s, line_nb, max(cells)+1)
+            for first, values in split_in_column_runs(cells):
+                update_data.append({
+                    "values": [values],
+                    "range": sc.get_range(s, first, first+len(values)-1, line_nb, line_nb),
+                })
+
+        if update_data:
+            sc.update_values(update_data)
+        else:
+            print("Nothing to update")
+
+    def get_extra_sheets_ranges(self, sc):
+        """Get the ranges read first when saving level and ilvl in Google
+        Sheets, see save_extra_google_sheets()
+
+        Args:
+            sc (SheetConnector): connector to the document
+
+        Returns:
+            (str array) the header row and the date column of each sheet
+        """
+        ranges = []
+        for s in [H_LVL, H_ILVL]:
+            sc.check_or_create_sheet(s)
+            ranges += [sc.get_range(s, first_row=1, last_row=1), sc.get_range(s, 0, 0)]
+        return ranges
+
+
+class CharacterRegistry:
+    """Fetched characters, kept in insertion order in a ResultTable and
+    indexed by their normalized server and name (see char_key()), and by
+    their zone when tagged with it"""
+
+    def __init__(self, schema=None):
+        """Constructor
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters, a new one
+                                  is created if None
+        """
+        self.table = ResultTable(schema)
+        self.schema = self.table.schema
+        self.indexes = {}  # {char_key: row index}
+
+    def add(self, char, replace=False):
+        """Register a character
+
+        Args:
+            char (CharInfo): the character
+            replace (bool): replace the character if already registered,
+                            keeping its position
+
+        Returns:
+            (bool) False if the character was already registered and not replaced
+        """
+        key = char_key(char.server(), char.name()) + (char.get(H_ZONE),)
+        if key in self.indexes:
+            if not replace:
+                return False
+            self.table.set_row(self.indexes[key], char)
+        else:
+            self.indexes[key] = self.table.append(char)
+        return True
+
+    def remove(self, server, name, zone=None):
+        """Unregister a character
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+            zone (str): zone of the character, if tagged with it
+
+        Returns:
+            (bool) False if the character was not registered
+        """
+        index = self.indexes.pop(char_key(server, name) + (zone,), None)
+        if index is None:
+            return False
+        self.table.remove_row(index)
+        for key, i in self.indexes.items():
+            if i > index:
+                self.indexes[key] = i - 1
+        return True
+
+    def get(self, server, name, zone=None):
+        """Get a registered character
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+            zone (str): zone of the character, if tagged with it
+
+        Returns:
+            a RowView object or None if not registered
+        """
+        index = self.indexes.get(char_key(server, name) + (zone,))
+        return None if index is None else RowView(self.table, index)
+
+    def sorted_by(self, field, reverse=False):
+        """Get the characters sorted by a field
+
+        Args:
+            field (str): the field, numbers are sorted numerically
+            reverse (bool): sort in descending order
+
+        Returns:
+            (RowView array) the characters, in insertion order when equal
+        """
+        return [RowView(self.table, i) for i in self.table.sorted_indexes(field, reverse)]
+
+    def __contains__(self, char):
+        return char_key(char.server(), char.name()) + (char.get(H_ZONE),) in self.indexes
+
+    def __iter__(self):
+        return (RowView(self.table, i) for i in range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+
+_MISSING = object()  # value of the fields a character does not have
+
+
+class TableColumn:
+    """Column of a ResultTable. Integers, and strings holding canonical
+    integers such as the levels and item levels, are stored in a 64-bit
+    array. The column switches to a list of interned strings and objects
+    as soon as another value is stored."""
+
+    INT_MISSING = -2 ** 63
+    INT_PATTERN = re.compile(r"^(0|-?[1-9][0-9]{0,17})$")
+
+    def __init__(self, size, value):
+        """Constructor
+
+        Args:
+            size (int): number of rows, all missing
+            value: first value, deciding the type of the column
+        """
+        if isinstance(value, str) and self.INT_PATTERN.match(value):
+            self.kind = str
+        elif (type(value) is int) and (abs(value) < 2 ** 62):
+            self.kind = int
+        else:
+            self.kind = object
+        if self.kind is object:
+            self.data = [_MISSING] * size
+        else:
+            self.data = array('q', [self.INT_MISSING]) * size
+
+    def fits(self, value):
+        """Check if a value can be stored in the column without converting it
+
+        Args:
+            value: the value
+
+        Returns:
+            (bool) True if the value fits
+        """
+        if self.kind is str:
+            return isinstance(value, str) and bool(self.INT_PATTERN.match(value))
+        if self.kind is int:
+            return (type(value) is int) and (abs(value) < 2 ** 62)
+        return True
+
+    def append(self, value=_MISSING):
+        """Add a row
+
+        Args:
+            value: value of the row
+        """
+        self.data.append(self.INT_MISSING if self.kind is not object else _MISSING)
+        self.set(len(self.data) - 1, value)
+
+    def set(self, index, value):
+        """Set the value of a row
+
+        Args:
+            index (int): index of the row
+            value: the value, _MISSING to remove it
+        """
+        if (value is not _MISSING) and not self.fits(value):
+            self.data = [self.get(i) for i in range(len(self.data))]
+            self.kind = object
+        if self.kind is object:
+            self.data[index] = sys.intern(value) if type(value) is str else value
+        else:
+            self.data[index] = self.INT_MISSING if value is _MISSING else int(value)
+
+    def remove(self, index):
+        """Remove a row
+
+        Args:
+            index (int): index of the row
+        """
+        del self.data[index]
+
+    def get(self, index):
+        """Get the value of a row
+
+        Args:
+            index (int): index of the row
+
+        Returns:
+            the value, as stored in the character, or _MISSING
+        """
+        value = self.data[index]
+        if self.kind is object:
+            return value
+        if value == self.INT_MISSING:
+            return _MISSING
+        return str(value) if self.kind is str else value
+
+    def sort_key(self):
+        """Get the sort key of the rows
+
+        Returns:
+            a function giving the sort key of a row index
+        """
+        if self.kind is not object:
+            return self.data.__getitem__
+        return lambda i: (self.data[i] is not _MISSING, str(self.data[i]) if self.data[i] is not _MISSING else "")
+
+
+class ResultTable:
+    """Columnar storage of the characters: one TableColumn per field of a
+    shared FieldSchema, instead of one dictionary per character"""
+
+    def __init__(self, schema=None):
+        """Constructor
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters, a new one
+                                  is created if None
+        """
+        self.schema = schema if schema is not None else FieldSchema()
+        self.columns = {}  # {field: TableColumn}
+        self.size = 0
+
+    def append(self, char):
+        """Add a character
+
+        Args:
+            char (CharInfo): the character
+
+        Returns:
+            (int) index of the row
+        """
+        self.size += 1
+        for column in self.columns.values():
+            column.append()
+        self.set_row(self.size - 1, char)
+        return self.size - 1
+
+    def set_row(self, index, char):
+        """Set the values of a row
+
+        Args:
+            index (int): index of the row
+            char (CharInfo): the character
+        """
+        self.schema.update(char)
+        for field, column in self.columns.items():
+            column.set(index, char.get(field, _MISSING))
+        for field in char.keys():
+            if field not in self.columns:
+                column = self.columns[field] = TableColumn(self.size, char[field])
+                column.set(index, char[field])
+
+    def remove_row(self, index):
+        """Remove a row, the next rows being shifted
+
+        Args:
+            index (int): index of the row
+        """
+        for column in self.columns.values():
+            column.remove(index)
+        self.size -= 1
+
+    def get(self, index, field):
+        """Get a value
+
+        Args:
+            index (int): index of the row
+            field (str): the field
+
+        Returns:
+            the value, or _MISSING if the character does not have the field
+        """
+        column = self.columns.get(field)
+        return _MISSING if column is None else column.get(index)
+
+    def column_values(self, field):
+        """Iterate over the values of a field, skipping the missing ones
+
+        Args:
+            field (str): the field
+
+        Returns:
+            the values, in insertion order
+        """
+        column = self.columns.get(field)
+        if column is None:
+            return
+        for i in range(self.size):
+            value = column.get(i)
+            if value is not _MISSING:
+                yield value
+
+    def sorted_indexes(self, field, reverse=False):
+        """Sort the rows by a field, the rows without the field being the
+        lowest
+
+        Args:
+            field (str): the field
+            reverse (bool): sort in descending order
+
+        Returns:
+            (int array) the row indexes, in insertion order when equal
+        """
+        if field not in self.columns:
+            return list(range(self.size))
+        return sorted(range(self.size), key=self.columns[field].sort_key(), reverse=reverse)
+
+    def __len__(self):
+        return self.size
+
+
+class RowView(Mapping):
+    """Read-only view of a row of a ResultTable, with the accessors of CharInfo"""
+
+    __slots__ = ("table", "index")
+
+    server = CharInfo.server
+    name = CharInfo.name
+    classname = CharInfo.classname
+    level = CharInfo.level
+    ilevel = CharInfo.ilevel
+    get_hex_color = CharInfo.get_hex_color
+
+    def __init__(self, table, index):
+        """Constructor
+
+        Args:
+            table (ResultTable): the table
+            index (int): index of the row
+        """
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        value = self.table.get(self.index, field)
+        if value is _MISSING:
+            raise KeyError(field)
+        return value
+
+    def __iter__(self):
+        return (f for f in self.table.schema if self.table.get(self.index, f) is not _MISSING)
+
+    def __len__(self):
+        return sum(1 for f in self)
+
+
+class RefreshScheduler:
+    """Priority queue of the characters to refresh in daemon mode, ordered
+    by due date. The refresh interval of a character depends on its activity:
+    recently modified characters are refreshed often, idle characters and
+    alts rarely."""
+
+    def __init__(self):
+        """Constructor"""
+        self.heap = []     # [(due date, sequence, server, name)]
+        self.entries = {}  # {char_key: sequence of the valid entry in the heap}
+        self.sequence = itertools.count()
+
+    def schedule(self, server, name, due):
+        """Schedule the refresh of a character, replacing its previous schedule
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+            due (float): timestamp of the refresh
+        """
+        seq = next(self.sequence)
+        self.entries[char_key(server, name)] = seq
+        heapq.heappush(self.heap, (due, seq, server, name))
+
+    def unschedule(self, server, name):
+        """Stop refreshing a character
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+        """
+        self.entries.pop(char_key(server, name), None)
+
+    def is_scheduled(self, server, name):
+        """Check if a character is scheduled
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+        """
+        return char_key(server, name) in self.entries
+
+    def pop_due(self, now, max_count):
+        """Remove the characters to refresh now from the queue
+
+        Args:
+            now (float): current timestamp
+            max_count (int): maximum number of characters
+
+        Returns:
+            ((str, str) array) servers and names of the characters, the most
+            overdue first
+        """
+        due = []
+        while self.heap and (len(due) < max_count) and (self.heap[0][0] <= now):
+            _, seq, server, name = heapq.heappop(self.heap)
+            if self.entries.get(char_key(server, name)) == seq:
+                del self.entries[char_key(server, name)]
+                due.append((server, name))
+        return due
+
+    def next_due(self):
+        """Get the date of the next refresh
+
+        Returns:
+            (float) timestamp of the next refresh, infinite if none
+        """
+        while self.heap and (self.entries.get(char_key(self.heap[0][2], self.heap[0][3])) != self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else float("inf")
+
+    def get_interval(self, char):
+        """Compute the refresh interval of a character from its activity
+
+        Args:
+            char (CharInfo): the fetched character, None if it cannot be fetched
+
+        Returns:
+            (float) seconds before the next refresh
+        """
+        if char is None:
+            return DAEMON_RETRY_INTERVAL
+        if (H_LVL in char) and (int(char[H_LVL]) < DAEMON_ALT_LEVEL):
+            return DAEMON_IDLE_INTERVAL
+        if not char.last_modified:
+            return DAEMON_REFRESH_INTERVALS[-1][1]
+        age = time.time() - char.last_modified / 1000.
+        for modified_within, interval in DAEMON_REFRESH_INTERVALS:
+            if age < modified_within:
+                return interval
+        return DAEMON_IDLE_INTERVAL
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FieldSchema:
+    """Ordered fieldnames (headers) of the characters, growing as new fields
+    appear: the known fields keep their position"""
+
+    def __init__(self, fieldnames=(H_SERVER, H_NAME, H_CLASS, H_ILVL, H_LVL)):
+        """Constructor
+
+        Args:
+            fieldnames (str array): the first fieldnames
+        """
+        self.fieldnames = list(fieldnames)
+        self.known = set(fieldnames)
+
+    def update(self, char):
+        """Add the new fields of a character
+
+        Args:
+            char (CharInfo): the character
+
+        Returns:
+            (str array) the added fieldnames
+        """
+        added = [k for k in char.keys() if k not in self.known]
+        self.fieldnames += added
+        self.known.update(added)
+        return added
+
+    def __iter__(self):
+        return iter(self.fieldnames)
+
+    def __len__(self):
+        return len(self.fieldnames)
+
+
+class CsvSink:
+    """CSV output written as the characters are registered. The rows are
+    written with the fields known so far, the header and the shorter rows
+    are completed when closing the file if new fields appeared."""
+
+    def __init__(self, path, delimiter=';'):
+        """Constructor
+
+        Args:
+            path (str): path to the CSV file
+            delimiter (str): delimiter of the fields
+        """
+        self.path = path
+        self.delimiter = delimiter
+        self.file = open(path, 'w')
+        self.fieldnames = None  # fields of the written header
+        self.writer = None
+
+    def write(self, char, schema):
+        """Write a character
+
+        Args:
+            char (CharInfo): the character
+            schema (FieldSchema): fieldnames of the characters
+        """
+        if (self.writer is None) or (len(schema) > len(self.writer.fieldnames)):
+            self.writer = csv.DictWriter(self.file, fieldnames=list(schema), delimiter=self.delimiter)
+            if self.fieldnames is None:
+                self.writer.writeheader()
+                self.fieldnames = list(schema)
+        self.writer.writerow(char)
+        self.file.flush()
+
+    def close(self, schema):
+        """Close the file, completing the header and the rows if needed
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters
+        """
+        self.file.close()
+        if (self.fieldnames is None) or (len(schema) == len(self.fieldnames)):
+            return
+        with open(self.path) as csvfile:
+            rows = list(csv.reader(csvfile, delimiter=self.delimiter))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as csvfile:
+            writer = csv.writer(csvfile, delimiter=self.delimiter)
+            writer.writerow(list(schema))
+            for row in rows[1:]:
+                writer.writerow(row + [""] * (len(schema) - len(row)))
+        os.replace(tmp_path, self.path)
+
+
+class JsonLinesSink:
+    """JSON Lines output: one JSON object per character, written as the
+    characters are registered"""
+
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+            path (str or file): path to the file, '-' for the standard
+                                output, or an open file
+        """
+        self.owned = not (path == "-" or hasattr(path, "write"))
+        self.file = open(path, 'w') if self.owned else (sys.stdout if path == "-" else path)
+
+    def write(self, char, schema):
+        """Write a character
+
+        Args:
+            char (CharInfo): the character
+            schema (FieldSchema): fieldnames of the characters
+        """
+        self.file.write(json.dumps(char) + "\n")
+        self.file.flush()
+
+    def close(self, schema):
+        """Close the file
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters
+        """
+        if self.owned:
+            self.file.close()
+
+
+class StdoutSink:
+    """Print the characters as they are registered, the header being
+    printed again when new fields appear"""
+
+    def __init__(self):
+        """Constructor"""
+        self.fieldnames = []
+
+    def write(self, char, schema):
+        """Print a character
+
+        Args:
+            char (CharInfo): the character
+            schema (FieldSchema): fieldnames of the characters
+        """
+        if len(schema) != len(self.fieldnames):
+            self.fieldnames = list(schema)
+            print("# " + ", ".join(self.fieldnames))
+        print(", ".join([str(char.get(f, "")) for f in self.fieldnames]))
+        sys.stdout.flush()
+
+    def close(self, schema):
+        """Nothing to close
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters
+        """
+        pass
+
+
+class AsyncCharactersExtractor(CharactersExtractor):
+    """asyncio counterpart of CharactersExtractor: the API calls of all the
+    characters are multiplexed on the running event loop. The results
+    (characters and gear to fix) are the same as the synchronous extractor,
+    so the CSV and Google Sheets exports are inherited unchanged.
+
+    Requires the 'aiohttp' package. Usage:
+        async with AsyncCharactersExtractor(client_id, client_secret, "eu") as ace:
+            await ace.fetch_classes()
+            await ace.fetch_char("voljin:oxyde")
+    """
+
+    def __init__(self, client_id, client_secret, zone, max_in_flight=100,
+                 timeout=DEFAULT_TIMEOUT, single_request=False, item_cache=None,
+                 static_cache=None, token_store=None, char_states=None,
+                 rate_limiter=None, max_retries=MAX_RETRIES, api_host=None):
+        """Contructor. No request is sent before the extractor is opened.
+
+        Args:
+            client_id (str): Blizzard client ID
+            client_secret (str): Blizzard client secret
+            zone (str): Zone of the target guild and/or characters
+            max_in_flight (int): maximum number of simultaneous API calls
+            timeout (float or tuple): default timeout of the API calls, in
+                                      seconds: total or (connect, read)
+            single_request (bool): fetch all the info of a character with a
+                                   single API call
+            item_cache (ItemCache): persistent cache of the item descriptions
+            static_cache (StaticDataCache): cache of the classes and achievements
+            token_store (TokenStore): store of the access tokens
+            char_states (CharacterStateStore): characters of the previous runs
+            rate_limiter (RateLimiter): limiter of the API calls
+            max_retries (int): retries of the API calls failing with a
+                               transient error (429, 5xx, network errors)
+            api_host (str): base URL of the API and OAuth servers
+        """
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+        super().__init__(client_id, client_secret, zone, max_in_flight, timeout,
+                         single_request, item_cache, static_cache, token_store,
+                         char_states, rate_limiter, max_retries, api_host)
+        self.token_lock = None
+
+    def create_session(self, pool_size):
+        """The aiohttp session is created when opening the extractor
+
+        Returns:
+            None
+        """
+        return None
+
+    def create_single_flight(self, name, memoize=False):
+        """Create a coalescing of the identical API calls, see AsyncSingleFlight
+
+        Returns:
+            an AsyncSingleFlight object
+        """
+        return AsyncSingleFlight(name, memoize)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        """Open the HTTP session"""
+        import asyncio
+        import aiohttp
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        self.token_lock = asyncio.Lock()
+        if isinstance(self.timeout, tuple):
+            timeout = aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        else:
+            timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+            timeout=timeout)
+
+    async def close(self):
+        """Close the HTTP session"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def get_json(self, url_template, **params):
+        """Send a GET request to the API, see CharactersExtractor.get_json()"""
+        status, headers, data = await self.api_get(url_template, **params)
+        return data
+
+    async def api_get(self, url_template, headers=None, **params):
+        """Send a GET request to the API, see CharactersExtractor.api_get()
+
+        Returns:
+            (int, dict, dict) the status, the headers and the decoded JSON
+            body (None if empty) of the response
+        """
+        import asyncio
+        import aiohttp
+        endpoint = ENDPOINTS.get(url_template, "other")
+        token_renewed = False
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.rate_limiter.reserve())
+            access_token = await self.get_access_token()
+            url = url_template.format(api_host=self.api_host, access_token=access_token, **params)
+            logger.debug(url)
+            start = time.perf_counter()
+            try:
+                async with self.semaphore:
+                    start = time.perf_counter()  # not measuring the wait for the semaphore
+                    async with self.session.get(url, headers=headers) as r:
+                        body = await r.read()
+                        metrics.observe_request("blizzard", endpoint, r.status, time.perf_counter() - start,
+                                                len(body))
+                        if r.status == 401 and not token_renewed:
+                            logger.info("access token rejected, getting a new one")
+                            self.token_store.discard(self.zone, self.client_id, access_token)
+                            token_renewed = True
+                            continue
+                        if (r.status not in RETRY_STATUSES) or (attempt >= self.max_retries):
+                            r.raise_for_status()
+                            data = json.loads(body) if (r.status != 304 and body) else None
+                            return r.status, r.headers, data
+                        delay = retry_delay(attempt, r.headers.get("Retry-After"))
+                        if r.status == 429:
+                            self.rate_limiter.pause(delay)
+                        logger.warning("HTTP %d, retrying in %.1fs", r.status, delay)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                metrics.observe_request("blizzard", endpoint, None, time.perf_counter() - start)
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_delay(attempt)
+                logger.warning("%s, retrying in %.1fs", e, delay)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get_access_token(self):
+        """Get a valid access token, from the token store if possible
+
+        Returns:
+            (str) the access token
+        """
+        async with self.token_lock:
+            access_token = self.token_store.get(self.zone, self.client_id)
+            metrics.observe_cache("token", access_token is not None)
+            if access_token is None:
+                access_token, expires_in = await self.fetch_access_token()
+                self.token_store.put(self.zone, self.client_id, access_token, expires_in)
+        return access_token
+
+    async def fetch_access_token(self):
+        """Get a new auth token from Blizzard's OAuth API
+
+        Returns:
+            (str, int) the access token and its lifetime in seconds
+        """
+        import aiohttp
+        url = TOKEN_URL.format(oauth_host=self.oauth_host)
+        logger.debug(url)
+        start = time.perf_counter()
+        async with self.session.post(url, data={"grant_type": "client_credentials"},
+                                     auth=aiohttp.BasicAuth(self.client_id, self.client_secret)) as r:
+            body = await r.read()
+            metrics.observe_request("blizzard", "token", r.status, time.perf_counter() - start, len(body))
+            r.raise_for_status()
+            token_json = json.loads(body)
+        logger.debug("Got access token: %s", token_json["access_token"])
+        return token_json["access_token"], token_json.get("expires_in", DEFAULT_TOKEN_LIFETIME)
+
+    async def run(self, guild, chars, raid, csv_output, summary,
+                  check_gear, google_sheet_id, dry_run,
+                  default_server):
+        """main function, see CharactersExtractor.run()
+
+        The exports are run in the default executor to not block the loop.
+        """
+        import asyncio
+        if not self.session:
+            await self.open()
+        if csv_output:
+            self.add_sink(CsvSink(csv_output))
+        try:
+            with profiler.phase("static data"):
+                await self.fetch_achievements_details()
+                await self.fetch_classes()
+
+            with profiler.phase("guild roster"):
+                guild_chars = (await self.find_guild_characters(guild, default_server)) if guild else []
+            # the gear of the characters is checked concurrently: not measured apart
+            with profiler.phase("character fetch"):
+                await self.fetch_chars(guild_chars + chars, default_server, raid, check_gear)
+        finally:
+            with profiler.phase("outputs"):
+                self.close_sinks()
+
+        export = functools.partial(self.export_results, raid, None, summary,
+                                   check_gear, google_sheet_id, dry_run)
+        await asyncio.get_running_loop().run_in_executor(None, export)
+
+    async def find_guild_characters(self, serv_and_guildname, default_server=None):
+        """Find characters from given list, see CharactersExtractor.find_guild_characters()"""
+        print("======================================================")
+        print("Processing guild: '%s'" % serv_and_guildname)
+        server, name = split_server_and_name(serv_and_guildname, default_server)
+
+        return self.process_guild_members(await self.get_json(GUILD_URL, server=server, name=name, fields="members"))
+
+    async def fetch_char(self, serv_and_name, default_server=None, raid=False,
+                         check_gear=False):
+        """Fetch and register a character, see CharactersExtractor.fetch_char()"""
+        await self.fetch_chars([serv_and_name], default_server, raid, check_gear)
+
+    async def fetch_chars(self, servs_and_names, default_server=None, raid=False,
+                          check_gear=False):
+        """Fetch all the given characters at once and register them in the
+        given order, each one as soon as it and the previous ones are fetched
+
+        Args:
+            servs_and_names (str array): characters to fetch ("server:name")
+            default_server (string): default server if not given in 'servs_and_names'
+            raid (bool): Only keeps info that are usefull for raids (class, lvl, ilvl)
+            check_gear (bool): check gear for any missing gem or enchantment
+        """
+        import asyncio
+        to_fetch = self.get_chars_to_fetch(servs_and_names, default_server)
+        tasks = [asyncio.ensure_future(self.build_char(server, name, raid, check_gear))
+                 for server, name in to_fetch]
+        try:
+            for task in tasks:
+                char = await task
+                if char:
+                    self.register_char(char)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def build_char(self, server, name, raid=False, check_gear=False):
+        """Fetch a character without registering it, see CharactersExtractor.build_char()"""
+        import asyncio
+        import aiohttp
+        print("======================================================")
+        print("Processing: %s:%s" % (server, name))
+        char = CharInfo(server, name)
+        if self.load_previous_char(char, raid, check_gear):
+            return char.previous
+        try:
+            if self.single_request:
+                await self.fetch_char_profile(char, raid, check_gear)
+            elif raid:
+                await self.fetch_char_base(char, check_gear)
+            else:
+                # filling the base first, so the other requests are not sent
+                # if the character is not modified, then separated parts to
+                # keep the keys order of the synchronous extractor
+                await self.fetch_char_base(char, check_gear)
+                parts = [CharInfo(server, name) for i in range(2)]
+                await asyncio.gather(self.fetch_char_achievements(parts[0]),
+                                     self.fetch_char_professions(parts[1]))
+                for part in parts:
+                    char.update(part)
+        except NotModified:
+            logger.info("%s/%s not modified since last run", server, name)
+            return char.previous
+        except (ValueError, KeyError, aiohttp.ClientError, asyncio.TimeoutError):
+            logger.error("cannot fetch %s/%s", server, name)
+            self.failed.append("%s:%s" % (server, name))
+            return None
+        if self.char_states:
+            self.char_states.put(self.zone, char, self.get_fetch_signature(raid, check_gear))
+        return char
+
+    async def get_char_json(self, char, fields):
+        """Fetch the profile of a character, see CharactersExtractor.get_char_json()"""
+        data, char.validators = await self.char_requests.do(self.get_char_request_key(char, fields, True),
+                                                            self.request_char_json, char, fields)
+        return data
+
+    async def get_char_fields_json(self, char, fields):
+        """Fetch fields of the profile of a character, see
+        CharactersExtractor.get_char_fields_json()"""
+        return await self.char_requests.do(self.get_char_request_key(char, fields, False),
+                                           self.get_json, BASE_CHAR_URL, server=char.server(),
+                                           name=char.name(), fields=fields)
+
+    async def request_char_json(self, char, fields):
+        """Send the request of get_char_json(), see CharactersExtractor.request_char_json()"""
+        headers = {}
+        if char.previous and char.previous.validators:
+            etag, last_modified = char.previous.validators
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        status, r_headers, data = await self.api_get(BASE_CHAR_URL, headers=headers, server=char.server(), name=char.name(), fields=fields)
+        if headers:
+            metrics.observe_cache("character", status == 304)
+        if status == 304:
+            raise NotModified()
+        return data, (r_headers.get("ETag"), r_headers.get("Last-Modified"))
+
+    async def fetch_char_base(self, char, check_gear):
+        """Fetch and fill info for the given character: level + items related info
+
+        Args:
+            char (CharInfo): the character to fetch
+            check_gear (bool): check gear for any missing gem or enchantment
+        """
+        char_json = await self.get_char_json(char, "items")
+        items = self.process_char_base(char, char_json)
+        if check_gear:
+            await self.check_char_gear(char, items)
+
+    async def fetch_char_profile(self, char, raid, check_gear):
+        """Fetch and fill all the info of the character with a single request,
+        see CharactersExtractor.fetch_char_profile()"""
+        char_json = await self.get_char_json(char, ",".join(self.get_char_fields(raid)))
+        items = self.process_char_profile(char, char_json, raid)
+        if check_gear:
+            await self.check_char_gear(char, items)
+
+    async def check_char_gear(self, char, items):
+        """Check all the equipped items of the character at once and set its
+        gear to fix
+
+        Args:
+            char (CharInfo): the checked character
+            items (dict): the equipped items received from the API
+        """
+        import asyncio
+        slots = sorted(items)
+        checks = await asyncio.gather(*[self.check_item_enchants_and_gems(slot, items[slot])
+                                        for slot in slots])
+        self.set_gear_to_fix(char, [(slot, c[0], c[1]) for slot, c in zip(slots, checks)])
+
+    async def check_item_enchants_and_gems(self, slot, item_dict):
+        """Check any missing enchant or gem in the given item
+
+        Args:
+            slot (str): slot of the item (ex: head, back, shoulders, neck...)
+            item_dict (dict): incomplete description of the item received from
+                              the API
+
+        Returns:
+            (int, boolean): (number of empty gem slot, true is not enchanted)
+        """
+        item_key = self.get_item_key(slot, item_dict)
+        if item_key is None:
+            return 0, False
+        try:
+            return self.check_item(slot, item_dict, await self.get_item(item_key))
+        except ValueError:
+            logger.error("cannot get full item description for %s", item_dict["id"])
+        return 0, False
+
+    async def get_item(self, item_key):
+        """Get the full description of an item, see CharactersExtractor.get_item()"""
+        return await self.item_requests.do(item_key, self.load_item, item_key)
+
+    async def load_item(self, item_key):
+        """Get the full description of an item, from the item cache if possible
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item, see get_item_key()
+
+        Returns:
+            (dict) the full description of the item
+        """
+        item = self.item_cache.get(item_key) if self.item_cache else None
+        if self.item_cache:
+            metrics.observe_cache("item", item is not None)
+        if item is None:
+            item = await self.get_json(BASE_ITEM_URL, **self.get_item_params(item_key))
+            if self.item_cache:
+                self.item_cache.put(item_key, item)
+        return item
+
+    async def fetch_char_achievements(self, char):
+        """Fetch and fill achievements
+
+        Args:
+            char (CharInfo): the character to fetch
+        """
+        try:
+            obj = await self.get_char_fields_json(char, "achievements")
+        except ValueError:
+            logger.warn("cannot retrieve achievements for %s/%s", char.server(), char.name())
+            return
+        self.process_char_achievements(char, obj)
+
+    async def fetch_char_professions(self, char):
+        """Fetch and fill BfA professions
+
+        Args:
+            char (CharInfo): the character to fetch
+        """
+        try:
+            obj = await self.get_char_fields_json(char, "professions")
+        except ValueError:
+            logger.warn("cannot retrieve professions for %s/%s", char.server(), char.name())
+            return
+        self.process_char_professions(char, obj)
+
+    async def fetch_achievements_details(self):
+        """Fetch details for the achievements to check"""
+        import asyncio
+        print("======================================================")
+        print("Fetching achievements details")
+        for ach in await asyncio.gather(*[self.get_static_json("achievement/%d" % a_id, BASE_ACHIEV_URL, id=a_id)
+                                          for a_id in ACHIEVEMENTS]):
+            self.process_achievement_details(ach)
+
+    async def fetch_classes(self):
+        """Fetch the 'class id' to 'name' mapping"""
+        print("======================================================")
+        print("Fetching classes")
+        self.process_classes(await self.get_static_json("classes", CLASSES_URL))
+
+    async def get_static_json(self, key, url_template, **params):
+        """Get reference data, see CharactersExtractor.get_static_json()"""
+        data = self.static_cache.get(key) if self.static_cache else None
+        if self.static_cache:
+            metrics.observe_cache("static", data is not None)
+        if data is None:
+            data = await self.get_json(url_template, **params)
+            if self.static_cache:
+                self.static_cache.put(key, data)
+        return data
+
+
+class SingleFlight:
+    """Coalescing of identical calls shared by several threads: the first
+    caller of a key runs the call, the concurrent callers of the same key
+    wait for its result (or its exception) instead of running it again.
+    When memoizing, the results are also kept for the later callers, until
+    forgotten; the failures never are."""
+
+    def __init__(self, name, memoize=False):
+        """Constructor
+
+        Args:
+            name (str): name of the calls in the metrics, ex: "item (run)"
+            memoize (bool): keep the results for the later callers
+        """
+        self.name = name
+        self.memoize = memoize
+        self.lock = threading.Lock()
+        self.calls = {}  # {key: Future of the running (or memoized) call}
+
+    def do(self, key, function, *args, **kwargs):
+        """Call a function, unless an identical call is running or memoized
+
+        Args:
+            key: hashable identifier of the call
+            function: the function to call with 'args' and 'kwargs'
+
+        Returns:
+            the result of the function
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            owner = future is None
+            if owner:
+                future = self.calls[key] = Future()
+        metrics.observe_cache(self.name, not owner)
+        if not owner:
+            return future.result()
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            self.forget(key)
+            future.set_exception(e)
+            raise
+        if not self.memoize:
+            self.forget(key)
+        future.set_result(result)
+        return result
+
+    def forget(self, key):
+        """Forget a memoized result"""
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def clear(self):
+        """Forget all the memoized results"""
+        with self.lock:
+            self.calls = {}
+
+
+class AsyncSingleFlight(SingleFlight):
+    """asyncio counterpart of SingleFlight, for the coroutines of an event
+    loop"""
+
+    async def do(self, key, function, *args, **kwargs):
+        """Await a coroutine function, unless an identical call is running
+        or memoized, see SingleFlight.do()"""
+        import asyncio
+        future = self.calls.get(key)
+        owner = future is None
+        if owner:
+            future = self.calls[key] = asyncio.get_running_loop().create_future()
+        metrics.observe_cache(self.name, not owner)
+        if not owner:
+            return await asyncio.shield(future)
+        try:
+            result = await function(*args, **kwargs)
+        except BaseException as e:
+            self.forget(key)
+            future.set_exception(e)
+            future.exception()  # retrieved, even without any waiter
+            raise
+        if not self.memoize:
+            self.forget(key)
+        future.set_result(result)
+        return result
+
+
+class ItemCache:
+    """Persistent cache of the full item descriptions, stored in a SQLite
+    database. The description of an item only depends on its id, context and
+    bonus list, so it can be reused by all the characters and all the runs.
+    Can be used from several threads at once."""
+
+    def __init__(self, path, max_age=ITEM_CACHE_MAX_AGE * 24 * 3600,
+                 max_entries=ITEM_CACHE_MAX_ENTRIES):
+        """Constructor. Open (or create) the database and evict the outdated
+        entries.
+
+        Args:
+            path (str): path to the SQLite database
+            max_age (float): seconds before an entry is evicted
+            max_entries (int): maximum number of entries, the least recently
+                               used entries are evicted first
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.used = {}  # last use of the items read since the last commit: {item_key: timestamp}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS items ("
+                        "item_id INTEGER, context TEXT, bonus_list TEXT, "
+                        "data TEXT, fetched REAL, used REAL, "
+                        "PRIMARY KEY (item_id, context, bonus_list))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS items_used ON items (used)")
+        self.evict()
+
+    def get(self, item_key):
+        """Get a cached item description
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item
+
+        Returns:
+            (dict) the item description or None if not cached
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data FROM items WHERE item_id=? AND context=? AND bonus_list=? AND fetched>=?",
+                                  tuple(item_key) + (time.time() - self.max_age,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            # saved with the next commit, so that the reads do not wait for the disk
+            self.used[tuple(item_key)] = time.time()
+        return json.loads(row[0])
+
+    def put(self, item_key, item):
+        """Store an item description
+
+        Args:
+            item_key (tuple): (id, context, bonus list) of the item
+            item (dict): the item description received from the API
+        """
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)",
+                            tuple(item_key) + (json.dumps(item), now, now))
+            self.save_used()
+            self.db.commit()
+
+    def save_used(self):
+        """Save the last use of the items read since the last commit, the
+        lock being held"""
+        if self.used:
+            self.db.executemany("UPDATE items SET used=? WHERE item_id=? AND context=? AND bonus_list=?",
+                                [(used,) + key for key, used in self.used.items()])
+            self.used = {}
+
+    def evict(self):
+        """Remove the outdated entries and the least recently used ones when
+        the cache is too big"""
+        with self.lock:
+            self.save_used()
+            self.db.execute("DELETE FROM items WHERE fetched<?", (time.time() - self.max_age,))
+            self.db.execute("DELETE FROM items WHERE rowid IN (SELECT rowid FROM items ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                            (self.max_entries,))
+            self.db.commit()
+
+    def close(self):
+        """Evict the extra entries and close the database"""
+        self.evict()
+        self.db.close()
+
+
+class StaticDataCache:
+    """Cache of the reference data (classes, achievements...) stored in a JSON
+    file. These data only change with game patches."""
+
+    def __init__(self, path, ttl=STATIC_CACHE_TTL * 3600, refresh=False):
+        """Constructor
+
+        Args:
+            path (str): path to the JSON file
+            ttl (float): seconds before a cached entry is outdated
+            refresh (bool): ignore the cached entries (they are still updated)
+        """
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.entries = {}  # {key: {"fetched": timestamp, "data": data}}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            logger.info("no valid static data cache in %s", path)
+
+    def get(self, key):
+        """Get cached data
+
+        Args:
+            key (str): key of the data
+
+        Returns:
+            the data, or None if not cached or outdated
+        """
+        entry = self.entries.get(key)
+        if self.refresh or not entry or (entry["fetched"] + self.ttl < time.time()):
+            return None
+        logger.debug("using cached static data: %s", key)
+        return entry["data"]
+
+    def put(self, key, data):
+        """Store data and save the cache file
+
+        Args:
+            key (str): key of the data
+            data: the data to store (must be serializable in JSON)
+        """
+        with self.lock:
+            self.entries[key] = {"fetched": time.time(), "data": data}
+            save_json(self.path, self.entries)
+
+
+class NotModified(Exception):
+    """Raised when a conditional request reports that the resource is not
+    modified"""
+    pass
+
+
+class CharacterStateStore:
+    """Characters fetched by the previous incremental runs, with the info
+    needed to know if they are modified: the 'lastModified' of their profile
+    and the HTTP validators (ETag / Last-Modified). Stored in a SQLite
+    database, can be used from several threads at once."""
+
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+            path (str): path to the SQLite database
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS characters ("
+                        "zone TEXT, server TEXT, name TEXT, signature TEXT, "
+                        "last_modified INTEGER, etag TEXT, http_last_modified TEXT, "
+                        "data TEXT, to_fix TEXT, updated REAL, "
+                        "PRIMARY KEY (zone, server, name))")
+        self.db.commit()
+
+    def get(self, zone, server, name, signature):
+        """Get a character fetched by a previous run
+
+        Args:
+            zone (str): zone of the character
+            server (str): server of the character
+            name (str): name of the character
+            signature (str): description of the fetched info, see
+                             CharactersExtractor.get_fetch_signature()
+
+        Returns:
+            a CharInfo object, or None if unknown or fetched with another
+            signature
+        """
+        with self.lock:
+            row = self.db.execute("SELECT last_modified, etag, http_last_modified, data, to_fix "
+                                  "FROM characters WHERE zone=? AND server=? AND name=? AND signature=?",
+                                  (zone, server, name, signature)).fetchone()
+        if row is None:
+            return None
+        char = CharInfo(server, name)
+        char.update(json.loads(row[3]))
+        char.last_modified = row[0]
+        char.validators = (row[1], row[2])
+        char.to_fix = json.loads(row[4])
+        return char
+
+    def put(self, zone, char, signature):
+        """Store a fetched character
+
+        Args:
+            zone (str): zone of the character
+            char (CharInfo): the fetched character
+            signature (str): description of the fetched info, see
+                             CharactersExtractor.get_fetch_signature()
+        """
+        etag, http_last_modified = char.validators if char.validators else (None, None)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO characters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (zone, char.server(), char.name(), signature, char.last_modified,
+                             etag, http_last_modified, json.dumps(char), json.dumps(char.to_fix),
+                             time.time()))
+            self.db.commit()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+
+class HistoryStore:
+    """History of the fetched characters: a timestamped snapshot per
+    character each time it is fetched, stored in a SQLite database indexed by character
+    and date. Used as an output sink of CharactersExtractor."""
+
+    FIELDS = {H_LVL: "level", H_ILVL: "ilvl"}  # queryable fields: {field: column}
+
+    def __init__(self, path, zone, timestamp=None):
+        """Constructor
+
+        Args:
+            path (str): path to the SQLite database
+            zone (str): zone of the recorded characters, unless tagged with
+                        their zone
+            timestamp (float): date of the recorded snapshots, the time of
+                               each write if None
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.zone = zone
+        self.timestamp = timestamp
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                        "zone TEXT, server_key TEXT, name_key TEXT, fetched REAL, "
+                        "server TEXT, name TEXT, level INTEGER, ilvl INTEGER, data TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_char "
+                        "ON snapshots (zone, server_key, name_key, fetched)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS snapshots_fetched ON snapshots (zone, fetched)")
+        self.db.commit()
+
+    def write(self, char, schema=None):
+        """Record a snapshot of a character
+
+        Args:
+            char (CharInfo): the character
+            schema (FieldSchema): fieldnames of the characters
+        """
+        server_key, name_key = char_key(char.server(), char.name())
+        values = [char.get(f) for f in (H_LVL, H_ILVL)]
+        values = [int(v) if v not in (None, "") else None for v in values]
+        fetched = self.timestamp if self.timestamp is not None else time.time()
+        with self.lock:
+            self.db.execute("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (char.get(H_ZONE, self.zone), server_key, name_key, fetched, char.server(),
+                             char.name(), values[0], values[1], json.dumps(char)))
+            self.db.commit()
+
+    def trend(self, server, name, since=0):
+        """Get the snapshots of a character
+
+        Args:
+            server (str): server of the character
+            name (str): name of the character
+            since (float): timestamp of the oldest snapshot
+
+        Returns:
+            ((float, int, int) array) date, level and ilvl of each snapshot
+        """
+        server_key, name_key = char_key(server, name)
+        with self.lock:
+            return self.db.execute("SELECT fetched, level, ilvl FROM snapshots "
+                                   "WHERE zone=? AND server_key=? AND name_key=? AND fetched>=? "
+                                   "ORDER BY fetched", (self.zone, server_key, name_key, since)).fetchall()
+
+    def deltas(self, field, since):
+        """Get the progression of all the characters: the difference between
+        their last snapshot and their last snapshot before the period (or
+        their first one in the period)
+
+        Args:
+            field (str): the field, see HistoryStore.FIELDS
+            since (float): timestamp of the start of the period
+
+        Returns:
+            ((str, str, int, int, int) array) server, name, old value, new value
+            and difference, sorted by decreasing difference
+        """
+        column = self.FIELDS[field]
+        # SQLite returns the columns of the row holding the MAX()/MIN()
+        query = ("SELECT server_key, name_key, server, name, %s, {agg}(fetched) FROM snapshots "
+                 "WHERE zone=? AND {cond} AND %s IS NOT NULL GROUP BY server_key, name_key") % (column, column)
+        with self.lock:
+            last = self.db.execute(query.format(agg="MAX", cond="1"), (self.zone,)).fetchall()
+            before = self.db.execute(query.format(agg="MAX", cond="fetched<?"), (self.zone, since)).fetchall()
+            first = self.db.execute(query.format(agg="MIN", cond="fetched>=?"), (self.zone, since)).fetchall()
+        old = {r[:2]: r[4] for r in first}
+        old.update({r[:2]: r[4] for r in before})
+        deltas = [(r[2], r[3], old[r[:2]], r[4], r[4] - old[r[:2]]) for r in last if r[:2] in old]
+        return sorted(deltas, key=lambda d: d[4], reverse=True)
+
+    def close(self, schema=None):
+        """Close the database
+
+        Args:
+            schema (FieldSchema): fieldnames of the characters
+        """
+        self.db.close()
+
+
+class ApiArchive:
+    """Archive of the responses of the APIs, see --record and --replay. The
+    responses of Blizzard's API (URL, status, headers and body, stripped of
+    the access tokens) and the results of the Google Sheets API calls are
+    JSON lines of a gzip file in the archive's directory.
+
+    When replaying, the HTTP sessions of the extractors are served from the
+    archive, without any network call: for each request, the last recorded
+    response not asking for a retry. The Google Sheets calls are served the
+    first recorded result, the state of the document before any update."""
+
+    def __init__(self, directory, replay=False):
+        """Constructor
+
+        Args:
+            directory (str): directory of the archive
+            replay (bool): replay the archive, record a new one otherwise
+        """
+        self.path = os.path.join(directory, ARCHIVE_FILE)
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.responses = {}  # replayed responses: {(method, URL): record}
+        self.results = {}    # replayed Sheets results: {key: result}
+        self.file = None
+        if replay:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record["api"] == "sheets":
+                        self.results.setdefault(record["key"], record["result"])
+                        continue
+                    key = (record["method"], record["url"])
+                    if (record["status"] not in RETRY_STATUSES) or (key not in self.responses):
+                        self.responses[key] = record
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self.file = gzip.open(self.path, "wt", encoding="utf-8")
+
+    def attach(self, session):
+        """Record the responses received by an HTTP session, or serve its
+        requests from the archive when replaying
+
+        Args:
+            session (requests.Session): the session
+        """
+        if self.replay:
+            adapter = ReplayAdapter(self)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        else:
+            session.hooks["response"].append(self.record_response)
+
+    def sheets_service(self, service=None):
+        """Get a Google Sheets service recording the results of the calls
+        to 'service', or replaying them
+
+        Args:
+            service: Sheets v4 service, None when replaying
+
+        Returns:
+            an ArchivedSheetsService object
+        """
+        return ArchivedSheetsService(self, service)
+
+    def record_response(self, r, *args, **kwargs):
+        """Record a response, hook of requests"""
+        headers = {k: v for k, v in r.headers.items()
+                   if k.lower() not in ("content-encoding", "content-length", "transfer-encoding", "connection")}
+        body = re.sub(r'("access_token"\s*:\s*")[^"]*"', r'\1"', r.content.decode("utf-8", "replace"))
+        self.write({"api": "blizzard", "method": r.request.method, "url": strip_access_token(r.request.url),
+                    "status": r.status_code, "headers": headers, "body": body})
+
+    def record_result(self, key, result):
+        """Record the result of a Google Sheets call"""
+        self.write({"api": "sheets", "key": key, "result": result})
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+
+    def find_response(self, method, url):
+        """Find the replayed response of a request
+
+        Args:
+            method (str): HTTP method
+            url (str): URL of the request
+
+        Returns:
+            (dict) the recorded response, None if not recorded
+        """
+        return self.responses.get((method, strip_access_token(url)))
+
+    def find_result(self, key):
+        """Find the replayed result of a Google Sheets call
+
+        Raises:
+            LookupError: the call is not recorded
+        """
+        if key not in self.results:
+            raise LookupError("Google Sheets call not recorded in %s: %s" % (self.path, key))
+        return self.results[key]
+
+    def close(self):
+        """Close the archive"""
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """Transport adapter of requests serving the responses of an ApiArchive"""
+
+    def __init__(self, archive):
+        super().__init__()
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        record = self.archive.find_response(request.method, request.url)
+        if record is None and request.url.endswith("/oauth/token"):
+            # the recording run may have used a stored token
+            record = {"status": 200, "headers": {}, "body": '{"access_token": "replay", "expires_in": 86400}'}
+        elif record is None:
+            logger.warning("not recorded in %s: %s", self.archive.path, strip_access_token(request.url))
+            record = {"status": 404, "headers": {}, "body": '{"code": 404, "detail": "Not recorded"}'}
+        response = requests.models.Response()
+        response.request = request
+        response.url = request.url
+        response.status_code = record["status"]
+        response.reason = "Replayed"
+        response.headers = requests.structures.CaseInsensitiveDict(record["headers"])
+        response.encoding = "utf-8"
+        response._content = record["body"].encode("utf-8")
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+class ArchivedSheetsService:
+    """Proxy of a Google Sheets v4 service recording the results of its
+    calls in an ApiArchive, or replaying them without any service. Ex:
+    service.spreadsheets().values().get(...).execute()"""
+
+    def __init__(self, archive, service=None, path=()):
+        """Constructor
+
+        Args:
+            archive (ApiArchive): the archive
+            service: the proxied service (or resource), None when replaying
+            path (str tuple): names of the resources leading to 'service'
+        """
+        self.archive = archive
+        self.service = service
+        self.path = path
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            target = getattr(self.service, name)(**kwargs) if self.service is not None else None
+            if name in ("spreadsheets", "values"):
+                return ArchivedSheetsService(self.archive, target, self.path + (name,))
+            # same names as in the metrics, ex: "values.batchGet"
+            call_name = ".".join(self.path[1:] + (name,))
+            return ArchivedSheetsRequest(self.archive, call_name + " " + json.dumps(kwargs, sort_keys=True), target)
+        return call
+
+
+class ArchivedSheetsRequest:
+    """Request of ArchivedSheetsService"""
+
+    def __init__(self, archive, key, request=None):
+        self.archive = archive
+        self.key = key          # the call and its parameters
+        self.request = request  # the proxied request, None when replaying
+
+    def execute(self):
+        if self.archive.replay:
+            return self.archive.find_result(self.key)
+        result = self.request.execute()
+        self.archive.record_result(self.key, result)
+        return result
+
+
+def strip_access_token(url):
+    """Remove the value of the access token from a URL
+
+    Args:
+        url (str): the URL, ex: "https://eu.api.blizzard.com/wow/item/1?access_token=abc"
+
+    Returns:
+        (str) the stripped URL, ex: "https://eu.api.blizzard.com/wow/item/1?access_token="
+    """
+    return re.sub(r"access_token=[^&]*", "access_token=", url)
+
+
+class RateLimiter:
+    """Token bucket limiter of the API calls, shared by all the threads (or
+    coroutines) using it. Each limit is a bucket refilled continuously: a
+    call consumes a token of every bucket and has to wait when a bucket is
+    empty."""
+
+    def __init__(self, limits=API_RATE_LIMITS):
+        """Constructor
+
+        Args:
+            limits ((float, float) array): (number of calls, per seconds)
+        """
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        self.buckets = [{"capacity": calls, "rate": calls / period, "tokens": calls, "updated": now}
+                        for calls, period in limits]
+        self.paused_until = now
+
+    def reserve(self):
+        """Reserve a call
+
+        Returns:
+            (float) seconds to wait before sending the call
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0, self.paused_until - now)
+            for b in self.buckets:
+                b["tokens"] = min(b["capacity"], b["tokens"] + (now - b["updated"]) * b["rate"])
+                b["updated"] = now
+                b["tokens"] -= 1
+                if b["tokens"] < 0:
+                    wait = max(wait, -b["tokens"] / b["rate"])
+        return wait
+
+    def pause(self, delay):
+        """Delay all the next calls, when the API reports that the quota is
+        exceeded
+
+        Args:
+            delay (float): seconds to wait
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+def retry_delay(attempt, retry_after=None):
+    """Compute the delay before retrying a failed API call: a jittered
+    exponential backoff, or the delay requested by the server if longer
+
+    Args:
+        attempt (int): number of the failed attempt (from 0)
+        retry_after (str): value of the Retry-After header, if any
+
+    Returns:
+        (float) the delay in seconds
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BACKOFF * (2 ** attempt)))
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            try:
+                delay = max(delay, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                logger.warning("invalid Retry-After header: %s", retry_after)
+    return delay
+
+
+class RequestStats:
+    """Calls, statuses, response bytes and latency histogram of an endpoint"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0                # error statuses and network errors
+        self.statuses = {}             # {status or "error": count}
+        self.bytes = 0                 # size of the response bodies
+        self.latency_sum = 0.0
+        self.latency_min = 0.0
+        self.latency_max = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # calls per latency bucket, the last one is +Inf
+
+    def observe(self, status, elapsed, size):
+        """Record a call, see Metrics.observe_request()"""
+        self.calls += 1
+        key = status if status is not None else "error"
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if status is None or status >= 400:
+            self.errors += 1
+        self.bytes += size
+        self.latency_sum += elapsed
+        self.latency_min = min(self.latency_min, elapsed) if self.calls > 1 else elapsed
+        self.latency_max = max(self.latency_max, elapsed)
+        i = 0
+        while i < len(LATENCY_BUCKETS) and elapsed > LATENCY_BUCKETS[i]:
+            i += 1
+        self.buckets[i] += 1
+
+    def quantile(self, q):
+        """Estimate a quantile of the latency from the histogram, by linear
+        interpolation within its bucket, narrowed to the observed latencies
+
+        Args:
+            q (float): the quantile, ex: 0.95
+
+        Returns:
+            (float) the latency in seconds
+        """
+        rank = q * self.calls
+        count = 0
+        for i, n in enumerate(self.buckets):
+            if n and count + n >= rank:
+                if i == len(LATENCY_BUCKETS):
+                    return self.latency_max
+                low = max(LATENCY_BUCKETS[i - 1] if i else 0, self.latency_min)
+                high = min(LATENCY_BUCKETS[i], self.latency_max)
+                return low + (high - low) * max(0, rank - count) / n
+            count += n
+        return 0.0
+
+    def to_dict(self):
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "statuses": {str(k): v for k, v in self.statuses.items()},
+                "bytes": self.bytes,
+                "latency_sum": self.latency_sum,
+                "latency_max": self.latency_max,
+                "latency_p50": self.quantile(0.5),
+                "latency_p95": self.quantile(0.95),
+                "latency_buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.buckets))}
+
+
+class Metrics:
+    """Metrics of the API calls and of the caches, shared by all the
+    threads (or coroutines): the calls are recorded per API ("blizzard" or
+    "sheets") and endpoint (see ENDPOINTS, or the Sheets API call), the
+    lookups per cache ("item", "static", "token", "character")"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # {(api, endpoint): RequestStats}
+        self.caches = {}    # {cache: [hits, misses]}
+
+    def reset(self):
+        """Forget all the recorded metrics"""
+        with self.lock:
+            self.requests = {}
+            self.caches = {}
+
+    def observe_request(self, api, endpoint, status, elapsed, size=0):
+        """Record an API call
+
+        Args:
+            api (str): called API, "blizzard" or "sheets"
+            endpoint (str): name of the endpoint, ex: "item"
+            status (int): HTTP status, None for network errors
+            elapsed (float): latency of the call in seconds
+            size (int): size of the response body in bytes, 0 if unknown
+        """
+        with self.lock:
+            stats = self.requests.get((api, endpoint))
+            if stats is None:
+                stats = self.requests[(api, endpoint)] = RequestStats()
+            stats.observe(status, elapsed, size)
+
+    def observe_cache(self, cache, hit):
+        """Record a cache lookup
+
+        Args:
+            cache (str): name of the cache, ex: "item"
+            hit (bool): True if found in the cache
+        """
+        with self.lock:
+            counts = self.caches.setdefault(cache, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def to_dict(self):
+        """Get the metrics, to save them as JSON
+
+        Returns:
+            (dict) {"requests": {api: {endpoint: stats}}, "caches": {cache: counts}}
+        """
+        with self.lock:
+            apis = {}
+            for (api, endpoint), stats in sorted(self.requests.items()):
+                apis.setdefault(api, {})[endpoint] = stats.to_dict()
+            caches = {cache: {"hits": hits, "misses": misses,
+                              "hit_ratio": hits / (hits + misses) if hits + misses else None}
+                      for cache, (hits, misses) in sorted(self.caches.items())}
+        return {"requests": apis, "caches": caches}
+
+    def to_prometheus(self):
+        """Format the metrics in Prometheus' text exposition format
+
+        Returns:
+            (str) the metrics
+        """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP wowchars_%s %s" % (name, help_text))
+            lines.append("# TYPE wowchars_%s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("wowchars_%s%s{%s} %s" % (name, suffix, ",".join(['%s="%s"' % l for l in labels]),
+                                                       repr(value)))
+
+        with self.lock:
+            endpoints = sorted(self.requests.items())
+            caches = sorted(self.caches.items())
+            metric("api_requests_total", "counter", "API calls by status",
+                   [("", (("api", api), ("endpoint", endpoint), ("status", status)), n)
+                    for (api, endpoint), stats in endpoints
+                    for status, n in sorted(stats.statuses.items(), key=str)])
+            metric("api_response_bytes_total", "counter", "Size of the API responses",
+                   [("", (("api", api), ("endpoint", endpoint)), stats.bytes) for (api, endpoint), stats in endpoints])
+            samples = []
+            for (api, endpoint), stats in endpoints:
+                labels = (("api", api), ("endpoint", endpoint))
+                cumulated = itertools.accumulate(stats.buckets)
+                for bound, count in zip([repr(float(b)) for b in LATENCY_BUCKETS] + ["+Inf"], cumulated):
+                    samples.append(("_bucket", labels + (("le", bound),), count))
+                samples.append(("_sum", labels, stats.latency_sum))
+                samples.append(("_count", labels, stats.calls))
+            metric("api_request_duration_seconds", "histogram", "Latency of the API calls", samples)
+            metric("cache_hits_total", "counter", "Lookups found in the caches",
+                   [("", (("cache", cache),), hits) for cache, (hits, misses) in caches])
+            metric("cache_misses_total", "counter", "Lookups not found in the caches",
+                   [("", (("cache", cache),), misses) for cache, (hits, misses) in caches])
+        return "\n".join(lines) + "\n"
+
+    def display(self):
+        """Print a summary table of the metrics"""
+        data = self.to_dict()
+        print("======================================================")
+        print("%-8s %-20s %7s %6s %10s %9s %9s %9s %9s" % ("API", "endpoint", "calls", "errors", "KB",
+                                                          "avg (ms)", "p50 (ms)", "p95 (ms)", "total (s)"))
+        for api, endpoints in data["requests"].items():
+            for endpoint, stats in endpoints.items():
+                print("%-8s %-20s %7d %6d %10.1f %9.1f %9.1f %9.1f %9.2f" % (
+                    api, endpoint, stats["calls"], stats["errors"], stats["bytes"] / 1024,
+                    stats["latency_sum"] * 1000 / stats["calls"], stats["latency_p50"] * 1000,
+                    stats["latency_p95"] * 1000, stats["latency_sum"]))
+        for cache, counts in data["caches"].items():
+            print("%s cache: %d hit(s), %d miss(es), %.1f%% hit ratio" % (
+                cache.capitalize(), counts["hits"], counts["misses"], 100 * (counts["hit_ratio"] or 0)))
+
+
+metrics = Metrics()  # metrics of the process, see --stats
+
+
+class Profiler:
+    """Per-phase profiling of a run, see --profile: the wall time, the CPU
+    time (of the whole process) and the peak of the memory allocated by
+    Python (tracemalloc) of each phase, and optionally a cProfile dump per
+    phase. Until enabled, the phases are no-ops.
+
+    The phases entered while another one is running (ex: "gear check", run
+    by the threads fetching the characters) are sub-phases: their wall time
+    and the CPU time of their thread are summed over their calls, and their
+    memory is not measured."""
+
+    def __init__(self):
+        self.enabled = False
+        self.pstats_dir = None
+        self.lock = threading.Lock()
+        self.phases = {}       # {name: stats}, in the order of their first call
+        self.running = None    # name of the running phase (not sub-phase)
+        self.local = threading.local()  # 'profiling': cProfile is enabled in the thread
+
+    def enable(self, pstats_dir=None):
+        """Enable the profiling
+
+        Args:
+            pstats_dir (str): directory of the cProfile dumps (see
+                              dump_stats()), no dump if None
+        """
+        if pstats_dir:
+            os.makedirs(pstats_dir, exist_ok=True)
+        self.pstats_dir = pstats_dir
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Context manager measuring a phase, or a sub-phase if another
+        phase is running
 
-    def save_csv(self, output_file):
-        """Save the results in a CSV file
+        Args:
+            name (str): name of the phase, ex: "character fetch"
+        """
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            top = self.running is None
+            if top:
+                self.running = name
+            stats = self.phases.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_memory": None,
+                                                  "sub_phase": not top, "pstats": None})
+        if top:
+            tracemalloc.reset_peak()
+        cpu_clock = time.process_time if top else time.thread_time
+        start, start_cpu = time.perf_counter(), cpu_clock()
+        try:
+            with self.profiling(name):
+                yield
+        finally:
+            wall, cpu = time.perf_counter() - start, cpu_clock() - start_cpu
+            with self.lock:
+                stats["calls"] += 1
+                stats["wall"] += wall
+                stats["cpu"] += cpu
+                if top:
+                    stats["peak_memory"] = max(stats["peak_memory"] or 0, tracemalloc.get_traced_memory()[1])
+                    self.running = None
+
+    @contextlib.contextmanager
+    def profiling(self, name=None):
+        """Context manager running cProfile in the current thread, unless
+        already running, when dumping the profiles.
+
+        Since Python 3.12, cProfile relies on sys.monitoring: a single
+        profiler can run in the process, and it profiles all the threads.
+        The worker threads are then profiled by the profiler of the phase,
+        running in the main thread.
 
         Args:
-            output_file (str): path to the CSV file
+            name (str): phase of the profile, the running phase if None
         """
-        with open(output_file, 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=self.get_ordered_fieldnames(), delimiter=';')
-            writer.writeheader()
-            for r in self.characters:
-                writer.writerow(r)
+        name = name or self.running
+        if (not (self.enabled and self.pstats_dir and name) or getattr(self.local, "profiling", False)
+                or profiling_tool_active()):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another thread started its profiler since the check
+            yield
+            return
+        self.local.profiling = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.local.profiling = False
+            with self.lock:
+                stats = self.phases[name]
+                if stats["pstats"] is None:
+                    stats["pstats"] = pstats.Stats(profile)
+                else:
+                    stats["pstats"].add(profile)
 
-    def get_ordered_fieldnames(self):
-        """Sort the fieldnames (headers) in a specific order
+    def call(self, function, *args):
+        """Call a function in a worker thread, profiled with cProfile as part
+        of the running phase
 
-        Returns;
-            (str array) the ordered headers
+        Returns:
+            the result of the function
         """
-        fieldnames = [H_SERVER, H_NAME, H_CLASS, H_ILVL, H_LVL]
-        for c in self.characters:
-            for k in c.keys():
-                if k not in fieldnames:
-                    fieldnames.append(k)
-        return fieldnames
+        if not self.enabled:
+            return function(*args)
+        with self.profiling():
+            return function(*args)
 
-    def display_summary(self):
-        """Print a summary of the results"""
+    def display(self):
+        """Print the measures of the phases"""
         print("======================================================")
-        print("Fetched %d character(s)" % len(self.characters))
-        fieldnames = self.get_ordered_fieldnames()
-        # computing width of each column
-        widths = {f:len(f) for f in fieldnames}
-        for f in fieldnames:
-            for char in self.characters:
-                if f in char:
-                    widths[f] = max(widths[f], len(str(char[f])))
+        print("%-22s %7s %10s %10s %16s" % ("phase", "calls", "wall (s)", "CPU (s)", "peak memory (MB)"))
+        with self.lock:
+            for name, stats in self.phases.items():
+                print("%-22s %7d %10.3f %10.3f %16s" % (("  " + name) if stats["sub_phase"] else name,
+                                                        stats["calls"], stats["wall"], stats["cpu"],
+                                                        "%.1f" % (stats["peak_memory"] / 2 ** 20)
+                                                        if stats["peak_memory"] is not None else "-"))
+
+    def dump_stats(self):
+        """Save the cProfile stats of each phase in the pstats directory, ex:
+        "03-character_fetch.pstats", to be read with the pstats module
 
-        # printing fieldnames
-        line = []
-        for f in fieldnames:
-            v = "%-" + str(widths[f]) + "s"
-            line.append(v % f)
-        print((", ").join(line))
+        Returns:
+            (str array) the saved files
+        """
+        files = []
+        if not self.pstats_dir:
+            return files
+        with self.lock:
+            for i, (name, stats) in enumerate(self.phases.items()):
+                if stats["pstats"] is None:
+                    continue
+                path = os.path.join(self.pstats_dir, "%02d-%s.pstats" % (i + 1, name.replace(" ", "_")))
+                stats["pstats"].dump_stats(path)
+                files.append(path)
+        return files
 
-        # printing rows
-        for char in sorted(self.characters, key=lambda x:x[H_ILVL], reverse=True):
-            line = []
-            for f in fieldnames:
-                v = "%-" + str(widths[f]) + "s"
-                line.append(v % (char[f] if (f in char) else ""))
-            print((", ").join(line))
 
-    def display_gear_to_fix(self):
-        """Display gear to fix: missing gems or enchantments"""
-        print("======================================================")
-        print("/!\\ %d character(s) to fix!" % len(self.to_fix))
-        for c in self.to_fix:
-            print("%s: %s" % (c, ", ".join(self.to_fix[c])))
-        print("---------------------------")
-        to_create = {}
-        for c in self.to_fix:
-            for tc in self.to_fix[c]:
-                if tc not in to_create:
-                    to_create[tc] = [1, set()]
-                else:
-                    to_create[tc][0] += 1
-                to_create[tc][1].add(c)
+profiler = Profiler()  # profiler of the process, see --profile
 
-        for tc in sorted(to_create):
-            print("%s: %s %s" % (tc, to_create[tc][0], to_create[tc][1]))
 
-    def save_summary_in_google_sheets(self, google_sheet_id, dry_run):
-        """Save summary in Google Sheets
+def profiling_tool_active():
+    """Check if a profiler runs for the whole process (Python 3.12+), so
+    no other can be enabled
 
-        Args:
-            google_sheet_id (str): the ID of the document
-            dry_run (bool): if True, do not modify the document
-        """
-        print("======================================================")
-        print("Synching summary in Google Sheets")
+    Returns:
+        (bool) True if a profiler is active
+    """
+    monitoring = getattr(sys, "monitoring", None)
+    return monitoring is not None and monitoring.get_tool(monitoring.PROFILER_ID) is not None
 
-        SUMMARY = "summary"
 
-        sc = SheetConnector(google_sheet_id, dry_run)
-        sc.check_or_create_sheet(SUMMARY)
-        fieldnames = self.get_ordered_fieldnames()
-        sc.ensure_headers(SUMMARY, fieldnames)
+class TokenStore:
+    """Store of the OAuth access tokens, per zone and client ID, optionally
+    saved in a JSON file to be reused by the next runs. A token is considered
+    as expired a bit before its actual expiry, so it is renewed before being
+    rejected by the API."""
 
-        sheet_values = sc.get_values(SUMMARY+"!A:Z")
-        headers = sheet_values[0]
-        h_indexes = {h: i for i, h in enumerate(headers)}
-        values = sheet_values[1:]
+    def __init__(self, path=None, margin=TOKEN_REFRESH_MARGIN):
+        """Constructor
 
-        update_data = []  # cell values to update
-        to_colorize = []  # cells to colorize (when adding new character(s))
+        Args:
+            path (str): path to the JSON file, tokens are only kept in memory
+                        if None
+            margin (float): seconds before the expiry when a token is renewed
+        """
+        self.path = path
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.tokens = {}  # {"zone:client_id": {"access_token": token, "expires": timestamp}}
+        if path:
+            try:
+                with open(path) as f:
+                    self.tokens = json.load(f)
+            except (IOError, ValueError):
+                logger.info("no valid token store in %s", path)
 
-        # updating / adding characters info
-        for r in sorted(self.characters, key=lambda x: x[H_ILVL], reverse=True):
-            char_index = None
-            # checking if character is already known
-            for i, g_line in enumerate(values):
-                if g_line[h_indexes[H_SERVER]] == r[H_SERVER] and g_line[h_indexes[H_NAME]] == r[H_NAME]:
-                    char_index = i
-                    break
+    def get(self, zone, client_id):
+        """Get a stored token
 
-            if char_index is not None:
-                g_row = values[char_index]
-                for i, h in enumerate(headers):
-                    if (h in fieldnames) and (h in r) and r[h] and ((i >= len(g_row)) or (r[h] != g_row[i])):
-                        cell_id = "%s%d" % (column_letter(i), char_index+2)
-                        update_data.append({
-                            "values": [[r[h]]],
-                            "range": SUMMARY+"!%s:%s"%(cell_id, cell_id),
-                        })
-            else:
-                line = [(r[h] if h in r else None) for h in headers]
-                values.append(line)
-                row_index = len(values)+1
-                update_data.append({
-                    "values": [line],
-                    "range": SUMMARY+"!A{row}:Z{row}".format(row=row_index),
-                })
-                to_colorize.append((h_indexes[H_NAME], row_index, r.get_hex_color()))
+        Args:
+            zone (str): zone of the token
+            client_id (str): Blizzard client ID
 
-        if update_data:
-            sc.update_values(update_data)
-            for tc in to_colorize:
-                color = RGBColor.from_hex(tc[2])
-                column = column_letter(tc[0])
-                sc.set_background_color(SUMMARY, column, tc[1], color)
-        else:
-            print("Nothing to update")
+        Returns:
+            (str) the access token, or None if unknown or about to expire
+        """
+        entry = self.tokens.get("%s:%s" % (zone, client_id))
+        if not entry or (entry["expires"] - self.margin < time.time()):
+            return None
+        return entry["access_token"]
 
-    def save_extra_google_sheets(self, google_sheet_id, dry_run):
-        """Save level and ilvl in Google Sheets in separated Sheets
+    def put(self, zone, client_id, access_token, expires_in):
+        """Store a token
 
         Args:
-            google_sheet_id (str): the ID of the document
-            dry_run (bool): if True, do not modify the document
+            zone (str): zone of the token
+            client_id (str): Blizzard client ID
+            access_token (str): the token
+            expires_in (float): lifetime of the token in seconds
         """
-        print("======================================================")
-        print("Synching ilvl/level in Google Sheets")
-
-        sc = SheetConnector(google_sheet_id, dry_run)
-        names = [r[H_NAME] for r in sorted(self.characters, key=lambda x:x[H_NAME])]
+        with self.lock:
+            self.tokens["%s:%s" % (zone, client_id)] = {"access_token": access_token,
+                                                        "expires": time.time() + expires_in}
+            self.save()
 
-        update_data = []
-        today = strftime("%Y-%m-%d")
+    def discard(self, zone, client_id, access_token):
+        """Remove a rejected token, unless it was already replaced
 
-        for s in [H_LVL, H_ILVL]:
-            v_dict = {r[H_NAME]:r[s] for r in sorted(self.characters, key=lambda x:x[H_NAME])}
-            sc.ensure_headers(s, [H_DATE]+names)
-            sheet_values = sc.get_values("%s!A:Z"%s)
-            headers = sheet_values[0]
-            h_indexes = {h:i for i, h in enumerate(headers)}
-            update_needed = False
-            last_update_today = (len(sheet_values) > 1) and (sheet_values[-1][h_indexes[H_DATE]] == today)
-            if len(sheet_values) <= 1:
-                update_needed = True
-            else:
-                values = sheet_values[1:]
-                last_line = values[-1]
-                for name in sorted(v_dict):
-                    h_i = h_indexes[name]
-                    if len(last_line) <= h_i:
-                        update_needed = True
-                        break
-                    new_v = int(v_dict[name])
-                    cur_v = last_line[h_i]
-                    if (not cur_v) or (int(cur_v) < new_v):
-                        update_needed = True
-                        break
+        Args:
+            zone (str): zone of the token
+            client_id (str): Blizzard client ID
+            access_token (str): the rejected token
+        """
+        with self.lock:
+            key = "%s:%s" % (zone, client_id)
+            if key in self.tokens and self.tokens[key]["access_token"] == access_token:
+                del self.tokens[key]
+                self.save()
 
-            if not update_needed:
-                continue
+    def save(self):
+        """Save the tokens in the JSON file, readable only by the user"""
+        if self.path:
+            save_json(self.path, self.tokens)
 
-            line = values[-1] if last_update_today else ([None] * len(headers))
-            for i, h in enumerate(headers):
-                if h in v_dict:
-                    if len(line) <= i:
-                        line += [None] * (i+1-len(line))
-                    line[i] = v_dict[h]
-            line[h_indexes[H_DATE]] = today
 
-            # Adding a new line if last date is not today, else updating the last one
-            line_nb = len(sheet_values)
-            if (len(sheet_values) <= 1) or (sheet_values[-1][h_indexes[H_DATE]] < today):
-                line_nb += 1
-            update_data.append({
-                "values": [line],
-                "range": "%s!A%d:Z%d" % (s, line_nb, line_nb),
-            })
+def save_json(path, data):
+    """Save data in a JSON file readable only by the user. The data are
+    written in a unique temporary file, then renamed, so processes sharing
+    the file never read a partial file nor overwrite their temporary files.
 
-        if update_data:
-            sc.update_values(update_data)
-        else:
-            print("Nothing to update")
+    Args:
+        path (str): path to the JSON file
+        data: the data (must be serializable in JSON)
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory or ".", prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 def set_logger(verbosity):
@@ -830,6 +4152,87 @@ def set_logger(verbosity):
     # logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.WARNING - (self.args.verbosity * 10))
 
 
+def split_server_and_name(serv_and_name, default_server=None):
+    """Split a "server:name" string. Using only the name is supported but
+    will produce a warning.
+
+    Args:
+        serv_and_name (str): server and name, ex: "voljin:oxyde"
+        default_server (str): server used when not given in 'serv_and_name'
+
+    Returns:
+        (str, str) the server and the name
+    """
+    try:
+        server, name = serv_and_name.split(":")
+    except ValueError:
+        if default_server:
+            logger.info("no server name, using default server '%s'", default_server)
+            server = default_server
+        else:
+            logger.warn("no server name, using default server 'voljin'")
+            server = "voljin"
+        name = serv_and_name
+    return server, name
+
+
+def normalize_server(server):
+    """Normalize a server name into its slug, ex: "Vol'jin" -> "voljin",
+    "Chants éternels" -> "chants-eternels"
+
+    Args:
+        server (str): name or slug of the server
+
+    Returns:
+        (str) the slug of the server
+    """
+    slug = unicodedata.normalize("NFKD", server)
+    slug = "".join([c for c in slug if not unicodedata.combining(c)])
+    slug = slug.lower().replace("'", "").strip()
+    return "-".join(slug.split())
+
+
+def char_key(server, name):
+    """Build the key identifying a character, whatever the casing of its name
+    and the form of its server (name or slug)
+
+    Args:
+        server (str): server of the character
+        name (str): name of the character
+
+    Returns:
+        (str, str) the key
+    """
+    return normalize_server(server), unicodedata.normalize("NFC", name).casefold()
+
+
+def char_label(char):
+    """Get the label of a character in the gear report: its name and its
+    server, and its zone when tagged with it (see run_batch())
+
+    Args:
+        char (CharInfo or RowView): the character
+
+    Returns:
+        (str) the label, ex: "Oxyde-voljin" or "Oxyde-hyjal (us)"
+    """
+    label = "%s-%s" % (char.name(), char.server())
+    return "%s (%s)" % (label, char[H_ZONE]) if char.get(H_ZONE) else label
+
+
+def char_column(char):
+    """Get the header of the column of a character in the level and ilvl
+    sheets: its name, and its zone when tagged with it (see run_batch())
+
+    Args:
+        char (CharInfo or RowView): the character
+
+    Returns:
+        (str) the header, ex: "Oxyde" or "Oxyde (us)"
+    """
+    return "%s (%s)" % (char[H_NAME], char[H_ZONE]) if char.get(H_ZONE) else char[H_NAME]
+
+
 def column_letter(index):
     """In Sheets the columns are identified by letters, not integers.
     This function translates the column index into letter(s).
@@ -851,6 +4254,25 @@ def column_letter(index):
     return res
 
 
+def split_in_column_runs(cells):
+    """Split cells of a row into runs of contiguous columns, to write them
+    without touching the other columns
+
+    Args:
+        cells (dict): keys are column indexes, values are the cell values
+
+    Returns:
+        (array) the runs: [(first column index, [values])]
+    """
+    runs = []
+    for col in sorted(cells):
+        if runs and (runs[-1][0] + len(runs[-1][1]) == col):
+            runs[-1][1].append(cells[col])
+        else:
+            runs.append((col, [cells[col]]))
+    return runs
+
+
 def column_index(column_str):
     """In Sheets the columns are identified by letters, not integers.
     This function translates the column string into an integer index.
@@ -959,23 +4381,37 @@ APPLICATION_NAME = 'wowchars'
 
 class SheetConnector:
     """Helper class to use Google Sheets"""
-    def __init__(self, sheet_id, dry_run):
+    def __init__(self, sheet_id, dry_run, service=None, archive=None):
         """Constructor
 
         Args:
             sheet_id (str): ID of the document.
             dry_run (bool): if True, do not modify the document
+            service: Sheets v4 service to use instead of connecting to
+                     Google's (ex: tests/lib/MockSheetsService.py)
+            archive (ApiArchive): archive recording the results of the
+                                  API calls, or replaying them
         """
         self.dry_run = dry_run
-        self.credentials = self.get_credentials()
-
-        http = self.credentials.authorize(httplib2.Http())
-        discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                        'version=v4')
-        self.service = discovery.build('sheets', 'v4', http=http,
-                                  discoveryServiceUrl=discoveryUrl)
+        if service is None and not (archive and archive.replay):
+            import httplib2
+            from apiclient import discovery
+            self.credentials = self.get_credentials()
+
+            http = self.credentials.authorize(httplib2.Http())
+            discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
+                            'version=v4')
+            service = discovery.build('sheets', 'v4', http=http,
+                                      discoveryServiceUrl=discoveryUrl)
+        if archive:
+            service = archive.sheets_service(service)
+        self.service = service
 
         self.spreadsheetId = sheet_id
+        self.format_requests = []  # queued formatting: [(sheet name, request)]
+        self.sheets = None         # cached sheets of the document: {name: ID}
+        self.grid_sizes = {}       # cached sizes of the sheets: {name: (rows, columns)}
+        self.values_cache = {}     # values read by get_multiple_values(): {range: values}
 
     def check_or_create_sheet(self, sheetName):
         """Check if the sheet exists in the document, create it otherwise
@@ -1006,7 +4442,13 @@ class SheetConnector:
             }
           ]
         }
-        self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body).execute()
+        result = self.execute("batchUpdate", self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body))
+        try:
+            properties = result["replies"][0]["addSheet"]["properties"]
+            self.get_sheets()[properties["title"]] = properties["sheetId"]
+            self.set_grid_size(properties)
+        except (KeyError, IndexError):
+            self.sheets = None
 
     def sheet_exists(self, sheetName):
         """Check if the sheet exists in the document
@@ -1035,28 +4477,126 @@ class SheetConnector:
             }
           ]
         }
-        self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body).execute()
+        self.execute("batchUpdate", self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body))
+        del sheets[sheetName]
+        self.grid_sizes.pop(sheetName, None)
+        self.forget_values(sheetName)
+
+    def get_sheets(self, refresh=False):
+        """Get the sheets in the doc. The metadata of the document is only
+        downloaded once, then kept up to date when adding or deleting sheets.
 
-    def get_sheets(self):
-        """Get the sheets in the doc
+        Args:
+            refresh (bool): download the metadata again
 
         Returns:
             (dict) keys are names, values are IDs
         """
-        sheet_metadata = self.service.spreadsheets().get(spreadsheetId=self.spreadsheetId).execute()
-        sheets = sheet_metadata.get('sheets', '')
-        return {s["properties"]["title"]:s["properties"]["sheetId"] for s in sheets}
+        if (self.sheets is None) or refresh:
+            sheet_metadata = self.execute("get", self.service.spreadsheets().get(
+                spreadsheetId=self.spreadsheetId, fields="sheets.properties"))
+            sheets = sheet_metadata.get('sheets', '')
+            self.sheets = {s["properties"]["title"]:s["properties"]["sheetId"] for s in sheets}
+            self.grid_sizes = {}
+            for s in sheets:
+                self.set_grid_size(s["properties"])
+        return self.sheets
+
+    def set_grid_size(self, properties):
+        """Store the size of a sheet
+
+        Args:
+            properties (dict): properties of the sheet, from the API
+        """
+        grid = properties.get("gridProperties", {})
+        self.grid_sizes[properties["title"]] = (grid.get("rowCount", 1000), grid.get("columnCount", 26))
+
+    def get_grid_size(self, sheetName):
+        """Get the size of a sheet
+
+        Args:
+            sheetName (str): name of the sheet
+
+        Returns:
+            (int, int) the number of rows and columns
+        """
+        self.get_sheets()
+        return self.grid_sizes[sheetName]
+
+    def ensure_grid(self, sheetName, rows, columns):
+        """Ensure the sheet is large enough, adding rows and/or columns if needed
+
+        Args:
+            sheetName (str): name of the sheet
+            rows (int): minimum number of rows
+            columns (int): minimum number of columns
+        """
+        cur_rows, cur_columns = self.get_grid_size(sheetName)
+        batch = []
+        for dimension, current, needed in (("ROWS", cur_rows, rows), ("COLUMNS", cur_columns, columns)):
+            if needed > current:
+                batch.append({
+                  "appendDimension": {
+                    "sheetId": self.get_sheets()[sheetName],
+                    "dimension": dimension,
+                    "length": needed - current
+                  }
+                })
+        if not batch:
+            return
+        logger.info("%sExtending %s to %dx%d", ("DRYRUN: " if self.dry_run else ""), sheetName,
+                    max(rows, cur_rows), max(columns, cur_columns))
+        if not self.dry_run:
+            self.execute("batchUpdate", self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId,
+                                                                                body={"requests": batch}))
+            self.grid_sizes[sheetName] = (max(rows, cur_rows), max(columns, cur_columns))
+
+    def get_range(self, sheetName, first_col=0, last_col=None, first_row=None, last_row=None):
+        """Build a A1 range of a sheet, the whole sheet by default
+
+        Args:
+            sheetName (str): name of the sheet
+            first_col (int): index of the first column
+            last_col (int): index of the last column, last column of the grid if None
+            first_row (int): first row (from 1), all the rows if None
+            last_row (int): last row, same as first_row if None
+
+        Returns:
+            (str) the range, ex: "sheet2!A2:B2", "sheet2!C:AK"
+        """
+        if last_col is None:
+            last_col = max(self.get_grid_size(sheetName)[1] - 1, first_col)
+        if first_row is None:
+            return "%s!%s:%s" % (sheetName, column_letter(first_col), column_letter(last_col))
+        return "%s!%s%d:%s%d" % (sheetName, column_letter(first_col), first_row,
+                                 column_letter(last_col), last_row or first_row)
+
+    def forget_values(self, sheetName):
+        """Drop the cached values of a sheet
+
+        Args:
+            sheetName (str): name of the sheet
+        """
+        for rangeName in [r for r in self.values_cache if r.split("!")[0] == sheetName]:
+            del self.values_cache[rangeName]
 
-    def ensure_headers(self, sheetName, fieldnames):
+    def ensure_headers(self, sheetName, fieldnames, g_headers=None):
         """Ensure the sheet exists and contains the specified headers
 
         Args:
             sheetName (str): name of the sheet to check
-            sheetName (str array): headers to check
+            fieldnames (str array): headers to check
+            g_headers (str array): current headers of the sheet, read from
+                                   the document if None
+
+        Returns:
+            (str array) the headers of the sheet, including the added ones
         """
-        self.check_or_create_sheet(sheetName)
-        values = self.get_values(sheetName+"!1:1")
-        g_headers = values[0] if values else []
+        if g_headers is None:
+            self.check_or_create_sheet(sheetName)
+            values = self.get_values(sheetName+"!1:1")
+            g_headers = values[0] if values else []
+        g_headers = list(g_headers)
 
         appended_headers = []
 
@@ -1071,7 +4611,8 @@ class SheetConnector:
                 g_headers_indexes[field] = len(g_headers)
 
         if(appended_headers):
-            range_name = "%s!%s1:AZ1" % (sheetName, column_letter(len(g_headers_indexes) - len(appended_headers)))
+            self.ensure_grid(sheetName, 1, len(g_headers))
+            range_name = self.get_range(sheetName, len(g_headers) - len(appended_headers), len(g_headers) - 1, 1)
             logger.info("Adding headers in %s => %s", range_name, appended_headers)
 
             update_data = [{
@@ -1079,6 +4620,7 @@ class SheetConnector:
                 "range": range_name,
             }]
             self.update_values(update_data)
+        return g_headers
 
     def update_values(self, update_data):
         """Update values in the document
@@ -1089,18 +4631,61 @@ class SheetConnector:
         body = { "data": update_data, "value_input_option": "USER_ENTERED" }
         logger.info("%sUpdating data in Google sheets: %s", ("DRYRUN: " if self.dry_run else ""), update_data)
         if not self.dry_run:
-            self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheetId, body=body).execute()
+            self.execute("values.batchUpdate", self.service.spreadsheets().values().batchUpdate(spreadsheetId=self.spreadsheetId, body=body))
+            for d in update_data:
+                self.forget_values(d["range"].split("!")[0])
 
     def get_values(self, rangeName):
-        """Get values
+        """Get values, from the cache if already read by get_multiple_values()
 
         Args:
             rangeName (str): range of the values to get. Ex: "sheet2!A2:B2"
         """
-        result = self.service.spreadsheets().values().get(
-            spreadsheetId=self.spreadsheetId, range=rangeName).execute()
+        if rangeName in self.values_cache:
+            return self.values_cache[rangeName]
+        result = self.execute("values.get", self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheetId, range=rangeName))
         return result.get('values', [])
 
+    def get_multiple_values(self, rangeNames):
+        """Get the values of several ranges with a single request. The values
+        are cached until their sheet is modified.
+
+        Args:
+            rangeNames (str array): ranges of the values to get. Ex: ["sheet1!1:1", "sheet2!A2:B2"]
+
+        Returns:
+            (array) the values of each range, in the same order
+        """
+        to_read = [r for r in rangeNames if r not in self.values_cache]
+        if to_read:
+            result = self.execute("values.batchGet", self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheetId, ranges=to_read))
+            for rangeName, vr in zip(to_read, result.get('valueRanges', [])):
+                self.values_cache[rangeName] = vr.get('values', [])
+        return [self.values_cache[r] for r in rangeNames]
+
+    def execute(self, call, request):
+        """Execute a request to the API, measured in the metrics. Google's
+        client only returns the decoded response, so its size is not counted.
+
+        Args:
+            call (str): name of the API call, ex: "values.batchUpdate"
+            request: the request to execute, built by the service
+
+        Returns:
+            (dict) the decoded response
+        """
+        start = time.perf_counter()
+        try:
+            result = request.execute()
+        except Exception as e:
+            status = getattr(getattr(e, "resp", None), "status", None)
+            metrics.observe_request("sheets", call, status, time.perf_counter() - start)
+            raise
+        metrics.observe_request("sheets", call, 200, time.perf_counter() - start)
+        return result
+
     def get_credentials(self, flags=None):
         """Gets valid user credentials from storage.
 
@@ -1110,6 +4695,9 @@ class SheetConnector:
         Returns:
             Credentials, the obtained credential.
         """
+        from oauth2client import client
+        from oauth2client import tools
+        from oauth2client.file import Storage
         home_dir = os.path.expanduser('~')
         credential_dir = os.path.join(home_dir, '.credentials')
         if not os.path.exists(credential_dir):
@@ -1141,7 +4729,7 @@ class SheetConnector:
             The background color as a RGBColor object
         """
         ranges = "%s!%s%d" % (sheet, column, row)
-        data = self.service.spreadsheets().get(spreadsheetId=self.spreadsheetId, ranges=ranges, includeGridData=True).execute()
+        data = self.execute("get", self.service.spreadsheets().get(spreadsheetId=self.spreadsheetId, ranges=ranges, includeGridData=True))
         v = data["sheets"][0]["data"][0]["rowData"][0]["values"][0]
         if "effectiveFormat" in v:
             return RGBColor.from_float_rgb_dict(v["effectiveFormat"]["backgroundColor"])
@@ -1149,32 +4737,72 @@ class SheetConnector:
             return RGBColor.from_float_rgb_dict(v["userEnteredFormat"]["backgroundColor"])
 
     def set_background_color(self, sheet_name, column, row, rgb_color):
-        col_i = column_index(column) if type(column) is str else column
+        """Set background color of a cell right away
 
-        sheets = self.get_sheets()
+        Args:
+            sheet_name (string): name of the sheet
+            column (string or int): column id or index of the cell
+            row (int): row of the cell
+            rgb_color (RGBColor): the color
+        """
+        self.queue_background_color(sheet_name, column, row, rgb_color)
+        self.flush_formatting()
 
-        body = {
-          "requests": [
-            {
-              "repeatCell": {
-                "range": {
-                  "sheetId": sheets[sheet_name],
-                  "startRowIndex": row-1,
-                  "endRowIndex": row,
-                  "startColumnIndex": col_i,
-                  "endColumnIndex": col_i+1
-                },
-                "cell": {
-                  "userEnteredFormat": {
-                    "backgroundColor": rgb_color.to_float_rgb_dict()
-                  }
-                },
-                "fields": "userEnteredFormat(backgroundColor)"
+    def queue_background_color(self, sheet_name, column, row, rgb_color):
+        """Queue the background color of a cell, to be set with the other
+        queued formatting by flush_formatting()
+
+        Args:
+            sheet_name (string): name of the sheet
+            column (string or int): column id or index of the cell
+            row (int): row of the cell
+            rgb_color (RGBColor): the color
+        """
+        col_i = column_index(column) if type(column) is str else column
+        color = rgb_color.to_float_rgb_dict()
+
+        # extending the previous request when coloring the next cell of the column the same way
+        if self.format_requests:
+            prev_sheet, prev = self.format_requests[-1]
+            prev_cell = prev["repeatCell"]
+            if ((prev_sheet == sheet_name) and (prev_cell["range"]["endRowIndex"] == row-1)
+                    and (prev_cell["range"]["startColumnIndex"] == col_i)
+                    and (prev_cell["cell"]["userEnteredFormat"]["backgroundColor"] == color)):
+                prev_cell["range"]["endRowIndex"] = row
+                return
+
+        self.format_requests.append((sheet_name, {
+          "repeatCell": {
+            "range": {
+              "startRowIndex": row-1,
+              "endRowIndex": row,
+              "startColumnIndex": col_i,
+              "endColumnIndex": col_i+1
+            },
+            "cell": {
+              "userEnteredFormat": {
+                "backgroundColor": color
               }
             },
-          ]
-        }
-        self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body).execute()
+            "fields": "userEnteredFormat(backgroundColor)"
+          }
+        }))
+
+    def flush_formatting(self):
+        """Send all the queued formatting in a single request"""
+        if not self.format_requests:
+            return
+        logger.info("%sFormatting %d range(s) in Google sheets", ("DRYRUN: " if self.dry_run else ""),
+                    len(self.format_requests))
+        if not self.dry_run:
+            sheets = self.get_sheets()
+            batch = []
+            for sheet_name, request in self.format_requests:
+                request["repeatCell"]["range"]["sheetId"] = sheets[sheet_name]
+                batch.append(request)
+            body = {"requests": batch}
+            self.execute("batchUpdate", self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheetId, body=body))
+        self.format_requests = []
 
 
 if __name__ == "__main__":